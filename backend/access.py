@@ -0,0 +1,122 @@
+import os
+import uuid
+from typing import NamedTuple, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from database import AsyncSessionLocal, User, Membership, MembershipStatus, reads_from_replica
+from metrics import metrics
+
+# Both caches are invalidated explicitly when memberships or profiles change,
+# but only in the worker that made the change; the TTL bounds how long other
+# workers keep a stale answer. A revoked membership stays usable elsewhere for
+# up to MEMBERSHIP_CACHE_SECONDS, and a new one is refused for up to
+# MEMBERSHIP_NEGATIVE_CACHE_SECONDS.
+MEMBERSHIP_CACHE_SECONDS = float(os.getenv("MEMBERSHIP_CACHE_SECONDS", "30"))
+MEMBERSHIP_NEGATIVE_CACHE_SECONDS = float(os.getenv("MEMBERSHIP_NEGATIVE_CACHE_SECONDS", "5"))
+USER_CACHE_SECONDS = float(os.getenv("USER_CACHE_SECONDS", "300"))
+
+# (user id, org id) -> role_in_org of an approved membership, or NOT_A_MEMBER
+membership_cache = TTLCache(max_entries=100000, ttl=MEMBERSHIP_CACHE_SECONDS)
+# user id -> User detached from the session that loaded it
+user_cache = TTLCache(max_entries=50000, ttl=USER_CACHE_SECONDS)
+
+NOT_A_MEMBER = ""
+
+
+class OrgAccess(NamedTuple):
+    """Result of a successful organization membership check"""
+    user: User
+    organization_id: str
+    role: str
+
+
+def _normalize_id(value) -> Optional[str]:
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+async def get_membership_role(db: AsyncSession, user_id, organization_id) -> Optional[str]:
+    """Return the user's role in an organization if their membership is approved"""
+    user_key = _normalize_id(user_id)
+    org_key = _normalize_id(organization_id)
+    if user_key is None or org_key is None:
+        return None
+
+    role = membership_cache.get((user_key, org_key))
+    if role is not None:
+        metrics.increment("access.membership.cached")
+        return role or None
+
+    statement = select(Membership.role_in_org).where(
+        Membership.user_id == uuid.UUID(user_key),
+        Membership.organization_id == uuid.UUID(org_key),
+        Membership.status == MembershipStatus.APPROVED.value
+    ).limit(1)
+    role = await db.scalar(statement)
+    if role is None and reads_from_replica(db):
+        # A just-approved membership may not have reached the replica yet
+        async with AsyncSessionLocal() as primary:
+            role = await primary.scalar(statement)
+    # Non-members are cached only briefly, since approvals on other workers cannot invalidate the entry here
+    if role is None:
+        membership_cache.set((user_key, org_key), NOT_A_MEMBER, ttl=MEMBERSHIP_NEGATIVE_CACHE_SECONDS)
+    else:
+        membership_cache.set((user_key, org_key), role)
+    return role
+
+
+async def ensure_org_member(
+    db: AsyncSession,
+    user: User,
+    organization_id,
+    role: Optional[str] = None,
+    detail: str = "You are not a member of this organization"
+) -> OrgAccess:
+    """Raise 403 unless the user is an approved member (with the given role, if any)"""
+    member_role = await get_membership_role(db, user.id, organization_id)
+    if member_role is None or (role is not None and member_role != role):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=detail
+        )
+    return OrgAccess(user, str(organization_id), member_role)
+
+
+def invalidate_membership(user_id, organization_id) -> None:
+    """Forget a cached membership after it was created or changed"""
+    user_key = _normalize_id(user_id)
+    org_key = _normalize_id(organization_id)
+    if user_key is not None and org_key is not None:
+        membership_cache.invalidate((user_key, org_key))
+
+
+async def load_user(db: AsyncSession, user_id) -> Optional[User]:
+    """Return a User snapshot by id, loading it once per cache TTL"""
+    user_key = _normalize_id(user_id)
+    if user_key is None:
+        return None
+
+    user = user_cache.get(user_key)
+    if user is not None:
+        metrics.increment("access.user.cached")
+        return user
+
+    user = await db.get(User, uuid.UUID(user_key))
+    if user is not None:
+        # Detach so the snapshot can outlive this session; only loaded columns are read later
+        db.expunge(user)
+        user_cache.set(user_key, user)
+    return user
+
+
+def invalidate_user(user_id) -> None:
+    """Forget a cached User snapshot after its profile changed"""
+    user_key = _normalize_id(user_id)
+    if user_key is not None:
+        user_cache.invalidate(user_key)
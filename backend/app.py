@@ -1,23 +1,33 @@
 from fastapi import FastAPI, UploadFile, Form, Depends, HTTPException, status, Request
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import func, case, and_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, joinedload
 import os
-import tempfile
 from paperqa import Docs
 from dotenv import load_dotenv
 from datetime import timedelta, datetime
 import uuid
 import json
 import asyncio
-from typing import List, Dict, AsyncGenerator, Any
-from database import get_db, User, Organization, Paper, Membership, MembershipStatus, MembershipRole
+from typing import List, Dict, AsyncGenerator, Any, Optional
+from database import get_async_db, get_async_read_db, AsyncSessionLocal, async_engine, async_read_engine, User, Organization, OrganizationStats, Paper, Membership, MembershipStatus, MembershipRole, UserRole, storage_filename, ORG_SEARCH_USES_FTS
 from supabase_auth import SupabaseAuth
+from pagination import paginate
+from access import OrgAccess, ensure_org_member, invalidate_membership, membership_cache, user_cache
 from schemas import UserCreate, UserLogin, Token, QueryRequest, QueryResponse, UserOrganization, OrganizationSearch
 from pinecone_service import PineconeService
 from supabase_storage import SupabaseStorageService
 from profile import router as profile_router
+from cache import MemoryBoundedCache, TTLCache, approximate_size
+from pdf_cache import PdfDiskCache, temporary_pdf_path
+from concurrency import SingleFlight, StreamingSingleFlight, StageGraph, QueryScheduler, QueryTicket, QueueFullError
+from metrics import metrics
+from sql_metrics import sql_metrics
+from org_stats import adjust_org_stats, get_org_stats
+from rate_limit import embedding_governor, openai_governor
 import re
 import tiktoken
 import difflib
@@ -28,13 +38,71 @@ load_dotenv()
 UPLOAD_DIR = "uploaded_pdfs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Largest accepted PDF upload, and the chunk size used to spool uploads
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Room for the multipart framing and form fields around the file itself
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+PDF_MAGIC = b"%PDF-"
+
 app = FastAPI(title="Alexandria Multi-Tenant API")
 
+def upload_too_large() -> HTTPException:
+    metrics.increment("upload.rejected.too_large")
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File exceeds the {UPLOAD_MAX_BYTES // (1024 * 1024)} MB upload limit"
+    )
+
+class UploadSizeLimitMiddleware:
+    """Cap upload request bodies while they are received.
+
+    A declared Content-Length over the limit is refused before the body is
+    read. Bodies without one (chunked transfer) are cut off as soon as the
+    bytes received cross the limit, instead of after the form parser has
+    spooled them all.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/upload":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            error = upload_too_large()
+            response = JSONResponse(status_code=error.status_code, content={"detail": error.detail})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing, so this becomes a 413
+                    raise upload_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+# Registered before CORS so rejections still carry CORS headers
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD_BYTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    # Paginated listings return their next cursor in a header so bodies stay plain arrays
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Include profile router
@@ -56,21 +124,94 @@ except Exception as e:
     print(f"Failed to initialize Supabase Storage service: {e}")
     storage_service = None
 
-# Cache for Alexandria docs with timestamps for invalidation
-org_docs = {}
-org_docs_timestamps = {}
-
-# Enhanced caching for processed documents
-processed_docs_cache = {}
-doc_vectors_cache = {}
 cache_ttl = 3600  # 1 hour cache TTL
 
+# Memory-bounded cache for per-org PaperQA Docs ("docs")
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+DOCUMENT_CACHE_ORG_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_ORG_MAX_BYTES", str(256 * 1024 * 1024)))
+document_cache = MemoryBoundedCache(
+    max_bytes=DOCUMENT_CACHE_MAX_BYTES,
+    per_org_max_bytes=DOCUMENT_CACHE_ORG_MAX_BYTES,
+    ttl=cache_ttl
+)
+
+# On-disk LRU cache of PDF files shared by file serving and corpus loading.
+# The byte budget is tracked per process, so with several workers sharing the
+# directory set it to the disk space you can spare divided by the worker count.
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "pdf_cache")
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+pdf_cache = PdfDiskCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
+
+@app.on_event("shutdown")
+async def close_storage_client():
+    """Release pooled storage connections"""
+    if storage_service:
+        await storage_service.aclose()
+
+@app.on_event("shutdown")
+async def close_database_pool():
+    """Close pooled database connections"""
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+# Collapse concurrent cold loads per org and identical in-flight questions per org
+corpus_flight = SingleFlight("corpus")
+answer_flight = StreamingSingleFlight("answer")
+
 # Advanced preprocessing configuration
 CHUNK_SIZE = 1000  # Optimal chunk size for semantic search
 CHUNK_OVERLAP = 200  # Overlap to maintain context
 MAX_TOKENS_PER_QUERY = 4000  # Token limit for query processing
 RELEVANCE_THRESHOLD = 0.7  # Minimum relevance score for chunks
 
+# Per-query deadline covering setup and answer generation
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", "120"))
+DISCONNECT_POLL_SECONDS = 0.5
+QUERY_TIMEOUT_MESSAGE = "The query took too long to answer. Please try again."
+QUERY_BUSY_MESSAGE = "Too many queries in progress. Please try again shortly."
+
+# Rough OpenAI usage of one PaperQA call, charged to the shared rate governor up front
+PAPERQA_QUERY_REQUESTS = 12  # evidence summaries plus the answer
+PAPERQA_QUERY_TOKENS = int(os.getenv("PAPERQA_QUERY_TOKEN_ESTIMATE", "30000"))
+# Adding a paper makes one citation-inference chat call and embeds every chunk
+PAPERQA_ADD_CHAT_TOKENS = int(os.getenv("PAPERQA_ADD_CHAT_TOKEN_ESTIMATE", "2000"))
+PAPERQA_ADD_EMBEDDING_TOKENS = int(os.getenv("PAPERQA_ADD_TOKEN_ESTIMATE", "8000"))
+# Corpus loads run beside a live question's retrieval and answer, and must not starve them
+CORPUS_LOAD_PRIORITY = "ingestion"
+
+# Admission control for LLM-backed answering
+QUERY_MAX_CONCURRENT = int(os.getenv("QUERY_MAX_CONCURRENT", "8"))
+QUERY_MAX_QUEUED = int(os.getenv("QUERY_MAX_QUEUED", "32"))
+QUERY_MAX_QUEUED_PER_ORG = int(os.getenv("QUERY_MAX_QUEUED_PER_ORG", "8"))
+
+# How long browsers may reuse a served PDF before revalidating it with its ETag
+PDF_BROWSER_CACHE_SECONDS = int(os.getenv("PDF_BROWSER_CACHE_SECONDS", "3600"))
+PDF_RANGE_CHUNK_SIZE = 64 * 1024
+
+# "proxy" serves PDFs through the API; "redirect" sends clients to a signed storage URL
+PDF_SERVE_MODE = os.getenv("PDF_SERVE_MODE", "proxy").lower()
+PDF_SIGNED_URL_SECONDS = int(os.getenv("PDF_SIGNED_URL_SECONDS", "3600"))
+# Stop handing out a cached signed URL this long before it expires
+PDF_SIGNED_URL_REFRESH_MARGIN = 300
+
+query_scheduler = QueryScheduler(
+    max_concurrent=QUERY_MAX_CONCURRENT,
+    max_queued=QUERY_MAX_QUEUED,
+    max_queued_per_org=QUERY_MAX_QUEUED_PER_ORG
+)
+
+# Organization typeahead: results per (user, query), reused to answer longer queries
+ORG_SEARCH_LIMIT = 20
+ORG_SEARCH_CACHE_SECONDS = 30
+org_search_cache = TTLCache(max_entries=20000, ttl=ORG_SEARCH_CACHE_SECONDS)
+
+# Signed storage URLs per object path for redirect serving
+signed_url_cache = TTLCache(
+    max_entries=10000,
+    ttl=PDF_SIGNED_URL_SECONDS - PDF_SIGNED_URL_REFRESH_MARGIN
+)
+
 security = HTTPBearer()
 
 def intelligent_chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
@@ -121,8 +262,36 @@ def optimize_context_for_tokens(chunks: List[Dict], max_tokens: int = MAX_TOKENS
     
     return optimized_context.strip()
 
-def enhanced_question_cleaning(answer_text: str, question_text: str) -> str:
-    """Enhanced cleaning to remove question repetition and improve answer quality, even if paraphrased."""
+# Phrases PaperQA uses when the corpus cannot support an answer
+CANNOT_ANSWER_PATTERNS = [
+    "i cannot answer",
+    "i can't answer", 
+    "cannot answer",
+    "can't answer",
+    "don't have enough information",
+    "not enough information",
+    "insufficient information",
+    "no relevant information found"
+]
+
+INSUFFICIENT_INFO_MESSAGE = "I'm sorry, but I don't have enough information to answer your question. Could you please upload a document to your organization to provide some context?"
+
+# Trailing references sections that should not be shown in the chat answer
+REFERENCES_PATTERNS = [
+    r'\n\s*References?\s*:?\s*\n.*',
+    r'\n\s*Sources?\s*:?\s*\n.*',
+    r'\n\s*Bibliography\s*:?\s*\n.*',
+    r'\n\s*\d+\.\s*\([^)]+\):.*',
+    r'\n\s*\[[^\]]+\].*'
+]
+
+def has_insufficient_info(answer_text: str) -> bool:
+    """Check whether an answer says the documents do not cover the question"""
+    answer_lower = answer_text.lower()
+    return any(pattern in answer_lower for pattern in CANNOT_ANSWER_PATTERNS)
+
+def remove_question_echo(answer_text: str, question_text: str) -> str:
+    """Remove a restatement of the question from the start of an answer, even if paraphrased"""
     def normalize(text):
         return re.sub(r'\W+', '', text).strip().lower()
     
@@ -146,17 +315,23 @@ def enhanced_question_cleaning(answer_text: str, question_text: str) -> str:
         similarity = SequenceMatcher(None, norm_first, norm_question).ratio()
         if similarity > 0.7:
             # Remove the first sentence
-            cleaned_answer = ' '.join(sentences[1:]).strip()
+            cleaned_answer = ' '.join(sentences[1:])
         else:
             # Also check the first two sentences combined
             if len(sentences) > 1:
                 norm_first_two = normalize(' '.join(sentences[:2]))
                 similarity2 = SequenceMatcher(None, norm_first_two, norm_question).ratio()
                 if similarity2 > 0.7:
-                    cleaned_answer = ' '.join(sentences[2:]).strip()
+                    cleaned_answer = ' '.join(sentences[2:])
     
-    # Remove leading/trailing whitespace and punctuation
-    cleaned_answer = re.sub(r'^[\s\.,:;\-\n]+', '', cleaned_answer)
+    # Remove leading whitespace and punctuation
+    return re.sub(r'^[\s\.,:;\-\n]+', '', cleaned_answer)
+
+def enhanced_question_cleaning(answer_text: str, question_text: str) -> str:
+    """Enhanced cleaning to remove question repetition and improve answer quality, even if paraphrased."""
+    cleaned_answer = remove_question_echo(answer_text, question_text)
+    
+    # Remove trailing whitespace and punctuation
     cleaned_answer = re.sub(r'[\s\.,:;\-\n]+$', '', cleaned_answer)
     
     # If answer is too short after cleaning, return original
@@ -165,23 +340,141 @@ def enhanced_question_cleaning(answer_text: str, question_text: str) -> str:
     
     return cleaned_answer.strip()
 
-async def get_cached_documents(org_id: str, db: Session) -> tuple:
-    """Get cached documents or load them efficiently"""
-    current_time = datetime.utcnow()
+def clean_answer_text(answer_text: str, question_text: str) -> str:
+    """Clean a complete answer: drop question echo, references and extra whitespace"""
+    cleaned_answer = enhanced_question_cleaning(answer_text, question_text)
+    
+    for pattern in REFERENCES_PATTERNS:
+        cleaned_answer = re.sub(pattern, '', cleaned_answer, flags=re.IGNORECASE | re.DOTALL)
     
+    # Clean up extra whitespace
+    cleaned_answer = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned_answer)
+    return cleaned_answer.strip()
+
+class IncrementalAnswerCleaner:
+    """Apply the clean_answer_text post-processing to an answer as tokens arrive.
+
+    The first sentences are held back until the question echo and
+    "cannot answer" checks can run on them. After that, text is released as
+    soon as it cannot be the start of a references section; once one is seen,
+    the rest of the answer is dropped.
+    """
+
+    HEAD_SENTENCES = 2
+    HEAD_MAX_CHARS = 300
+    REFERENCE_HEADINGS = ("references", "sources", "bibliography")
+
+    def __init__(self, question: str):
+        self.question = question
+        self.insufficient_info = False
+        self._head = ""
+        self._head_done = False
+        self._pending = ""
+        self._stopped = False
+
+    def feed(self, token: str) -> str:
+        """Add a token and return the text that is now safe to emit"""
+        if self._stopped:
+            return ""
+        if self._head_done:
+            return self._filter(token)
+        
+        self._head += token
+        sentence_ends = len(re.findall(r'[.!?]\s', self._head))
+        if sentence_ends < self.HEAD_SENTENCES and len(self._head) < self.HEAD_MAX_CHARS:
+            return ""
+        return self._release_head()
+
+    def finish(self) -> str:
+        """Flush whatever is still held back at the end of the answer"""
+        if self._stopped:
+            return ""
+        if not self._head_done:
+            # Short answers get the full non-incremental cleaning
+            self._head_done = True
+            self._stopped = True
+            if has_insufficient_info(self._head):
+                self.insufficient_info = True
+                return ""
+            return clean_answer_text(self._head, self.question)
+        
+        remaining = self._filter("\n")
+        self._stopped = True
+        return remaining.rstrip()
+
+    def _release_head(self) -> str:
+        self._head_done = True
+        if has_insufficient_info(self._head):
+            self.insufficient_info = True
+            self._stopped = True
+            return ""
+        return self._filter(remove_question_echo(self._head, self.question))
+
+    def _may_start_references(self, line: str) -> bool:
+        text = line.lstrip().lower()
+        if not text or text[0] == '[' or text[0].isdigit():
+            return True
+        return any(heading.startswith(text) or text.startswith(heading[:-1]) for heading in self.REFERENCE_HEADINGS)
+
+    def _filter(self, text: str) -> str:
+        self._pending += text
+        
+        for pattern in REFERENCES_PATTERNS:
+            match = re.search(pattern, self._pending, flags=re.IGNORECASE | re.DOTALL)
+            if match:
+                self._stopped = True
+                released = self._pending[:match.start()].rstrip()
+                self._pending = ""
+                return re.sub(r'\n\s*\n\s*\n', '\n\n', released)
+        
+        # Hold back the current line only while it could still open a references section
+        last_newline = self._pending.rfind("\n")
+        if last_newline != -1 and self._may_start_references(self._pending[last_newline:]):
+            released = self._pending[:last_newline]
+            self._pending = self._pending[last_newline:]
+        else:
+            released = self._pending
+            self._pending = ""
+        return re.sub(r'\n\s*\n\s*\n', '\n\n', released)
+
+def corpus_size(docs) -> int:
+    """Bytes held by a PaperQA corpus, never less than its texts and embeddings alone"""
+    known = 0
+    for text in getattr(docs, "texts", None) or []:
+        known += len(getattr(text, "text", "") or "")
+        embedding = getattr(text, "embedding", None)
+        if embedding is not None:
+            # A list of Python floats costs a float object plus a pointer per value
+            known += getattr(embedding, "nbytes", None) or len(embedding) * 32
+    return max(approximate_size(docs), known)
+
+async def get_cached_documents(org_id: str) -> tuple:
+    """Get cached documents or load them efficiently"""
     # Check if we have valid cached docs
-    if (org_id in org_docs and 
-        org_id in org_docs_timestamps and 
-        (current_time - org_docs_timestamps[org_id]).seconds < cache_ttl):
+    docs = document_cache.get(org_id, "docs")
+    if docs is not None:
         print(f"Using cached documents for organization {org_id}")
-        return org_docs[org_id], True
+        return docs, True
     
+    # Concurrent cold requests for the same org share a single load
+    docs = await corpus_flight.do(org_id, lambda: _load_documents(org_id))
+    return docs, False
+
+async def charge_paperqa_add() -> None:
+    """Charge adding one paper to PaperQA to the chat and embedding budgets"""
+    await openai_governor.acquire_async(PAPERQA_ADD_CHAT_TOKENS, CORPUS_LOAD_PRIORITY)
+    await embedding_governor.acquire_async(PAPERQA_ADD_EMBEDDING_TOKENS, CORPUS_LOAD_PRIORITY)
+
+async def _load_documents(org_id: str):
+    """Build PaperQA Docs for an organization and cache them"""
     # Load documents efficiently
     print(f"Loading documents for organization {org_id}...")
-    papers = db.query(Paper).filter(Paper.organization_id == org_id).all()
+    # The load is shared by every waiting request, so it uses its own session
+    async with AsyncSessionLocal() as db:
+        papers = (await db.scalars(select(Paper).where(Paper.organization_id == org_id))).all()
     
     if not papers:
-        return None, False
+        return None
     
     docs = Docs()
     
@@ -189,37 +482,375 @@ async def get_cached_documents(org_id: str, db: Session) -> tuple:
     for paper in papers:
         if storage_service:
             try:
-                # Check if we have cached PDF content
-                cache_key = f"{org_id}_{paper.id}"
-                if cache_key in processed_docs_cache:
-                    pdf_content = processed_docs_cache[cache_key]
-                else:
-                    print(f"Downloading PDF for PaperQA: {paper.title}")
-                    pdf_content = storage_service.download_pdf(str(paper.file_url))
-                    # Cache the PDF content
-                    processed_docs_cache[cache_key] = pdf_content
-                
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                    temp_file.write(pdf_content)
-                    temp_file_path = temp_file.name
-                await docs.aadd(temp_file_path)
-                os.unlink(temp_file_path)
+                # Downloads land in the disk cache, so PaperQA can read the cached file directly
+                try:
+                    cached_pdf = await pdf_cache.fetch(str(paper.file_url), storage_service.astream_pdf)
+                except OSError as e:
+                    # The cache disk is unusable (e.g. full); PaperQA still needs a path, so use a scoped temp file
+                    print(f"PDF disk cache unavailable for {paper.id}, loading from memory: {e}")
+                    pdf_content = await storage_service.adownload_pdf(str(paper.file_url))
+                    with temporary_pdf_path(pdf_content) as temp_file_path:
+                        await charge_paperqa_add()
+                        await docs.aadd(temp_file_path)
+                    continue
+                await charge_paperqa_add()
+                await docs.aadd(cached_pdf.path)
             except Exception as e:
                 print(f"Error loading PDF {paper.id} for PaperQA: {e}")
         else:
+            await charge_paperqa_add()
             await docs.aadd(str(paper.file_url))
     
-    # Cache the docs
-    org_docs[org_id] = docs
-    org_docs_timestamps[org_id] = current_time
+    # Cache the docs; sizing walks the whole corpus, so keep it off the event loop
+    document_cache.set(org_id, "docs", docs, size=await asyncio.to_thread(corpus_size, docs))
     print(f"Cached {len(papers)} documents for organization {org_id}")
     
-    return docs, False
+    return docs
+
+async def run_paperqa_query(docs, question: str, token_stream) -> Any:
+    """Answer a question with PaperQA, publishing answer tokens as the model emits them.
+
+    Evidence is gathered first without callbacks: aquery would otherwise
+    stream every chunk summary ahead of the answer.
+    """
+    await openai_governor.acquire_async(PAPERQA_QUERY_TOKENS, "interactive", requests=PAPERQA_QUERY_REQUESTS)
+    session = await docs.aget_evidence(question)
+    if not session.contexts:
+        # aquery would gather evidence again, with callbacks; nothing is worth streaming anyway
+        return await docs.aquery(session)
+    return await docs.aquery(session, callbacks=[token_stream.publish])
+
+def answer_flight_key(organization_id, question: str) -> tuple:
+    """Key identical questions within an org, ignoring case and whitespace"""
+    return (str(organization_id), " ".join(question.split()).lower())
 
 async def get_current_user(credentials = Depends(security)):
     """Get current user from Supabase token"""
     return await SupabaseAuth.get_user_by_token(credentials.credentials)
 
+def require_org_member(role: Optional[str] = None, detail: str = "You are not a member of this organization"):
+    """Dependency requiring an approved membership in the path's organization.
+
+    Memberships are served from a TTL cache, so repeat checks cost no queries;
+    misses are read from the replica when one is configured.
+    """
+    async def dependency(
+        organization_id: str,
+        current_user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_read_db)
+    ) -> OrgAccess:
+        return await ensure_org_member(db, current_user, organization_id, role, detail)
+    return dependency
+
+async def build_sources(organization_id, relevant_chunks: List[Dict], db: AsyncSession) -> tuple:
+    """Build citation sources for the top retrieved chunks"""
+    sources = []
+    enhanced_sources = []
+    top_chunks = relevant_chunks[:5]
+    
+    # Resolve only the referenced papers in a single IN query
+    paper_ids = set()
+    for chunk in top_chunks:
+        try:
+            paper_ids.add(uuid.UUID(str(chunk.get("paper_id", ""))))
+        except ValueError:
+            continue
+    if not paper_ids:
+        return sources, enhanced_sources
+    
+    papers = (await db.scalars(select(Paper).where(
+        Paper.organization_id == organization_id,
+        Paper.id.in_(paper_ids)
+    ))).all()
+    
+    paper_map = {str(paper.id): paper for paper in papers}
+    
+    print(f"Processing {len(top_chunks)} Pinecone chunks for sources")
+    for chunk in top_chunks:
+        paper_id = chunk.get("paper_id", "")
+        paper = paper_map.get(paper_id)
+        
+        if paper:
+            filename = os.path.basename(str(paper.file_url))
+            source_url = f"/papers/{organization_id}/file/{filename}"
+            
+            # Create citation
+            author_year = ""
+            if paper.title:
+                author_match = re.search(r'^([^(]+?)\s*\((\d{4})\)', paper.title)
+                if author_match:
+                    author = author_match.group(1).strip()
+                    year = author_match.group(2)
+                    author_year = f"{author} ({year})"
+                else:
+                    author_year = paper.title.split()[0] if paper.title.split() else "Unknown"
+            
+            chunk_index = chunk.get("chunk_index", 0)
+            citation = f"{author_year}, page {chunk_index + 1}" if author_year else f"{paper.title} (page {chunk_index + 1})"
+            
+            # Only add if not already present
+            if source_url not in [s["url"] for s in sources]:
+                sources.append({
+                    "url": source_url,
+                    "title": paper.title,
+                    "citation": citation
+                })
+                
+                enhanced_sources.append({
+                    "url": source_url,
+                    "title": paper.title,
+                    "citation": citation,
+                    "paper_id": str(paper.id),
+                    "chunk_index": chunk_index,
+                    "relevance_score": chunk.get("score", 0.0)
+                })
+    
+    return sources, enhanced_sources
+
+async def wait_for_disconnect(request: Request) -> None:
+    """Return once the client behind a request has gone away"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+async def race_request(future: asyncio.Future, disconnected: asyncio.Future, deadline: float) -> str | None:
+    """Wait for future unless the client disconnects or the deadline passes first.
+
+    Returns None when the future completed, otherwise the reason it was
+    abandoned ("disconnect" or "deadline") after cancelling it.
+    """
+    timeout = max(0.0, deadline - asyncio.get_running_loop().time())
+    done, _ = await asyncio.wait({future, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if future in done:
+        return None
+    
+    future.cancel()
+    if disconnected in done:
+        print("Client disconnected, abandoning query")
+        metrics.increment("query.cancelled.disconnect")
+        return "disconnect"
+    print(f"Query exceeded {QUERY_TIMEOUT_SECONDS:.0f}s deadline")
+    metrics.increment("query.cancelled.deadline")
+    return "deadline"
+
+async def stream_answer_events(
+    query_data: QueryRequest,
+    docs,
+    relevant_chunks: List[Dict],
+    request: Request,
+    deadline: float,
+    ticket: QueryTicket | None = None
+) -> AsyncGenerator[str, None]:
+    """Stream sources, then the answer as server-sent events while the model generates it.
+
+    Starting a new PaperQA run waits for a scheduler slot (admitting the
+    request first if it came without a ticket), and generation is abandoned when
+    the client disconnects or the query deadline (a loop.time() value)
+    passes; the shared PaperQA task is cancelled once no other request is
+    reading it.
+    """
+    try:
+        print("Starting enhanced streaming query...")
+        start_time = datetime.utcnow()
+        
+        # Sources come from retrieval alone, so send them before generation starts
+        # The request's session is closed once streaming starts, so use a short-lived one
+        async with AsyncSessionLocal() as db:
+            sources, enhanced_sources = await build_sources(query_data.organization_id, relevant_chunks, db)
+        if sources:
+            yield f"data: {json.dumps({'sources': sources})}\n\n"
+        
+        if enhanced_sources:
+            yield f"data: {json.dumps({'enhanced_sources': enhanced_sources})}\n\n"
+        
+        # Show a single indicator until the first answer token arrives
+        yield f"data: {json.dumps({'answer': 'Generating response', 'thinking': True})}\n\n"
+        
+        flight_key = answer_flight_key(query_data.organization_id, query_data.question)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+        answer_task = None
+        try:
+            # Starting a new PaperQA run needs a scheduler slot; joining one in flight does not.
+            # A question that was in flight at admission may have finished since, so admit now.
+            if not answer_flight.in_flight(flight_key):
+                if ticket is None:
+                    try:
+                        ticket = reserve_query_slot(query_data.organization_id, deadline)
+                    except QueueFullError:
+                        yield f"data: {json.dumps({'error': QUERY_BUSY_MESSAGE})}\n\n"
+                        return
+                if ticket.waiting:
+                    print(f"Waiting for a query slot for organization {query_data.organization_id}")
+                    abandoned = await race_request(asyncio.ensure_future(ticket.acquire()), disconnected, deadline)
+                    if abandoned == "deadline":
+                        yield f"data: {json.dumps({'error': QUERY_TIMEOUT_MESSAGE})}\n\n"
+                    if abandoned:
+                        return
+            
+            # Stream PaperQA's answer tokens, cleaning them as they arrive
+            try:
+                print("Running PaperQA query...")
+                # No await between this check and the join, so it tells whether we lead the run
+                coalesced = answer_flight.in_flight(flight_key)
+                stream, answer_task = answer_flight.join_stream(
+                    flight_key,
+                    lambda token_stream: run_paperqa_query(docs, query_data.question, token_stream)
+                )
+                if ticket is not None:
+                    if coalesced:
+                        ticket.release()
+                    else:
+                        # The slot is held for as long as the shared answer task runs
+                        ticket.release_when_done(answer_task)
+                
+                cleaner = IncrementalAnswerCleaner(query_data.question)
+                first_token_time = None
+                streamed_any = False
+                tokens = stream.__aiter__()
+                
+                while True:
+                    next_token = asyncio.ensure_future(tokens.__anext__())
+                    abandoned = await race_request(next_token, disconnected, deadline)
+                    if abandoned == "deadline":
+                        yield f"data: {json.dumps({'error': QUERY_TIMEOUT_MESSAGE})}\n\n"
+                    if abandoned:
+                        return
+                    
+                    try:
+                        token = next_token.result()
+                    except StopAsyncIteration:
+                        break
+                    
+                    if first_token_time is None:
+                        first_token_time = datetime.utcnow()
+                        metrics.observe("query.time_to_first_token", (first_token_time - start_time).total_seconds())
+                        print(f"First answer token after {(first_token_time - start_time).total_seconds():.2f}s")
+                    text = cleaner.feed(token)
+                    if text:
+                        streamed_any = True
+                        yield f"data: {json.dumps({'answer': text, 'thinking': False})}\n\n"
+                
+                answer = await asyncio.shield(answer_task)
+                
+                if first_token_time is None:
+                    # PaperQA answered without calling the LLM (e.g. no usable contexts)
+                    cleaner = IncrementalAnswerCleaner(query_data.question)
+                    cleaner.feed(answer.formatted_answer)
+                
+                text = cleaner.finish()
+                if text:
+                    streamed_any = True
+                    yield f"data: {json.dumps({'answer': text, 'thinking': False})}\n\n"
+                
+                if cleaner.insufficient_info and not streamed_any:
+                    # Return custom message for insufficient information
+                    yield f"data: {json.dumps({'answer': INSUFFICIENT_INFO_MESSAGE, 'thinking': False, 'insufficient_info': True})}\n\n"
+                    print("Detected insufficient information response, sent custom message")
+                    return
+                
+                metrics.observe("query.answer", (datetime.utcnow() - start_time).total_seconds())
+                print(f"Enhanced streaming completed in {(datetime.utcnow() - start_time).total_seconds():.2f}s")
+                
+            except Exception as e:
+                print(f"Error in PaperQA query: {e}")
+                yield f"data: {json.dumps({'error': f'Error generating response: {str(e)}'})}\n\n"
+                return
+        except asyncio.CancelledError:
+            # The server cancels the response when it notices the disconnect first
+            print("Streaming response cancelled, abandoning query")
+            metrics.increment("query.cancelled.disconnect")
+            raise
+        finally:
+            disconnected.cancel()
+            if answer_task is not None:
+                answer_flight.leave_stream(answer_task)
+            elif ticket is not None:
+                ticket.release()
+    except Exception as e:
+        print(f"Error in streaming query: {e}")
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+def reserve_query_slot(organization_id, deadline: float) -> QueryTicket:
+    """Admit a query to the scheduler, raising QueueFullError when saturated"""
+    ticket = query_scheduler.admit(str(organization_id))
+    # Safety net: a response that is never streamed must not hold its slot forever;
+    # it is disarmed once the slot is handed to an answer task
+    ticket.release_at(deadline)
+    return ticket
+
+def admit_query(query_data: QueryRequest, deadline: float) -> QueryTicket | None:
+    """Reserve answering capacity for a query, failing fast with 429 when saturated"""
+    # Questions already being answered share that work; stream_answer_events
+    # admits them after all if the run finishes before they join it
+    if answer_flight.in_flight(answer_flight_key(query_data.organization_id, query_data.question)):
+        return None
+    try:
+        return reserve_query_slot(query_data.organization_id, deadline)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=QUERY_BUSY_MESSAGE,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+async def prepare_query(query_data: QueryRequest, current_user: User, db: AsyncSession, deadline: float) -> tuple:
+    """Check membership, retrieve chunks and warm the org corpus concurrently.
+
+    Retrieval (embedding + Pinecone) runs in a worker thread alongside the
+    membership check; the corpus load starts as soon as membership passes, so
+    a cold query costs roughly the slowest stage rather than their sum.
+    """
+    org_id_str = str(query_data.organization_id)
+    graph = StageGraph("query")
+    
+    async def check_membership(results):
+        return await ensure_org_member(db, current_user, query_data.organization_id)
+    
+    async def retrieve_chunks(results):
+        if not pinecone_service:
+            print("Pinecone service not available")
+            return []
+        try:
+            relevant_chunks = await asyncio.to_thread(
+                pinecone_service.search_similar_chunks,
+                query=query_data.question,
+                organization_id=org_id_str,
+                top_k=8
+            )
+            print(f"Found {len(relevant_chunks)} relevant chunks from Pinecone")
+            return relevant_chunks
+        except Exception as e:
+            print(f"Error in Pinecone search: {e}")
+            return []
+    
+    async def warm_corpus(results):
+        docs, _ = await get_cached_documents(org_id_str)
+        if docs is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No papers found in organization. Please upload some papers first."
+            )
+        return docs
+    
+    graph.add("membership", check_membership)
+    graph.add("retrieval", retrieve_chunks)
+    # Only members may trigger a (potentially expensive) corpus load
+    graph.add("corpus", warm_corpus, depends_on=("membership",))
+    
+    try:
+        results = await asyncio.wait_for(graph.run(), timeout=max(0.0, deadline - asyncio.get_running_loop().time()))
+    except asyncio.TimeoutError:
+        metrics.increment("query.cancelled.deadline")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="The query took too long to prepare. Please try again."
+        )
+    finally:
+        for stage, seconds in graph.timings.items():
+            metrics.observe(f"query.stage.{stage}", seconds)
+        print("Query setup timings: " + ", ".join(f"{stage}={seconds:.2f}s" for stage, seconds in graph.timings.items()))
+    
+    return results["corpus"], results["retrieval"]
+
 @app.post("/register", response_model=Token)
 async def register(user_data: UserCreate):
     """Register a new user with email and password"""
@@ -257,9 +888,12 @@ async def login(user_data: UserLogin):
     )
 
 @app.post("/logout")
-async def logout(current_user: User = Depends(get_current_user)):
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: User = Depends(get_current_user)
+):
     """Logout user"""
-    return await SupabaseAuth.sign_out(str(current_user.id))
+    return await SupabaseAuth.sign_out(credentials.credentials)
 
 @app.post("/upload")
 async def upload_paper(
@@ -267,21 +901,11 @@ async def upload_paper(
     title: str = Form(...),
     organization_id: str = Form(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Upload a paper to an organization"""
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
+    await ensure_org_member(db, current_user, organization_id)
     
     if not file.filename or not file.filename.endswith('.pdf'):
         raise HTTPException(
@@ -289,65 +913,93 @@ async def upload_paper(
             detail="Only PDF files are supported"
         )
     
-    # Read file content
-    file_content = await file.read()
-    
-    # Upload to Supabase Storage
     if not storage_service:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Storage service not available"
         )
     
-    try:
-        storage_path = storage_service.upload_pdf(
-            file_content=file_content,
-            filename=file.filename,
-            organization_id=str(organization_id)
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to upload PDF: {str(e)}"
-        )
-    
-    paper = Paper(
-        id=uuid.uuid4(),
-        title=title,
-        file_url=storage_path,  # Store the Supabase storage path
-        uploaded_by=current_user.id,
-        organization_id=organization_id
-    )
-    db.add(paper)
-    db.commit()
-    db.refresh(paper)
-    
-    # Process PDF with Pinecone for vectorization
-    if pinecone_service:
+    # Spool the upload into the PDF cache in chunks, hashing and checking it on the way
+    with pdf_cache.spool() as spool:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            # Readers accept the header anywhere in the first KiB
+            if spool.size == 0 and PDF_MAGIC not in chunk[:1024]:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Only PDF files are supported"
+                )
+            if spool.size + len(chunk) > UPLOAD_MAX_BYTES:
+                raise upload_too_large()
+            # Hashing and file writes block, so they run in a worker thread
+            await asyncio.to_thread(spool.write, chunk)
+        
+        if spool.size == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Uploaded file is empty"
+            )
+        print(f"Received upload {file.filename}: {spool.size} bytes, sha256 {spool.digest}")
+        
+        async def spooled_chunks():
+            chunks = spool.iter_chunks(UPLOAD_CHUNK_SIZE)
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                yield chunk
+        
+        # Upload to Supabase Storage
         try:
-            # Create temporary file for Pinecone processing
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                temp_file.write(file_content)
-                temp_file_path = temp_file.name
-            
-            success = pinecone_service.store_document_vectors(
+            storage_path = await storage_service.aupload_pdf(
+                file_content=spooled_chunks(),
+                filename=file.filename,
                 organization_id=str(organization_id),
-                paper_id=str(paper.id),
-                file_path=temp_file_path,
-                title=title
+                content_length=spool.size
             )
-            if not success:
-                print(f"Warning: Failed to vectorize PDF {paper.id}")
-            
-            # Clean up temporary file
-            os.unlink(temp_file_path)
         except Exception as e:
-            print(f"Error during PDF vectorization: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Failed to upload PDF: {str(e)}"
+            )
+        
+        paper = Paper(
+            id=uuid.uuid4(),
+            title=title,
+            file_url=storage_path,  # Store the Supabase storage path
+            filename=storage_filename(storage_path),
+            size_bytes=spool.size,
+            uploaded_by=current_user.id,
+            organization_id=organization_id
+        )
+        db.add(paper)
+        await adjust_org_stats(db, organization_id, paper_count=1, total_bytes=spool.size)
+        await db.commit()
+        
+        # Process PDF with Pinecone for vectorization, reading the spooled file directly.
+        # Extraction, embedding and the governor's waits block, so they run in a worker thread.
+        if pinecone_service:
+            try:
+                chunk_count = await asyncio.to_thread(
+                    pinecone_service.store_document_vectors,
+                    organization_id=str(organization_id),
+                    paper_id=str(paper.id),
+                    file_path=spool.file,
+                    title=title,
+                    filename=file.filename
+                )
+                if chunk_count:
+                    paper.chunk_count = chunk_count
+                    await adjust_org_stats(db, organization_id, chunk_count=chunk_count)
+                    await db.commit()
+                else:
+                    print(f"Warning: Failed to vectorize PDF {paper.id}")
+            except Exception as e:
+                print(f"Error during PDF vectorization: {e}")
+        
+        # Keep the file so the first view and corpus load skip the storage download
+        try:
+            await asyncio.to_thread(spool.commit, storage_path)
+        except Exception as e:
+            print(f"Error caching uploaded PDF {paper.id}: {e}")
     
-    if organization_id in org_docs:
-        del org_docs[organization_id]
-        if organization_id in org_docs_timestamps:
-            del org_docs_timestamps[organization_id]
+    if document_cache.invalidate(organization_id, "docs"):
         print(f"Invalidated cache for organization {organization_id}")
     
     return {"message": "Paper uploaded successfully", "paper_id": str(paper.id)}
@@ -355,215 +1007,23 @@ async def upload_paper(
 @app.post("/query", response_model=QueryResponse)
 async def query_organization_papers(
     query_data: QueryRequest,
+    request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Query papers in an organization using hybrid search (Pinecone + Alexandria)"""
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == query_data.organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
-    # Step 1: Use Pinecone for fast semantic search to get relevant context
-    relevant_chunks = []
-    pinecone_context = ""  # Initialize here to fix scope issue
-    if pinecone_service:
-        try:
-            relevant_chunks = pinecone_service.search_similar_chunks(
-                query=query_data.question,
-                organization_id=str(query_data.organization_id),
-                top_k=8  # Reduced from 15 to 8 for better performance
-            )
-            
-            # Build context from Pinecone results with token limit
-            if relevant_chunks:
-                pinecone_context = optimize_context_for_tokens(relevant_chunks, max_tokens=MAX_TOKENS_PER_QUERY)
-                print(f"Found {len(relevant_chunks)} relevant chunks from Pinecone")
-            else:
-                print("No relevant chunks found from Pinecone")
-        except Exception as e:
-            print(f"Error in Pinecone search: {e}")
-    
-    # Step 2: Use PaperQA for detailed analysis with enhanced context
-    org_id_str = str(query_data.organization_id)
-    if org_id_str not in org_docs:
-        print(f"Loading documents for organization {org_id_str}...")
-        papers = db.query(Paper).filter(
-            Paper.organization_id == query_data.organization_id
-        ).all()
-        
-        if not papers:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="No papers found in organization. Please upload some papers first."
-            )
-        
-        docs, _ = await get_cached_documents(org_id_str, db)
-    else:
-        print(f"Using cached documents for organization {org_id_str}")
-    
-    docs = org_docs[org_id_str]
-    
-    # Ensure pinecone_context is properly defined for the nested function
-    final_pinecone_context = pinecone_context
-    
-    async def stream_answers():
-        try:
-            print("Starting enhanced streaming query...")
-            start_time = datetime.utcnow()
-            
-            # Stream thinking indicators first
-            thinking_phrases = [
-                "Analyzing documents",
-                "Processing your question", 
-                "Searching through sources",
-                "Generating response"
-            ]
-            
-            for phrase in thinking_phrases:
-                yield f"data: {json.dumps({'answer': phrase, 'thinking': True})}\n\n"
-                await asyncio.sleep(0.8)  # Shorter thinking time
-            
-            # Now use PaperQA with better answer cleaning
-            try:
-                print("Running PaperQA query...")
-                answer = await docs.aquery(query_data.question)
-                
-                # Check if the answer indicates insufficient information
-                answer_lower = answer.formatted_answer.lower()
-                cannot_answer_patterns = [
-                    "i cannot answer",
-                    "i can't answer", 
-                    "cannot answer",
-                    "can't answer",
-                    "don't have enough information",
-                    "not enough information",
-                    "insufficient information",
-                    "no relevant information found"
-                ]
-                
-                has_insufficient_info = any(pattern in answer_lower for pattern in cannot_answer_patterns)
-                
-                if has_insufficient_info:
-                    # Return custom message for insufficient information
-                    custom_message = "I'm sorry, but I don't have enough information to answer your question. Could you please upload a document to your organization to provide some context?"
-                    yield f"data: {json.dumps({'answer': custom_message, 'thinking': False, 'insufficient_info': True})}\n\n"
-                    print("Detected insufficient information response, sent custom message")
-                    return
-                
-                # Clean the answer more aggressively to remove references and extra content
-                cleaned_answer = enhanced_question_cleaning(answer.formatted_answer, query_data.question)
-                
-                # Remove any remaining references section
-                references_patterns = [
-                    r'\n\s*References?\s*:?\s*\n.*',
-                    r'\n\s*Sources?\s*:?\s*\n.*',
-                    r'\n\s*Bibliography\s*:?\s*\n.*',
-                    r'\n\s*\d+\.\s*\([^)]+\):.*',
-                    r'\n\s*\[[^\]]+\].*'
-                ]
-                
-                for pattern in references_patterns:
-                    cleaned_answer = re.sub(pattern, '', cleaned_answer, flags=re.IGNORECASE | re.DOTALL)
-                
-                # Clean up extra whitespace
-                cleaned_answer = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned_answer)
-                cleaned_answer = cleaned_answer.strip()
-                
-                print(f"Answer cleaned, length: {len(cleaned_answer)} characters")
-                
-                # Stream the cleaned answer in smaller chunks for smoother experience
-                # Split by sentences to preserve formatting
-                sentences = re.split(r'(?<=[.!?])\s+', cleaned_answer)
-                chunk_size = max(1, len(sentences) // 20)  # 20 chunks for smooth streaming
-                
-                for i in range(0, len(sentences), chunk_size):
-                    chunk_sentences = sentences[i:i + chunk_size]
-                    chunk_text = ' '.join(chunk_sentences)
-                    yield f"data: {json.dumps({'answer': chunk_text, 'thinking': False})}\n\n"
-                    await asyncio.sleep(0.05)  # Slightly longer for sentence chunks
-                
-                print(f"Enhanced streaming completed in {(datetime.utcnow() - start_time).total_seconds():.2f}s")
-                
-            except Exception as e:
-                print(f"Error in PaperQA query: {e}")
-                yield f"data: {json.dumps({'error': f'Error generating response: {str(e)}'})}\n\n"
-                return
-            
-            # Build sources (only if we didn't return early due to insufficient info)
-            sources = []
-            enhanced_sources = []
-            
-            # Get paper information
-            papers = db.query(Paper).filter(
-                Paper.organization_id == query_data.organization_id
-            ).all()
-            
-            paper_map = {str(paper.id): paper for paper in papers}
-            
-            # Add Pinecone sources
-            if relevant_chunks:
-                print(f"Processing {len(relevant_chunks)} Pinecone chunks for sources")
-                for chunk in relevant_chunks[:5]:
-                    paper_id = chunk.get("paper_id", "")
-                    paper = paper_map.get(paper_id)
-                    
-                    if paper:
-                        filename = os.path.basename(str(paper.file_url))
-                        source_url = f"/papers/{query_data.organization_id}/file/{filename}"
-                        
-                        # Create citation
-                        author_year = ""
-                        if paper.title:
-                            author_match = re.search(r'^([^(]+?)\s*\((\d{4})\)', paper.title)
-                            if author_match:
-                                author = author_match.group(1).strip()
-                                year = author_match.group(2)
-                                author_year = f"{author} ({year})"
-                            else:
-                                author_year = paper.title.split()[0] if paper.title.split() else "Unknown"
-                        
-                        chunk_index = chunk.get("chunk_index", 0)
-                        citation = f"{author_year}, page {chunk_index + 1}" if author_year else f"{paper.title} (page {chunk_index + 1})"
-                        
-                        # Only add if not already present
-                        if source_url not in [s["url"] for s in sources]:
-                            sources.append({
-                                "url": source_url,
-                                "title": paper.title,
-                                "citation": citation
-                            })
-                            
-                            enhanced_sources.append({
-                                "url": source_url,
-                                "title": paper.title,
-                                "citation": citation,
-                                "paper_id": str(paper.id),
-                                "chunk_index": chunk_index,
-                                "relevance_score": chunk.get("score", 0.0)
-                            })
-            
-            # Send sources
-            if sources:
-                yield f"data: {json.dumps({'sources': sources})}\n\n"
-            
-            if enhanced_sources:
-                yield f"data: {json.dumps({'enhanced_sources': enhanced_sources})}\n\n"
-                
-        except Exception as e:
-            print(f"Error in streaming query: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    deadline = asyncio.get_running_loop().time() + QUERY_TIMEOUT_SECONDS
+    ticket = admit_query(query_data, deadline)
+    try:
+        docs, relevant_chunks = await prepare_query(query_data, current_user, db, deadline)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
     
     return StreamingResponse(
-        stream_answers(), 
+        stream_answer_events(query_data, docs, relevant_chunks, request, deadline, ticket),
         media_type="text/plain",
         headers={
             "Cache-Control": "no-cache",
@@ -613,26 +1073,27 @@ def estimate_tokens(text: str) -> int:
 @app.get("/papers/{organization_id}")
 async def list_papers(
     organization_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    access: OrgAccess = Depends(require_org_member()),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    """List all papers in an organization"""
-    
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
-    papers = db.query(Paper).filter(
-        Paper.organization_id == organization_id
-    ).all()
+    """List papers in an organization, optionally a page at a time (?cursor=&limit=)"""
+    
+    # Uploader emails come from the same query instead of one lazy load per paper
+    rows, next_cursor = await paginate(
+        db,
+        select(Paper, User.email).outerjoin(User, User.id == Paper.uploaded_by).where(
+            Paper.organization_id == uuid.UUID(access.organization_id)
+        ),
+        columns=(Paper.uploaded_at, Paper.id),
+        key=lambda row: (row[0].uploaded_at, row[0].id),
+        cursor=cursor,
+        limit=limit
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     
     return [
         {
@@ -640,60 +1101,119 @@ async def list_papers(
             "title": paper.title,
             "file_url": paper.file_url,
             "uploaded_at": paper.uploaded_at,
-            "uploaded_by": paper.uploaded_by_user.email if paper.uploaded_by_user else "Unknown"
+            "uploaded_by": uploader_email or "Unknown"
         }
-        for paper in papers
+        for paper, uploader_email in rows
     ]
 
 @app.get("/organizations", response_model=List[UserOrganization])
-async def get_user_organizations(current_user: User = Depends(get_current_user)):
-    """Get all organizations the user belongs to"""
-    organizations = await SupabaseAuth.get_user_organizations(str(current_user.id))
+async def get_user_organizations(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Get the organizations the user belongs to, optionally a page at a time"""
+    organizations, next_cursor = await SupabaseAuth.get_user_organizations(
+        str(current_user.id), cursor=cursor, limit=limit
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return organizations
 
+def org_name_filter(query: str):
+    """Case-insensitive substring match on organization names, served by an index"""
+    # The trigram tokenizer needs at least three characters
+    if ORG_SEARCH_USES_FTS and len(query) >= 3:
+        return text(
+            "organizations.rowid IN (SELECT rowid FROM organizations_fts WHERE organizations_fts MATCH :match)"
+        ).bindparams(match='"' + query.replace('"', '""') + '"')
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return Organization.name.ilike(f"%{escaped}%", escape="\\")
+
+def org_search_sort_key(needle: str):
+    """The ORDER BY of run_org_search as a Python sort key for lowercase query needle"""
+    return lambda org: (0 if org["name"].lower().startswith(needle) else 1, org["name"])
+
+async def run_org_search(db: AsyncSession, user_id, query: str) -> List[Dict[str, Any]]:
+    """Matching organizations with member counts and the caller's membership, in one query"""
+    own_membership = aliased(Membership)
+    
+    # Member counts come from the organization_stats row, one primary-key join per result
+    statement = select(
+        Organization, OrganizationStats.approved_member_count, own_membership.status
+    ).outerjoin(
+        OrganizationStats, OrganizationStats.organization_id == Organization.id
+    ).outerjoin(
+        own_membership,
+        and_(own_membership.organization_id == Organization.id, own_membership.user_id == user_id)
+    )
+    if query:
+        # Keep in step with org_search_sort_key, which reorders cached results the same way
+        statement = statement.where(org_name_filter(query)).order_by(
+            # Names starting with the query first, as typeahead users expect
+            case((func.lower(Organization.name).startswith(query.lower(), autoescape=True), 0), else_=1),
+            Organization.name
+        )
+    rows = (await db.execute(statement.limit(ORG_SEARCH_LIMIT))).all()
+    
+    return [
+        {
+            "id": str(org.id),
+            "name": org.name,
+            "created_at": org.created_at,
+            "member_count": count or 0,
+            "is_member": membership_status is not None,
+            "membership_status": membership_status
+        }
+        for org, count, membership_status in rows
+    ]
+
 @app.get("/organizations/search")
 async def search_organizations(
     query: str = "",
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Search for organizations by name"""
-    organizations = db.query(Organization).filter(
-        Organization.name.ilike(f"%{query}%")
-    ).limit(20).all()
-    
-    # Check if user is already a member of each organization
-    result = []
-    for org in organizations:
-        membership = db.query(Membership).filter(
-            Membership.user_id == current_user.id,
-            Membership.organization_id == org.id
-        ).first()
-        
-        result.append({
-            "id": str(org.id),
-            "name": org.name,
-            "created_at": org.created_at,
-            "member_count": db.query(Membership).filter(
-                Membership.organization_id == org.id,
-                Membership.status == MembershipStatus.APPROVED.value
-            ).count(),
-            "is_member": membership is not None,
-            "membership_status": membership.status if membership else None
-        })
-    
-    return result
+    query = query.strip()
+    user_key = str(current_user.id)
+    needle = query.lower()
+    
+    # A result set for a prefix of this query that the LIMIT did not cut short
+    # already contains every match; it only needs filtering and re-ranking
+    for length in range(len(needle), -1, -1):
+        cached = org_search_cache.get((user_key, needle[:length]))
+        if cached is None:
+            continue
+        if length == len(needle):
+            metrics.increment("org_search.cache.hit")
+            return list(cached)
+        if len(cached) < ORG_SEARCH_LIMIT:
+            metrics.increment("org_search.cache.prefix_hit")
+            result = sorted(
+                (org for org in cached if needle in org["name"].lower()),
+                key=org_search_sort_key(needle)
+            )
+            org_search_cache.set((user_key, needle), result)
+            return list(result)
+        break
+    
+    metrics.increment("org_search.cache.miss")
+    result = await run_org_search(db, current_user.id, query)
+    org_search_cache.set((user_key, needle), result)
+    return list(result)
 
 @app.post("/organizations/{organization_id}/join")
 async def join_organization(
     organization_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Request to join an organization"""
     
     # Check if organization exists
-    organization = db.query(Organization).filter(Organization.id == organization_id).first()
+    organization = await db.scalar(select(Organization).where(Organization.id == organization_id))
     if not organization:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -701,10 +1221,10 @@ async def join_organization(
         )
     
     # Check if user is already a member
-    existing_membership = db.query(Membership).filter(
+    existing_membership = await db.scalar(select(Membership).where(
         Membership.user_id == current_user.id,
         Membership.organization_id == organization_id
-    ).first()
+    ).limit(1))
     
     if existing_membership:
         status_value = existing_membership.status
@@ -722,7 +1242,10 @@ async def join_organization(
             # Update existing denied request to pending
             existing_membership.status = MembershipStatus.PENDING.value
             existing_membership.requested_at = datetime.utcnow()
-            db.commit()
+            await adjust_org_stats(db, organization_id, pending_count=1)
+            await db.commit()
+            invalidate_membership(current_user.id, organization_id)
+            org_search_cache.invalidate_where(lambda key: key[0] == str(current_user.id))
             return {"message": "Request to join organization submitted"}
     
     # Create new membership request
@@ -734,78 +1257,72 @@ async def join_organization(
         role_in_org=MembershipRole.MEMBER.value
     )
     db.add(membership)
-    db.commit()
+    await adjust_org_stats(db, organization_id, pending_count=1)
+    await db.commit()
+    invalidate_membership(current_user.id, organization_id)
+    org_search_cache.invalidate_where(lambda key: key[0] == str(current_user.id))
     
     return {"message": "Request to join organization submitted"}
 
 @app.get("/organizations/{organization_id}/members")
 async def get_organization_members(
     organization_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    access: OrgAccess = Depends(require_org_member(
+        MembershipRole.ORG_ADMIN.value,
+        "You must be an admin to view organization members"
+    )),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all members of an organization (admin only)"""
     
-    # Check if user is admin of the organization
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value,
-        Membership.role_in_org == MembershipRole.ORG_ADMIN.value
-    ).first()
-    
-    if membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You must be an admin to view organization members"
-        )
-    
-    memberships = db.query(Membership).filter(
-        Membership.organization_id == organization_id
-    ).all()
+    # Join users up front instead of lazily loading each member's user
+    rows, next_cursor = await paginate(
+        db,
+        select(Membership, User).join(User, User.id == Membership.user_id).where(
+            Membership.organization_id == uuid.UUID(access.organization_id)
+        ),
+        columns=(Membership.requested_at, Membership.id),
+        key=lambda row: (row[0].requested_at, row[0].id),
+        cursor=cursor,
+        limit=limit
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     
     return [
         {
-            "id": str(m.user.id),
-            "email": m.user.email,
-            "name": m.user.name,
+            "id": str(user.id),
+            "email": user.email,
+            "name": user.name,
             "role": m.role_in_org,
             "status": m.status,
             "requested_at": m.requested_at,
             "approved_at": m.approved_at
         }
-        for m in memberships
+        for m, user in rows
     ]
 
 @app.post("/organizations/{organization_id}/members/{user_id}/approve")
 async def approve_member(
     organization_id: str,
     user_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    access: OrgAccess = Depends(require_org_member(
+        MembershipRole.ORG_ADMIN.value,
+        "You must be an admin to approve members"
+    )),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Approve a membership request (admin only)"""
     
-    # Check if user is admin of the organization
-    admin_membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value,
-        Membership.role_in_org == MembershipRole.ORG_ADMIN.value
-    ).first()
-    
-    if admin_membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You must be an admin to approve members"
-        )
-    
     # Find the membership request
-    membership = db.query(Membership).filter(
+    membership = await db.scalar(select(Membership).where(
         Membership.user_id == user_id,
         Membership.organization_id == organization_id,
         Membership.status == MembershipStatus.PENDING.value
-    ).first()
+    ).limit(1))
     
     if not membership:
         raise HTTPException(
@@ -815,7 +1332,11 @@ async def approve_member(
     
     membership.status = MembershipStatus.APPROVED.value
     membership.approved_at = datetime.utcnow()
-    db.commit()
+    await adjust_org_stats(db, organization_id, pending_count=-1, approved_member_count=1)
+    await db.commit()
+    invalidate_membership(user_id, organization_id)
+    # Every cached search showing this organization has a stale member count
+    org_search_cache.invalidate_where(lambda key: True)
     
     return {"message": "Member approved successfully"}
 
@@ -823,31 +1344,20 @@ async def approve_member(
 async def deny_member(
     organization_id: str,
     user_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    access: OrgAccess = Depends(require_org_member(
+        MembershipRole.ORG_ADMIN.value,
+        "You must be an admin to deny members"
+    )),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Deny a membership request (admin only)"""
     
-    # Check if user is admin of the organization
-    admin_membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value,
-        Membership.role_in_org == MembershipRole.ORG_ADMIN.value
-    ).first()
-    
-    if not admin_membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You must be an admin to deny members"
-        )
-    
     # Find the membership request
-    membership = db.query(Membership).filter(
+    membership = await db.scalar(select(Membership).where(
         Membership.user_id == user_id,
         Membership.organization_id == organization_id,
         Membership.status == MembershipStatus.PENDING.value
-    ).first()
+    ).limit(1))
     
     if not membership:
         raise HTTPException(
@@ -856,7 +1366,11 @@ async def deny_member(
         )
     
     membership.status = MembershipStatus.DENIED.value
-    db.commit()
+    await adjust_org_stats(db, organization_id, pending_count=-1)
+    await db.commit()
+    invalidate_membership(user_id, organization_id)
+    # Only the requester's searches show their membership status
+    org_search_cache.invalidate_where(lambda key: key[0] == str(membership.user_id))
     
     return {"message": "Member denied successfully"}
 
@@ -881,15 +1395,139 @@ async def create_organization(
         user_id=str(current_user.id),
         organization_name=name
     )
+    # A new organization can match any cached search
+    org_search_cache.invalidate_where(lambda key: True)
     return organization
 
+async def find_paper_by_filename(db: AsyncSession, organization_id: str, filename: str, *options):
+    """Look a paper up by the filename clients use in file URLs (an index seek)"""
+    paper = await db.scalar(select(Paper).options(*options).where(
+        Paper.organization_id == organization_id,
+        Paper.filename == filename
+    ).limit(1))
+    if paper is None:
+        # Rows created before the filename column existed and not yet backfilled
+        paper = await db.scalar(select(Paper).options(*options).where(
+            Paper.organization_id == organization_id,
+            Paper.filename.is_(None),
+            Paper.file_url.like(f"%{filename}")
+        ).limit(1))
+    return paper
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check an If-None-Match header against a strong ETag (weak comparison, as RFC 9110 requires)"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single "bytes=" range into inclusive (start, end).
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges, which we answer with the full file) and raises ValueError when
+    the range cannot be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', range_header)
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    if end < start:
+        return None
+    return start, end
+
+def iter_pdf_file(pdf_file, start: int, end: int):
+    """Read bytes start..end (inclusive) of an open file, closing it when done"""
+    with pdf_file:
+        pdf_file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = pdf_file.read(min(PDF_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def pdf_file_response(request: Request, cached_pdf, pdf_file) -> Response:
+    """Serve a cached PDF with a content-hash ETag, conditional GET and single byte ranges.
+
+    pdf_file is the cached blob already opened by pdf_cache.open(); reading
+    from it rather than the path keeps eviction from breaking the response.
+    The response takes ownership of it.
+    """
+    etag = f'"{cached_pdf.digest}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"private, max-age={PDF_BROWSER_CACHE_SECONDS}"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        pdf_file.close()
+        metrics.increment("pdf.serve.not_modified")
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A stale If-Range means the client's partial copy is outdated; send the whole file
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, cached_pdf.size)
+        except ValueError:
+            pdf_file.close()
+            metrics.increment("pdf.serve.range_not_satisfiable")
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{cached_pdf.size}"}
+            )
+
+        if byte_range is not None:
+            start, end = byte_range
+            metrics.increment("pdf.serve.partial")
+            return StreamingResponse(
+                iter_pdf_file(pdf_file, start, end),
+                status_code=206,
+                media_type="application/pdf",
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{cached_pdf.size}",
+                    "Content-Length": str(end - start + 1)
+                }
+            )
+
+    metrics.increment("pdf.serve.full")
+    return StreamingResponse(
+        iter_pdf_file(pdf_file, 0, cached_pdf.size - 1),
+        media_type="application/pdf",
+        headers={**headers, "Content-Length": str(cached_pdf.size)}
+    )
+
+async def signed_pdf_url(file_path: str) -> str:
+    """Return a signed URL for a stored PDF, reusing one until shortly before it expires"""
+    signed_url = signed_url_cache.get(file_path)
+    if signed_url is None:
+        signed_url = await storage_service.aget_pdf_url(file_path, expires_in=PDF_SIGNED_URL_SECONDS)
+        signed_url_cache.set(file_path, signed_url)
+    return signed_url
+
 @app.get("/papers/{organization_id}/file/{filename}")
 async def get_paper_file(
     organization_id: str,
     filename: str,
     token: str | None = None,
     request: Request = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Serve a PDF file securely if the user is a member of the organization"""
     print(f"=== PDF Request Debug ===")
@@ -924,24 +1562,11 @@ async def get_paper_file(
             detail="Authentication required"
         )
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    print(f"Membership found: {'yes' if membership else 'no'}")
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
+    await ensure_org_member(db, current_user, organization_id)
     
     # Find the paper in the database
     # The file_url now contains the full Supabase path: org_{organization_id}/{uuid}_{filename}
-    paper = db.query(Paper).filter(
-        Paper.organization_id == organization_id,
-        Paper.file_url.like(f"%{filename}")
-    ).first()
+    paper = await find_paper_by_filename(db, organization_id, filename)
     print(f"Paper found: {'yes' if paper else 'no'}")
     if paper:
         print(f"Paper file_url: {paper.file_url}")
@@ -955,39 +1580,42 @@ async def get_paper_file(
         print("Storage service not available")
         raise HTTPException(status_code=500, detail="Storage service not available")
     
+    if PDF_SERVE_MODE == "redirect":
+        # Let the browser fetch the bytes from storage directly
+        try:
+            signed_url = await signed_pdf_url(str(paper.file_url))
+        except Exception as e:
+            print(f"Error generating signed URL: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to generate PDF URL: {e}")
+        metrics.increment("pdf.serve.redirect")
+        return RedirectResponse(
+            signed_url,
+            status_code=307,
+            headers={"Cache-Control": "private, no-store"}
+        )
+    
+    # Serve from the local disk cache, downloading from Supabase only on a miss
     try:
-        print(f"Attempting to download PDF from Supabase: {paper.file_url}")
-        pdf_content = storage_service.download_pdf(str(paper.file_url))
-        print(f"PDF content downloaded, size: {len(pdf_content) if pdf_content else 0} bytes")
-        
-        if not pdf_content:
-            print("PDF content is empty")
-            raise HTTPException(status_code=500, detail="PDF content is empty")
-            
+        print(f"Fetching PDF: {paper.file_url}")
+        cached_pdf, pdf_file = await pdf_cache.open(str(paper.file_url), storage_service.astream_pdf)
     except Exception as e:
         print(f"Error downloading PDF: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to download PDF: {e}")
     
     print("Returning PDF response")
     
-    return StreamingResponse(
-        iter([pdf_content]),
-        media_type="application/pdf",
-        headers={
-            "Cache-Control": "no-cache"
-        }
-    )
+    return pdf_file_response(request, cached_pdf, pdf_file)
 
 @app.delete("/papers/{paper_id}")
 async def delete_paper(
     paper_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a paper and its vectors from the system"""
     
     # Find the paper
-    paper = db.query(Paper).filter(Paper.id == paper_id).first()
+    paper = await db.scalar(select(Paper).where(Paper.id == paper_id))
     if not paper:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -995,136 +1623,94 @@ async def delete_paper(
         )
     
     # Check if user has permission (must be member of the organization)
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == paper.organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You don't have permission to delete this paper"
-        )
+    await ensure_org_member(
+        db, current_user, paper.organization_id,
+        detail="You don't have permission to delete this paper"
+    )
     
-    # Delete vectors from Pinecone
+    # Delete vectors from Pinecone; listing and batch deletes block, so they run in a worker thread
     if pinecone_service:
         try:
-            pinecone_service.delete_document_vectors(str(paper_id))
+            await asyncio.to_thread(pinecone_service.delete_document_vectors, str(paper_id))
         except Exception as e:
             print(f"Error deleting vectors from Pinecone: {e}")
     
     # Delete the file from Supabase Storage
     if storage_service:
         try:
-            storage_service.delete_pdf(str(paper.file_url))
+            await storage_service.adelete_pdf(str(paper.file_url))
         except Exception as e:
             print(f"Error deleting file from Supabase Storage: {e}")
     else:
         print("Storage service not available for file deletion")
     
     # Delete from database
-    db.delete(paper)
-    db.commit()
+    await db.delete(paper)
+    await adjust_org_stats(
+        db, paper.organization_id,
+        paper_count=-1,
+        total_bytes=-(paper.size_bytes or 0),
+        chunk_count=-(paper.chunk_count or 0)
+    )
+    await db.commit()
     
-    # Clear cached docs for this organization
-    org_id_str = str(paper.organization_id)
-    if org_id_str in org_docs:
-        del org_docs[org_id_str]
+    # Clear cached docs for this paper's organization and the cached file
+    document_cache.invalidate(str(paper.organization_id), "docs")
+    await asyncio.to_thread(pdf_cache.invalidate, str(paper.file_url))
+    signed_url_cache.invalidate(str(paper.file_url))
     
     return {"message": "Paper deleted successfully"}
 
 @app.get("/papers/{organization_id}/stats")
 async def get_paper_stats(
     organization_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    access: OrgAccess = Depends(require_org_member()),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Get statistics about papers in an organization"""
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
-    # Get basic stats from database
-    total_papers = db.query(Paper).filter(
-        Paper.organization_id == organization_id
-    ).count()
-    
-    # Get vector stats from Pinecone
-    vector_stats = {}
-    if pinecone_service:
-        try:
-            vector_stats = pinecone_service.get_document_stats(str(organization_id))
-        except Exception as e:
-            print(f"Error getting vector stats: {e}")
+    # One counter row instead of counting papers and asking Pinecone for index-wide stats
+    stats = await get_org_stats(db, organization_id)
     
     return {
-        "total_papers": total_papers,
-        "vector_stats": vector_stats
+        "total_papers": stats["paper_count"],
+        "total_bytes": stats["total_bytes"],
+        "member_count": stats["approved_member_count"],
+        "pending_count": stats["pending_count"],
+        "vector_stats": {
+            "organization_id": str(organization_id),
+            "chunk_count": stats["chunk_count"]
+        }
     }
 
 @app.get("/organizations/{organization_id}/user-role")
 async def get_user_role_in_organization(
     organization_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    access: OrgAccess = Depends(require_org_member()),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Get the current user's role in the specified organization"""
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
     return {
-        "user_id": str(current_user.id),
+        "user_id": str(access.user.id),
         "organization_id": str(organization_id),
-        "role": membership.role_in_org,
-        "status": membership.status
+        "role": access.role,
+        "status": MembershipStatus.APPROVED.value
     }
 
 @app.get("/papers/{organization_id}/sources/{filename}/info")
 async def get_source_info(
     organization_id: str,
     filename: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    access: OrgAccess = Depends(require_org_member()),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Get detailed information about a source file including citation details"""
     
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
     # Find the paper in the database - handle both regular and temporary filenames
-    paper = db.query(Paper).filter(
-        Paper.organization_id == organization_id,
-        Paper.file_url.like(f"%{filename}")
-    ).first()
+    # Load the uploader with the paper; async sessions cannot lazy-load it later
+    uploader = joinedload(Paper.uploaded_by_user)
+    paper = await find_paper_by_filename(db, organization_id, filename, uploader)
     
     # If not found, try to find by paper ID (for temporary filenames)
     if not paper and filename.startswith('tmp'):
@@ -1132,10 +1718,10 @@ async def get_source_info(
         # Format: tmp{paper_id}.pdf
         try:
             paper_id = filename.replace('tmp', '').replace('.pdf', '')
-            paper = db.query(Paper).filter(
+            paper = await db.scalar(select(Paper).options(uploader).where(
                 Paper.organization_id == organization_id,
-                Paper.id == paper_id
-            ).first()
+                Paper.id == uuid.UUID(paper_id)
+            ))
         except:
             pass
     
@@ -1147,7 +1733,8 @@ async def get_source_info(
     if pinecone_service:
         try:
             # Get chunks for this paper
-            chunks = pinecone_service.search_similar_chunks(
+            chunks = await asyncio.to_thread(
+                pinecone_service.search_similar_chunks,
                 query="",  # Empty query to get all chunks
                 organization_id=str(organization_id),
                 top_k=1000  # Get all chunks
@@ -1184,217 +1771,25 @@ async def get_source_info(
 @app.post("/streaming-query")
 async def streaming_query(
     query_data: QueryRequest,
+    request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Streaming query endpoint for real-time responses"""
     
     print(f"=== Starting streaming query for: {query_data.question[:50]}... ===")
-    overall_start = datetime.utcnow()
-    
-    membership = db.query(Membership).filter(
-        Membership.user_id == current_user.id,
-        Membership.organization_id == query_data.organization_id,
-        Membership.status == MembershipStatus.APPROVED.value
-    ).first()
-    
-    if membership is None:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this organization"
-        )
-    
-    # Step 1: Use Pinecone for fast semantic search
-    print("Step 1: Pinecone search...")
-    pinecone_start = datetime.utcnow()
-    relevant_chunks = []
-    if pinecone_service:
-        try:
-            relevant_chunks = pinecone_service.search_similar_chunks(
-                query=query_data.question,
-                organization_id=str(query_data.organization_id),
-                top_k=8
-            )
-            print(f"Found {len(relevant_chunks)} relevant chunks from Pinecone in {(datetime.utcnow() - pinecone_start).total_seconds():.2f}s")
-        except Exception as e:
-            print(f"Error in Pinecone search: {e}")
-    else:
-        print("Pinecone service not available")
-    
-    # Step 2: Load documents for PaperQA
-    print("Step 2: Document loading...")
-    doc_start = datetime.utcnow()
-    org_id_str = str(query_data.organization_id)
-    if org_id_str not in org_docs:
-        print(f"Loading documents for organization {org_id_str}...")
-        papers = db.query(Paper).filter(
-            Paper.organization_id == query_data.organization_id
-        ).all()
-        
-        if not papers:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="No papers found in organization. Please upload some papers first."
-            )
-        
-        docs, _ = await get_cached_documents(org_id_str, db)
-        print(f"Document loading completed in {(datetime.utcnow() - doc_start).total_seconds():.2f}s")
-    else:
-        print(f"Using cached documents for organization {org_id_str}")
-        docs = org_docs[org_id_str]
-    
-    print(f"Total setup time: {(datetime.utcnow() - overall_start).total_seconds():.2f}s")
-    print("Step 3: Starting PaperQA processing...")
-    
-    async def stream_answers():
-        try:
-            print("Starting enhanced streaming query...")
-            start_time = datetime.utcnow()
-            
-            # Stream thinking indicators first
-            thinking_phrases = [
-                "Analyzing documents",
-                "Processing your question", 
-                "Searching through sources",
-                "Generating response"
-            ]
-            
-            for phrase in thinking_phrases:
-                yield f"data: {json.dumps({'answer': phrase, 'thinking': True})}\n\n"
-                await asyncio.sleep(0.8)  # Shorter thinking time
-            
-            # Now use PaperQA with better answer cleaning
-            try:
-                print("Running PaperQA query...")
-                answer = await docs.aquery(query_data.question)
-                
-                # Check if the answer indicates insufficient information
-                answer_lower = answer.formatted_answer.lower()
-                cannot_answer_patterns = [
-                    "i cannot answer",
-                    "i can't answer", 
-                    "cannot answer",
-                    "can't answer",
-                    "don't have enough information",
-                    "not enough information",
-                    "insufficient information",
-                    "no relevant information found"
-                ]
-                
-                has_insufficient_info = any(pattern in answer_lower for pattern in cannot_answer_patterns)
-                
-                if has_insufficient_info:
-                    # Return custom message for insufficient information
-                    custom_message = "I'm sorry, but I don't have enough information to answer your question. Could you please upload a document to your organization to provide some context?"
-                    yield f"data: {json.dumps({'answer': custom_message, 'thinking': False, 'insufficient_info': True})}\n\n"
-                    print("Detected insufficient information response, sent custom message")
-                    return
-                
-                # Clean the answer more aggressively to remove references and extra content
-                cleaned_answer = enhanced_question_cleaning(answer.formatted_answer, query_data.question)
-                
-                # Remove any remaining references section
-                references_patterns = [
-                    r'\n\s*References?\s*:?\s*\n.*',
-                    r'\n\s*Sources?\s*:?\s*\n.*',
-                    r'\n\s*Bibliography\s*:?\s*\n.*',
-                    r'\n\s*\d+\.\s*\([^)]+\):.*',
-                    r'\n\s*\[[^\]]+\].*'
-                ]
-                
-                for pattern in references_patterns:
-                    cleaned_answer = re.sub(pattern, '', cleaned_answer, flags=re.IGNORECASE | re.DOTALL)
-                
-                # Clean up extra whitespace
-                cleaned_answer = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned_answer)
-                cleaned_answer = cleaned_answer.strip()
-                
-                print(f"Answer cleaned, length: {len(cleaned_answer)} characters")
-                
-                # Stream the cleaned answer in smaller chunks for smoother experience
-                # Split by sentences to preserve formatting
-                sentences = re.split(r'(?<=[.!?])\s+', cleaned_answer)
-                chunk_size = max(1, len(sentences) // 20)  # 20 chunks for smooth streaming
-                
-                for i in range(0, len(sentences), chunk_size):
-                    chunk_sentences = sentences[i:i + chunk_size]
-                    chunk_text = ' '.join(chunk_sentences)
-                    yield f"data: {json.dumps({'answer': chunk_text, 'thinking': False})}\n\n"
-                    await asyncio.sleep(0.05)  # Slightly longer for sentence chunks
-                
-                print(f"Enhanced streaming completed in {(datetime.utcnow() - start_time).total_seconds():.2f}s")
-                
-            except Exception as e:
-                print(f"Error in PaperQA query: {e}")
-                yield f"data: {json.dumps({'error': f'Error generating response: {str(e)}'})}\n\n"
-                return
-            
-            # Build sources (only if we didn't return early due to insufficient info)
-            sources = []
-            enhanced_sources = []
-            
-            # Get paper information
-            papers = db.query(Paper).filter(
-                Paper.organization_id == query_data.organization_id
-            ).all()
-            
-            paper_map = {str(paper.id): paper for paper in papers}
-            
-            # Add Pinecone sources
-            if relevant_chunks:
-                print(f"Processing {len(relevant_chunks)} Pinecone chunks for sources")
-                for chunk in relevant_chunks[:5]:
-                    paper_id = chunk.get("paper_id", "")
-                    paper = paper_map.get(paper_id)
-                    
-                    if paper:
-                        filename = os.path.basename(str(paper.file_url))
-                        source_url = f"/papers/{query_data.organization_id}/file/{filename}"
-                        
-                        # Create citation
-                        author_year = ""
-                        if paper.title:
-                            author_match = re.search(r'^([^(]+?)\s*\((\d{4})\)', paper.title)
-                            if author_match:
-                                author = author_match.group(1).strip()
-                                year = author_match.group(2)
-                                author_year = f"{author} ({year})"
-                            else:
-                                author_year = paper.title.split()[0] if paper.title.split() else "Unknown"
-                        
-                        chunk_index = chunk.get("chunk_index", 0)
-                        citation = f"{author_year}, page {chunk_index + 1}" if author_year else f"{paper.title} (page {chunk_index + 1})"
-                        
-                        # Only add if not already present
-                        if source_url not in [s["url"] for s in sources]:
-                            sources.append({
-                                "url": source_url,
-                                "title": paper.title,
-                                "citation": citation
-                            })
-                            
-                            enhanced_sources.append({
-                                "url": source_url,
-                                "title": paper.title,
-                                "citation": citation,
-                                "paper_id": str(paper.id),
-                                "chunk_index": chunk_index,
-                                "relevance_score": chunk.get("score", 0.0)
-                            })
-            
-            # Send sources
-            if sources:
-                yield f"data: {json.dumps({'sources': sources})}\n\n"
-            
-            if enhanced_sources:
-                yield f"data: {json.dumps({'enhanced_sources': enhanced_sources})}\n\n"
-                
-        except Exception as e:
-            print(f"Error in streaming query: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    deadline = asyncio.get_running_loop().time() + QUERY_TIMEOUT_SECONDS
+    ticket = admit_query(query_data, deadline)
+    try:
+        docs, relevant_chunks = await prepare_query(query_data, current_user, db, deadline)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+    print("Starting PaperQA processing...")
     
     return StreamingResponse(
-        stream_answers(),
+        stream_answer_events(query_data, docs, relevant_chunks, request, deadline, ticket),
         media_type="text/plain",
         headers={
             "Cache-Control": "no-cache",
@@ -1403,3 +1798,38 @@ async def streaming_query(
         }
     )
 
+@app.get("/admin/cache")
+async def get_cache_stats(current_user: User = Depends(get_current_user)):
+    """Inspect the in-memory document cache (platform admin only)"""
+    if current_user.role != UserRole.ADMIN.value:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You must be an admin to view cache statistics"
+        )
+    
+    stats = document_cache.stats()
+    stats["pdf_disk_cache"] = pdf_cache.stats()
+    stats["signed_url_cache"] = signed_url_cache.stats()
+    stats["membership_cache"] = membership_cache.stats()
+    stats["user_cache"] = user_cache.stats()
+    stats["single_flight"] = {
+        "corpus": corpus_flight.stats(),
+        "answer": answer_flight.stats()
+    }
+    return stats
+
+@app.get("/admin/metrics")
+async def get_metrics(current_user: User = Depends(get_current_user)):
+    """Request-path counters and timings (platform admin only)"""
+    if current_user.role != UserRole.ADMIN.value:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You must be an admin to view metrics"
+        )
+    
+    snapshot = metrics.snapshot()
+    snapshot["query_scheduler"] = query_scheduler.stats()
+    snapshot["openai_governor"] = openai_governor.stats()
+    snapshot["embedding_governor"] = embedding_governor.stats()
+    snapshot["sql"] = sql_metrics.stats()
+    return snapshot
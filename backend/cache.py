@@ -0,0 +1,295 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+# Stop walking very large object graphs after this many objects; the
+# rest of the graph is then extrapolated from the objects seen so far.
+MAX_SIZED_OBJECTS = 200_000
+
+
+def approximate_size(obj: Any, max_objects: int = MAX_SIZED_OBJECTS) -> int:
+    """Estimate the memory held by an object graph in bytes.
+
+    A walk cut off at max_objects charges every object still queued at the
+    average size seen so far. Queued objects can have children of their own,
+    so a truncated estimate is still a lower bound.
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    visited = 0
+
+    while stack and visited < max_objects:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        visited += 1
+
+        # Buffers are dominated by their payload
+        if isinstance(current, (bytes, bytearray)):
+            total += sys.getsizeof(current)
+            continue
+        if isinstance(current, memoryview):
+            total += current.nbytes
+            continue
+        if isinstance(current, (str, int, float, bool, type(None))):
+            total += sys.getsizeof(current)
+            continue
+
+        # numpy arrays and similar expose their buffer size directly
+        nbytes = getattr(current, "nbytes", None)
+        if isinstance(nbytes, int):
+            total += nbytes
+            continue
+
+        try:
+            total += sys.getsizeof(current)
+        except TypeError:
+            continue
+
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        else:
+            attrs = getattr(current, "__dict__", None)
+            if isinstance(attrs, dict):
+                stack.append(attrs)
+            for slot in getattr(type(current), "__slots__", ()):
+                if isinstance(slot, str) and hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+
+    if stack and visited:
+        pending = len({id(item) for item in stack} - seen)
+        total += total * pending // visited
+    return total
+
+
+class _CacheEntry:
+    __slots__ = ("org_id", "key", "value", "size", "created_at", "last_access", "hits")
+
+    def __init__(self, org_id: str, key: str, value: Any, size: int):
+        now = time.monotonic()
+        self.org_id = org_id
+        self.key = key
+        self.value = value
+        self.size = size
+        self.created_at = now
+        self.last_access = now
+        self.hits = 0
+
+
+class MemoryBoundedCache:
+    """LRU cache keyed by (organization, key) with global and per-org byte budgets"""
+
+    def __init__(self, max_bytes: int, per_org_max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.per_org_max_bytes = per_org_max_bytes
+        self.ttl = ttl
+
+        self._entries: "OrderedDict[Tuple[str, str], _CacheEntry]" = OrderedDict()
+        self._org_bytes: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+
+        # Hit/miss counters per key kind ("docs", ...)
+        self._hits: Dict[str, int] = {}
+        self._misses: Dict[str, int] = {}
+        self._evictions = 0
+        self._rejections = 0
+
+    @staticmethod
+    def _kind(key: str) -> str:
+        return key.split(":", 1)[0]
+
+    def _is_expired(self, entry: _CacheEntry, now: float) -> bool:
+        return self.ttl is not None and now - entry.created_at >= self.ttl
+
+    def _remove(self, cache_key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(cache_key)
+        self._total_bytes -= entry.size
+        remaining = self._org_bytes.get(entry.org_id, 0) - entry.size
+        if remaining > 0:
+            self._org_bytes[entry.org_id] = remaining
+        else:
+            self._org_bytes.pop(entry.org_id, None)
+
+    def get(self, org_id: str, key: str) -> Optional[Any]:
+        """Return a cached value and mark it as recently used, or None"""
+        cache_key = (str(org_id), key)
+        kind = self._kind(key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            now = time.monotonic()
+            if entry is None or self._is_expired(entry, now):
+                if entry is not None:
+                    self._remove(cache_key)
+                self._misses[kind] = self._misses.get(kind, 0) + 1
+                return None
+
+            self._entries.move_to_end(cache_key)
+            entry.last_access = now
+            entry.hits += 1
+            self._hits[kind] = self._hits.get(kind, 0) + 1
+            return entry.value
+
+    def set(self, org_id: str, key: str, value: Any, size: Optional[int] = None) -> bool:
+        """Cache a value, evicting least recently used entries to stay within budget.
+
+        Returns False when the value alone exceeds the budget and was not cached.
+        """
+        org_id = str(org_id)
+        cache_key = (org_id, key)
+        if size is None:
+            size = approximate_size(value)
+
+        with self._lock:
+            if cache_key in self._entries:
+                self._remove(cache_key)
+
+            if size > self.per_org_max_bytes or size > self.max_bytes:
+                self._rejections += 1
+                print(f"Not caching {key} for organization {org_id}: {size} bytes exceeds budget")
+                return False
+
+            # Enforce the per-org quota first so one tenant only evicts its own entries
+            if self._org_bytes.get(org_id, 0) + size > self.per_org_max_bytes:
+                for other_key in [k for k in self._entries if k[0] == org_id]:
+                    if self._org_bytes.get(org_id, 0) + size <= self.per_org_max_bytes:
+                        break
+                    self._remove(other_key)
+                    self._evictions += 1
+
+            while self._entries and self._total_bytes + size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._evictions += 1
+
+            self._entries[cache_key] = _CacheEntry(org_id, key, value, size)
+            self._total_bytes += size
+            self._org_bytes[org_id] = self._org_bytes.get(org_id, 0) + size
+            return True
+
+    def invalidate(self, org_id: str, key: Optional[str] = None) -> int:
+        """Drop one key, or every entry of an organization when key is None"""
+        org_id = str(org_id)
+        with self._lock:
+            if key is not None:
+                if (org_id, key) in self._entries:
+                    self._remove((org_id, key))
+                    return 1
+                return 0
+
+            org_keys = [k for k in self._entries if k[0] == org_id]
+            for cache_key in org_keys:
+                self._remove(cache_key)
+            return len(org_keys)
+
+    def __contains__(self, cache_key: Hashable) -> bool:
+        org_id, key = cache_key
+        with self._lock:
+            entry = self._entries.get((str(org_id), key))
+            return entry is not None and not self._is_expired(entry, time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of budgets, usage, hit rates and per-entry details"""
+        with self._lock:
+            now = time.monotonic()
+            kinds = set(self._hits) | set(self._misses)
+            hit_rates = {}
+            for kind in sorted(kinds):
+                hits = self._hits.get(kind, 0)
+                misses = self._misses.get(kind, 0)
+                hit_rates[kind] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+                }
+
+            return {
+                "max_bytes": self.max_bytes,
+                "per_org_max_bytes": self.per_org_max_bytes,
+                "ttl_seconds": self.ttl,
+                "total_bytes": self._total_bytes,
+                "entry_count": len(self._entries),
+                "evictions": self._evictions,
+                "rejections": self._rejections,
+                "hit_rates": hit_rates,
+                "organizations": dict(self._org_bytes),
+                # Most recently used first
+                "entries": [
+                    {
+                        "organization_id": entry.org_id,
+                        "key": entry.key,
+                        "size_bytes": entry.size,
+                        "age_seconds": round(now - entry.created_at, 1),
+                        "idle_seconds": round(now - entry.last_access, 1),
+                        "hits": entry.hits
+                    }
+                    for entry in reversed(self._entries.values())
+                ]
+            }
+
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return a live value and mark it as recently used, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Cache a value for ttl seconds (the cache default when None)"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drop every entry whose key matches predicate"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entry_count": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+import bisect
+import json
+import os
+import sys
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+from sqlalchemy import delete, select, update
+from database import SessionLocal, Paper, storage_filename
+from pinecone_service import PineconeService
+from rate_limit import RateLimiter
+from repair_org_stats import OrganizationStatsRepair
+from supabase_storage import SupabaseStorageService, STORAGE_DELETE_BATCH_SIZE
+from sync_databases import DB_DELETE_BATCH_SIZE, DB_FETCH_SIZE, SyncAborted
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHECKPOINT_PATH = ".consistency_checkpoint.json"
+REPORT_PATH = "consistency_report.json"
+# Objects are uploaded before their paper row is committed, so incremental
+# runs look this much further back in the bucket than in the papers table
+UPLOAD_SLACK = timedelta(hours=1)
+# Rows looked up per query when matching objects and vectors to papers
+LOOKUP_BATCH_SIZE = 500
+
+ISSUE_TYPES = ("papers_missing_vectors", "papers_missing_object", "orphan_vectors", "orphan_objects")
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+class PaperRecord(NamedTuple):
+    id: str
+    organization_id: str
+    title: str
+    file_url: Optional[str]
+    uploaded_at: Optional[datetime]
+
+    def to_report(self) -> Dict[str, Any]:
+        return {
+            "paper_id": self.id,
+            "organization_id": self.organization_id,
+            "title": self.title,
+            "file_url": self.file_url,
+            "uploaded_at": _isoformat(self.uploaded_at)
+        }
+
+class ConsistencyChecker:
+    """Cross-check papers against their vectors in Pinecone and their PDFs in storage.
+
+    Full runs list all three stores. Incremental runs only look at papers and
+    objects created since the checkpoint's watermark, which keeps nightly runs
+    short; orphaned vectors can only be found by listing the whole index, so
+    they are left to full runs, which happen at least every full_every.
+    Anything younger than min_age may still be uploading and is skipped until
+    the next run.
+    """
+
+    def __init__(self, workers: int = 8, repair_rate: float = 600, checkpoint_path: str = CHECKPOINT_PATH):
+        self.pinecone_service = PineconeService()
+        self.storage_service = SupabaseStorageService()
+        self.db = SessionLocal()
+        self.workers = workers
+        self.limiter = RateLimiter(repair_rate)
+        self.checkpoint_path = checkpoint_path
+
+    def load_checkpoint(self) -> Dict[str, Optional[datetime]]:
+        try:
+            with open(self.checkpoint_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        return {
+            key: datetime.fromisoformat(data[key]) if data.get(key) else None
+            for key in ("watermark", "last_full_run")
+        }
+
+    def save_checkpoint(self, watermark: datetime, last_full_run: Optional[datetime]) -> None:
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"watermark": _isoformat(watermark), "last_full_run": _isoformat(last_full_run)}, f)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def iter_papers(
+        self,
+        uploaded_after: Optional[datetime] = None,
+        uploaded_before: Optional[datetime] = None
+    ) -> Iterator[PaperRecord]:
+        statement = select(
+            Paper.id, Paper.organization_id, Paper.title, Paper.file_url, Paper.uploaded_at
+        ).execution_options(yield_per=DB_FETCH_SIZE)
+        if uploaded_after is not None:
+            statement = statement.where(Paper.uploaded_at >= uploaded_after)
+        if uploaded_before is not None:
+            statement = statement.where(Paper.uploaded_at < uploaded_before)
+        for paper_id, organization_id, title, file_url, uploaded_at in self.db.execute(statement):
+            yield PaperRecord(str(paper_id), str(organization_id), title, file_url, uploaded_at)
+
+    def _folder_objects(self, organization_id: str, created_after: Optional[datetime]) -> List[dict]:
+        return list(self.storage_service.iter_organization_pdfs(organization_id, created_after=created_after))
+
+    def list_storage_objects(self, created_after: Optional[datetime] = None) -> Dict[str, dict]:
+        """Stored PDFs by path, listing organization folders in parallel"""
+        folders = self.storage_service.list_organization_folders()
+        objects: Dict[str, dict] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for folder_objects in executor.map(lambda org_id: self._folder_objects(org_id, created_after), folders):
+                for stored in folder_objects:
+                    objects[stored["path"]] = stored
+        return objects
+
+    def existing_file_urls(self, paths: Iterable[str]) -> Set[str]:
+        """Which storage paths a paper points at, looked up through the (organization_id, filename) index"""
+        names_by_org: Dict[uuid.UUID, List[str]] = defaultdict(list)
+        for path in paths:
+            try:
+                organization_id = uuid.UUID(path.split("/", 1)[0][len("org_"):])
+            except ValueError:
+                # Not an organization folder, so no paper can point at it
+                continue
+            names_by_org[organization_id].append(storage_filename(path))
+
+        existing: Set[str] = set()
+        for organization_id, names in names_by_org.items():
+            for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+                existing.update(self.db.scalars(
+                    select(Paper.file_url).where(
+                        Paper.organization_id == organization_id,
+                        Paper.filename.in_(names[start:start + LOOKUP_BATCH_SIZE])
+                    )
+                ))
+        return existing
+
+    def existing_paper_ids(self, paper_ids: Iterable[str]) -> Set[str]:
+        ids = []
+        for paper_id in paper_ids:
+            try:
+                ids.append(uuid.UUID(paper_id))
+            except ValueError:
+                continue
+        existing: Set[str] = set()
+        for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            existing.update(
+                str(paper_id)
+                for paper_id in self.db.scalars(select(Paper.id).where(Paper.id.in_(ids[start:start + LOOKUP_BATCH_SIZE])))
+            )
+        return existing
+
+    def _confirm_missing_objects(self, papers: List[PaperRecord]) -> Tuple[List[PaperRecord], List[PaperRecord]]:
+        """Split papers not seen in a listing into (missing, stored) by checking each object directly.
+
+        Listings page by offset and can skip objects while the bucket changes,
+        and a paper without its PDF gets deleted, so absence is never taken
+        from the listing alone.
+        """
+        def exists(paper: PaperRecord) -> bool:
+            return bool(paper.file_url) and self.storage_service.pdf_exists(paper.file_url)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            found = list(executor.map(exists, papers))
+        return (
+            [paper for paper, stored in zip(papers, found) if not stored],
+            [paper for paper, stored in zip(papers, found) if stored]
+        )
+
+    def check_full(self, cutoff: datetime) -> Tuple[Dict[str, list], Dict[str, int]]:
+        # List both stores before reading papers: uploads store the PDF, commit
+        # the row, then store vectors, so every listed vector's paper is visible
+        print("Listing Pinecone and storage...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vectors_future = executor.submit(self.pinecone_service.list_paper_ids, self.workers)
+            objects_future = executor.submit(self.list_storage_objects)
+            vector_ids = sorted(vectors_future.result())
+            objects = objects_future.result()
+        print(f"Found {len(vector_ids)} papers in Pinecone and {len(objects)} PDFs in storage")
+
+        counts = {"papers": 0, "vector_papers": len(vector_ids), "objects": len(objects)}
+        indexed = bytearray(len(vector_ids))
+        missing_vectors: List[PaperRecord] = []
+        unstored: List[PaperRecord] = []
+        unindexed: Set[str] = set()
+        for paper in self.iter_papers():
+            counts["papers"] += 1
+            position = bisect.bisect_left(vector_ids, paper.id)
+            has_vectors = position < len(vector_ids) and vector_ids[position] == paper.id
+            if has_vectors:
+                indexed[position] = 1
+            # Whatever is left in objects afterwards has no paper
+            stored = objects.pop(paper.file_url, None) is not None
+            if paper.uploaded_at is not None and paper.uploaded_at >= cutoff:
+                continue
+            if not stored:
+                unstored.append(paper)
+                if not has_vectors:
+                    unindexed.add(paper.id)
+            elif not has_vectors:
+                missing_vectors.append(paper)
+        print(f"Found {counts['papers']} papers in Supabase")
+
+        missing_object, stored_papers = self._confirm_missing_objects(unstored)
+        missing_vectors.extend(paper for paper in stored_papers if paper.id in unindexed)
+
+        issues = {
+            "papers_missing_vectors": missing_vectors,
+            "papers_missing_object": missing_object,
+            "orphan_vectors": [paper_id for paper_id, seen in zip(vector_ids, indexed) if not seen],
+            "orphan_objects": [
+                stored for stored in objects.values()
+                if stored["created_at"] is None or stored["created_at"] < cutoff
+            ]
+        }
+        return issues, counts
+
+    def check_incremental(self, since: datetime, cutoff: datetime) -> Tuple[Dict[str, list], Dict[str, int]]:
+        papers = list(self.iter_papers(uploaded_after=since, uploaded_before=cutoff))
+        print(f"Checking {len(papers)} papers uploaded since {since.isoformat()}")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            objects_future = executor.submit(self.list_storage_objects, since - UPLOAD_SLACK)
+            indexed = list(executor.map(lambda paper: self.pinecone_service.has_vectors(paper.id), papers))
+            objects = objects_future.result()
+        print(f"Found {len(objects)} PDFs stored since {(since - UPLOAD_SLACK).isoformat()}")
+
+        counts = {"papers": len(papers), "vector_papers": sum(indexed), "objects": len(objects)}
+        missing_vectors: List[PaperRecord] = []
+        unstored: List[PaperRecord] = []
+        unindexed: Set[str] = set()
+        for paper, has_vectors in zip(papers, indexed):
+            if paper.file_url not in objects:
+                unstored.append(paper)
+                if not has_vectors:
+                    unindexed.add(paper.id)
+            elif not has_vectors:
+                missing_vectors.append(paper)
+
+        missing_object, stored_papers = self._confirm_missing_objects(unstored)
+        missing_vectors.extend(paper for paper in stored_papers if paper.id in unindexed)
+
+        candidates = [
+            stored for stored in objects.values()
+            if stored["created_at"] is None or stored["created_at"] < cutoff
+        ]
+        claimed = self.existing_file_urls(stored["path"] for stored in candidates)
+
+        issues = {
+            "papers_missing_vectors": missing_vectors,
+            "papers_missing_object": missing_object,
+            "orphan_vectors": [],
+            "orphan_objects": [stored for stored in candidates if stored["path"] not in claimed]
+        }
+        return issues, counts
+
+    def _run_limited(self, fn: Callable[[Any], Any], items: List[Any], describe: Callable[[Any], str]) -> Tuple[List[Any], List[str]]:
+        """Apply fn to items in parallel at the repair rate, collecting failures instead of raising"""
+        def attempt(item):
+            self.limiter.acquire()
+            try:
+                return True, fn(item)
+            except Exception as e:
+                return False, f"{describe(item)}: {e}"
+
+        results: List[Any] = []
+        errors: List[str] = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for succeeded, value in executor.map(attempt, items):
+                (results if succeeded else errors).append(value)
+        for error in errors:
+            print(f"    Error: {error}")
+        return results, errors
+
+    def _reindex(self, paper: PaperRecord) -> Tuple[str, int]:
+        content = self.storage_service.download_pdf(paper.file_url)
+        # Stored names are "<uuid>_<original name>"
+        filename = storage_filename(paper.file_url).split("_", 1)[-1]
+        chunk_count = self.pinecone_service.store_document_vectors(
+            organization_id=paper.organization_id,
+            paper_id=paper.id,
+            file_path=content,
+            title=paper.title,
+            filename=filename
+        )
+        if not chunk_count:
+            raise Exception("no vectors were stored")
+        return paper.id, chunk_count
+
+    def _delete_unstored_paper_vectors(self, paper: PaperRecord) -> str:
+        self.pinecone_service.delete_paper_vectors(paper.id)
+        return paper.id
+
+    def repair(self, issues: Dict[str, list]) -> Dict[str, Dict[str, Any]]:
+        repairs: Dict[str, Dict[str, Any]] = {}
+
+        # Re-check orphans right before deleting: a paper may have been committed since the listing
+        claimed = self.existing_file_urls(stored["path"] for stored in issues["orphan_objects"])
+        paths = [stored["path"] for stored in issues["orphan_objects"] if stored["path"] not in claimed]
+        batches = [paths[start:start + STORAGE_DELETE_BATCH_SIZE] for start in range(0, len(paths), STORAGE_DELETE_BATCH_SIZE)]
+        print(f"  Deleting {len(paths)} orphaned PDFs from storage")
+        deleted, errors = self._run_limited(self.storage_service.delete_pdfs, batches, lambda batch: f"batch starting {batch[0]}")
+        repairs["orphan_objects"] = {"deleted": sum(deleted), "skipped": len(claimed), "errors": errors}
+
+        existing = self.existing_paper_ids(issues["orphan_vectors"])
+        paper_ids = [paper_id for paper_id in issues["orphan_vectors"] if paper_id not in existing]
+        print(f"  Deleting vectors of {len(paper_ids)} missing papers from Pinecone")
+        deleted, errors = self._run_limited(self.pinecone_service.delete_paper_vectors, paper_ids, str)
+        repairs["orphan_vectors"] = {
+            "papers": len(deleted),
+            "vectors_deleted": sum(deleted),
+            "skipped": len(existing),
+            "errors": errors
+        }
+
+        # A paper whose PDF is gone cannot be viewed or reindexed, so it is removed like sync_databases does
+        print(f"  Deleting {len(issues['papers_missing_object'])} papers whose PDF is missing")
+        cleared, errors = self._run_limited(
+            self._delete_unstored_paper_vectors, issues["papers_missing_object"], lambda paper: paper.id
+        )
+        for start in range(0, len(cleared), DB_DELETE_BATCH_SIZE):
+            batch = [uuid.UUID(paper_id) for paper_id in cleared[start:start + DB_DELETE_BATCH_SIZE]]
+            self.db.execute(delete(Paper).where(Paper.id.in_(batch)))
+            self.db.commit()
+        repairs["papers_missing_object"] = {"deleted": len(cleared), "errors": errors}
+
+        print(f"  Reindexing {len(issues['papers_missing_vectors'])} papers without vectors")
+        reindexed, errors = self._run_limited(self._reindex, issues["papers_missing_vectors"], lambda paper: paper.id)
+        for paper_id, chunk_count in reindexed:
+            self.db.execute(update(Paper).where(Paper.id == uuid.UUID(paper_id)).values(chunk_count=chunk_count))
+        self.db.commit()
+        repairs["papers_missing_vectors"] = {
+            "reindexed": len(reindexed),
+            "chunks": sum(chunk_count for _, chunk_count in reindexed),
+            "errors": errors
+        }
+
+        if cleared or reindexed:
+            repairs["org_stats"] = OrganizationStatsRepair().repair(dry_run=False)
+        return repairs
+
+    def _check_delete_fractions(self, issues: Dict[str, list], counts: Dict[str, int], max_delete_fraction: float) -> None:
+        for name, total in (
+            ("orphan_vectors", counts["vector_papers"]),
+            ("orphan_objects", counts["objects"]),
+            ("papers_missing_object", counts["papers"])
+        ):
+            if total and len(issues[name]) > total * max_delete_fraction:
+                raise SyncAborted(
+                    f"Refusing to repair {len(issues[name])} {name} out of {total}; "
+                    f"check the listings or raise --max-delete-fraction"
+                )
+
+    def run(
+        self,
+        dry_run: bool = True,
+        full: bool = False,
+        min_age: timedelta = timedelta(hours=1),
+        max_delete_fraction: float = 0.5,
+        full_every: timedelta = timedelta(days=7)
+    ) -> Dict[str, Any]:
+        """Check the stores, repair unless dry_run, and return a JSON-serializable report.
+
+        The checkpoint only advances when nothing was found or every repair
+        succeeded, so unrepaired issues are looked at again on the next run.
+        """
+        started_at = datetime.utcnow()
+        cutoff = started_at - min_age
+        checkpoint = self.load_checkpoint()
+        watermark = checkpoint["watermark"]
+        last_full_run = checkpoint["last_full_run"]
+        if not full and (watermark is None or last_full_run is None or last_full_run < started_at - full_every):
+            print("No recent full run in the checkpoint, running a full check")
+            full = True
+
+        print(f"Starting {'full' if full else 'incremental'} consistency check...")
+        if dry_run:
+            print("(DRY RUN - No changes will be made)")
+
+        report: Dict[str, Any] = {
+            "mode": "full" if full else "incremental",
+            "dry_run": dry_run,
+            "started_at": _isoformat(started_at),
+            "window": {"since": None if full else _isoformat(watermark), "until": _isoformat(cutoff)}
+        }
+        issues, counts = self.check_full(cutoff) if full else self.check_incremental(watermark, cutoff)
+        report["counts"] = counts
+        report["issue_counts"] = {name: len(issues[name]) for name in ISSUE_TYPES}
+        report["orphan_object_bytes"] = sum(stored["size"] or 0 for stored in issues["orphan_objects"])
+        report["issues"] = {
+            "papers_missing_vectors": [paper.to_report() for paper in issues["papers_missing_vectors"]],
+            "papers_missing_object": [paper.to_report() for paper in issues["papers_missing_object"]],
+            "orphan_vectors": issues["orphan_vectors"],
+            "orphan_objects": [
+                {"path": stored["path"], "size": stored["size"], "created_at": _isoformat(stored["created_at"])}
+                for stored in issues["orphan_objects"]
+            ]
+        }
+
+        print("Analysis Results:")
+        for name in ISSUE_TYPES:
+            print(f"  {name}: {len(issues[name])}")
+        print(f"  Bytes held by orphaned PDFs: {report['orphan_object_bytes']}")
+
+        clean = not any(issues[name] for name in ISSUE_TYPES)
+        if clean:
+            report["status"] = "clean"
+        elif dry_run:
+            report["status"] = "issues_found"
+        else:
+            try:
+                # Incremental counts cover only the window, so the guard compares against it
+                self._check_delete_fractions(issues, counts, max_delete_fraction)
+                print("Repairing...")
+                report["repairs"] = self.repair(issues)
+                failed = any(result.get("errors") for result in report["repairs"].values())
+                report["status"] = "repair_failed" if failed else "repaired"
+            except SyncAborted as e:
+                report["status"] = "aborted"
+                report["error"] = str(e)
+
+        report["checkpoint_advanced"] = report["status"] in ("clean", "repaired")
+        if report["checkpoint_advanced"]:
+            self.save_checkpoint(cutoff, started_at if full else last_full_run)
+        report["finished_at"] = _isoformat(datetime.utcnow())
+        return report
+
+    def close(self):
+        self.db.close()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check papers, Pinecone vectors and stored PDFs against each other")
+    parser.add_argument("--dry-run", action="store_true", default=True,
+                       help="Report issues without repairing them (default: True)")
+    parser.add_argument("--execute", action="store_true",
+                       help="Actually repair the issues found")
+    parser.add_argument("--full", action="store_true",
+                       help="List every store instead of checking changes since the last run")
+    parser.add_argument("--full-every-days", type=float, default=7,
+                       help="Run a full check when the last one is older than this (default: 7)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH,
+                       help=f"Checkpoint file for incremental runs (default: {CHECKPOINT_PATH})")
+    parser.add_argument("--report", default=REPORT_PATH,
+                       help=f"Where to write the JSON report (default: {REPORT_PATH})")
+    parser.add_argument("--workers", type=int, default=8,
+                       help="Parallel listing and repair requests (default: 8)")
+    parser.add_argument("--repair-rate", type=float, default=600,
+                       help="Repair operations started per minute (default: 600)")
+    parser.add_argument("--min-age-minutes", type=float, default=60,
+                       help="Leave papers and PDFs created more recently than this alone (default: 60)")
+    parser.add_argument("--max-delete-fraction", type=float, default=0.5,
+                       help="Abort a repair that would delete more than this fraction of a store, "
+                            "or of the checked window on incremental runs (default: 0.5)")
+
+    args = parser.parse_args()
+
+    if args.execute:
+        args.dry_run = False
+
+    checker = ConsistencyChecker(workers=args.workers, repair_rate=args.repair_rate, checkpoint_path=args.checkpoint)
+
+    try:
+        report = checker.run(
+            dry_run=args.dry_run,
+            full=args.full,
+            min_age=timedelta(minutes=args.min_age_minutes),
+            max_delete_fraction=args.max_delete_fraction,
+            full_every=timedelta(days=args.full_every_days)
+        )
+    finally:
+        checker.close()
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+    print(f"Consistency check {report['status']}")
+    if report["status"] in ("aborted", "repair_failed"):
+        sys.exit(1)
+    if args.dry_run and report["status"] == "issues_found":
+        print("To repair these issues, run with --execute flag")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from metrics import metrics
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one unit of work.
+
+    The first caller for a key starts the work; callers arriving while it is
+    still running await the same task instead of starting their own. Once the
+    task finishes the key is released, so later calls start fresh work.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def _release(self, key: Hashable, task: "asyncio.Task[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def join(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> "asyncio.Task[Any]":
+        """Start fn() for key, or return the task already in flight for it"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._release(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            print(f"[{self.name}] Joining in-flight work for {key}")
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn() for key, or join the call already in flight for it"""
+        # Shield so one caller going away does not cancel work others are awaiting
+        return await asyncio.shield(self.join(key, fn))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "started": self.started,
+            "coalesced": self.coalesced
+        }
+
+
+class TokenStream:
+    """Replayable token stream written by one producer and read by many consumers.
+
+    Every consumer sees the stream from its first token, so callers that join
+    an in-flight answer late still receive the complete text.
+    """
+
+    def __init__(self):
+        self._tokens: List[str] = []
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, token: str) -> None:
+        if self._closed or not token:
+            return
+        self._tokens.append(token)
+        self._notify()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._notify()
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self._tokens):
+                yield self._tokens[index]
+                index += 1
+            if self._closed:
+                return
+            await self._changed.wait()
+
+
+class StreamingSingleFlight(SingleFlight):
+    """SingleFlight whose callers also share the producer's token stream.
+
+    Callers that join a stream must call leave_stream when they stop reading;
+    the producer is cancelled once its last reader has left.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._streams: Dict[Hashable, TokenStream] = {}
+        self._readers: Dict["asyncio.Task[Any]", int] = {}
+        self.cancelled = 0
+
+    def _close_stream(self, key: Hashable, stream: TokenStream) -> None:
+        stream.close()
+        if self._streams.get(key) is stream:
+            del self._streams[key]
+
+    def join_stream(
+        self, key: Hashable, producer: Callable[[TokenStream], Awaitable[Any]]
+    ) -> Tuple[TokenStream, "asyncio.Task[Any]"]:
+        """Start producer(stream) for key, or join the stream already in flight"""
+        stream = self._streams.get(key)
+        if stream is not None and self.in_flight(key):
+            task = self.join(key, lambda: producer(stream))
+        else:
+            stream = TokenStream()
+            self._streams[key] = stream
+            task = self.join(key, lambda: producer(stream))
+            task.add_done_callback(lambda t: self._close_stream(key, stream))
+            task.add_done_callback(lambda t: self._readers.pop(t, None))
+
+        self._readers[task] = self._readers.get(task, 0) + 1
+        return stream, task
+
+    def leave_stream(self, task: "asyncio.Task[Any]") -> None:
+        """Stop reading a joined stream, cancelling the producer if nobody is left"""
+        remaining = self._readers.get(task, 0) - 1
+        if remaining > 0:
+            self._readers[task] = remaining
+            return
+
+        self._readers.pop(task, None)
+        if not task.done():
+            self.cancelled += 1
+            print(f"[{self.name}] Last reader left, cancelling in-flight work")
+            task.cancel()
+            # Release the key now so new callers start fresh work instead of joining a cancelled task
+            for key, inflight in list(self._inflight.items()):
+                if inflight is task:
+                    self._release(key, task)
+                    stream = self._streams.get(key)
+                    if stream is not None:
+                        self._close_stream(key, stream)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["cancelled"] = self.cancelled
+        return stats
+
+
+class StageGraph:
+    """Run named async stages concurrently, each starting once its dependencies finish.
+
+    Stage functions receive the results of the stages that have completed so
+    far. If any stage fails, the remaining stages are cancelled and the first
+    error is raised. Per-stage wall-clock timings are kept in `timings`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timings: Dict[str, float] = {}
+        self._stages: Dict[str, Tuple[Callable[[Dict[str, Any]], Awaitable[Any]], Tuple[str, ...]]] = {}
+
+    def add(self, name: str, fn: Callable[[Dict[str, Any]], Awaitable[Any]], depends_on: Tuple[str, ...] = ()) -> None:
+        self._stages[name] = (fn, tuple(depends_on))
+
+    async def run(self) -> Dict[str, Any]:
+        results: Dict[str, Any] = {}
+        tasks: Dict[str, "asyncio.Task[Any]"] = {}
+        loop = asyncio.get_running_loop()
+
+        async def run_stage(name: str) -> Any:
+            fn, depends_on = self._stages[name]
+            for dependency in depends_on:
+                await tasks[dependency]
+            started = loop.time()
+            try:
+                results[name] = await fn(results)
+            finally:
+                self.timings[name] = loop.time() - started
+            return results[name]
+
+        started = loop.time()
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+
+        try:
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # Drain cancelled stages so their exceptions are not reported as unretrieved
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            self.timings["total"] = loop.time() - started
+
+        return results
+
+
+class QueueFullError(Exception):
+    """Raised by QueryScheduler.admit when the wait queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Query queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QueryTicket:
+    """A caller's place in the QueryScheduler: waiting, running or released"""
+
+    def __init__(self, scheduler: "QueryScheduler", org_id: str, granted: bool):
+        self.scheduler = scheduler
+        self.org_id = org_id
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = self.enqueued_at if granted else None
+        self.released = False
+        self._slot: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        if granted:
+            self._slot.set_result(None)
+        self._release_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> bool:
+        return not self._slot.done()
+
+    async def acquire(self) -> None:
+        """Wait until the scheduler hands this ticket a slot"""
+        await asyncio.shield(self._slot)
+
+    def release_at(self, when: float) -> None:
+        """Release at loop time when, unless the slot is handed to a task first"""
+        self._cancel_timer()
+        self._release_timer = asyncio.get_running_loop().call_at(when, self.release)
+
+    def release_when_done(self, task: "asyncio.Future[Any]") -> None:
+        """Hold the slot for exactly as long as task runs"""
+        self._cancel_timer()
+        task.add_done_callback(lambda t: self.release())
+
+    def _cancel_timer(self) -> None:
+        if self._release_timer is not None:
+            self._release_timer.cancel()
+            self._release_timer = None
+
+    def release(self) -> None:
+        """Give back the slot, or leave the queue if still waiting; safe to call twice"""
+        if self.released:
+            return
+        self.released = True
+        self._cancel_timer()
+        self.scheduler._release(self)
+
+
+class QueryScheduler:
+    """Admission control for LLM-backed queries.
+
+    At most max_concurrent queries run at once. Further queries wait in
+    per-org queues that are served round-robin, so one busy org cannot starve
+    the others. When max_queued callers are already waiting (or one org has
+    max_queued_per_org waiting), admit() fails fast with QueueFullError.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, max_queued_per_org: int):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_org = max_queued_per_org
+
+        self._active = 0
+        self._queued = 0
+        # Orgs with waiters, in round-robin order
+        self._queues: "OrderedDict[str, Deque[QueryTicket]]" = OrderedDict()
+        # Smoothed time a query holds a slot, used for Retry-After estimates
+        self._avg_hold_seconds = 10.0
+        self.rejected = 0
+
+    def admit(self, org_id: str) -> QueryTicket:
+        """Reserve a slot or a queue position for a query, or raise QueueFullError"""
+        org_id = str(org_id)
+        if self._active < self.max_concurrent and self._queued == 0:
+            self._active += 1
+            self._publish()
+            return QueryTicket(self, org_id, granted=True)
+
+        org_queue = self._queues.get(org_id)
+        if self._queued >= self.max_queued or (org_queue is not None and len(org_queue) >= self.max_queued_per_org):
+            self.rejected += 1
+            metrics.increment("query.scheduler.rejected")
+            raise QueueFullError(self.retry_after())
+
+        ticket = QueryTicket(self, org_id, granted=False)
+        if org_queue is None:
+            org_queue = self._queues[org_id] = deque()
+        org_queue.append(ticket)
+        self._queued += 1
+        self._publish()
+        return ticket
+
+    def retry_after(self) -> int:
+        """Rough seconds until a slot frees up for a new caller"""
+        waves = (self._queued + 1) / max(1, self.max_concurrent)
+        return max(1, math.ceil(self._avg_hold_seconds * waves))
+
+    def _release(self, ticket: QueryTicket) -> None:
+        if ticket.waiting:
+            # Left before being scheduled: drop it from its org queue
+            org_queue = self._queues.get(ticket.org_id)
+            if org_queue is not None and ticket in org_queue:
+                org_queue.remove(ticket)
+                self._queued -= 1
+                if not org_queue:
+                    del self._queues[ticket.org_id]
+            ticket._slot.cancel()
+        else:
+            self._active -= 1
+            held = time.monotonic() - (ticket.granted_at or ticket.enqueued_at)
+            self._avg_hold_seconds = 0.8 * self._avg_hold_seconds + 0.2 * held
+            self._dispatch()
+        self._publish()
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrent and self._queues:
+            org_id, org_queue = next(iter(self._queues.items()))
+            ticket = org_queue.popleft()
+            self._queued -= 1
+            # Move the org to the back of the rotation, or drop it if drained
+            del self._queues[org_id]
+            if org_queue:
+                self._queues[org_id] = org_queue
+
+            self._active += 1
+            ticket.granted_at = time.monotonic()
+            metrics.observe("query.scheduler.wait", ticket.granted_at - ticket.enqueued_at)
+            ticket._slot.set_result(None)
+
+    def _publish(self) -> None:
+        metrics.set_gauge("query.scheduler.active", self._active)
+        metrics.set_gauge("query.scheduler.queued", self._queued)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "max_queued_per_org": self.max_queued_per_org,
+            "queued_by_org": {org_id: len(queue) for org_id, queue in self._queues.items()},
+            "rejected": self.rejected,
+            "avg_hold_seconds": round(self._avg_hold_seconds, 2)
+        }
@@ -1,25 +1,106 @@
-from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Text, Enum
+from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Text, Enum, Index, Integer, BigInteger, text
 from sqlalchemy.dialects.postgresql import UUID, TIMESTAMP
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from datetime import datetime
 import os
 import enum
 from dotenv import load_dotenv
+from sql_metrics import sql_metrics
 
 load_dotenv()
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database/app.db")
 
+# Connection pool sizing for the Postgres engines
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+def async_database_url(url: str) -> str:
+    """Swap a sync driver URL for its async equivalent (asyncpg / aiosqlite)"""
+    for prefix, async_prefix in (
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgres://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_database_url(DATABASE_URL)
+
+# Optional read replica for read-only endpoints; unset means everything uses the primary
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL")
+ASYNC_READ_DATABASE_URL = async_database_url(READ_DATABASE_URL) if READ_DATABASE_URL else None
+
+def pool_options(url: str, pool_class, name: str) -> dict:
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        # Records checkout wait time and pool timeouts under db.<name>.pool
+        "poolclass": sql_metrics.timed_pool_class(pool_class, name),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True
+    }
+
+# Sync engine for scripts (sync_databases.py, migrations) and startup DDL
 if DATABASE_URL.startswith("sqlite"):
     os.makedirs("database", exist_ok=True)
     engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL, QueuePool, "sync"))
+sql_metrics.instrument(engine, "sync")
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for request handlers, so queries never block the event loop
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL, AsyncAdaptedQueuePool, "primary")
+)
+sql_metrics.instrument(async_engine.sync_engine, "primary")
+
+if ASYNC_READ_DATABASE_URL:
+    async_read_engine = create_async_engine(
+        ASYNC_READ_DATABASE_URL, **pool_options(ASYNC_READ_DATABASE_URL, AsyncAdaptedQueuePool, "replica")
+    )
+    sql_metrics.instrument(async_read_engine.sync_engine, "replica")
+else:
+    async_read_engine = async_engine
+
+class RoutingSession(Session):
+    """Session that sends the reads of read-only sessions to the replica.
+
+    Sessions opened with info={"use_replica": True} read from the replica
+    until they write; flushes and INSERT/UPDATE/DELETE statements always go
+    to the primary, and every read after the first write stays there too so
+    the session sees its own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or getattr(clause, "is_dml", False):
+            self.info["use_replica"] = False
+        if self.info.get("use_replica"):
+            return async_read_engine.sync_engine
+        return async_engine.sync_engine
+
+# Objects stay readable after commit; async sessions cannot lazily refresh them
+AsyncSessionLocal = async_sessionmaker(
+    sync_session_class=RoutingSession, expire_on_commit=False, autoflush=False
+)
+
+def reads_from_replica(db: AsyncSession) -> bool:
+    """Whether db's reads may lag behind the primary"""
+    return async_read_engine is not async_engine and bool(db.info.get("use_replica"))
+
 Base = declarative_base()
 
 class MembershipStatus(str, enum.Enum):
@@ -65,6 +146,24 @@ class Organization(Base):
     created_by_user = relationship("User", back_populates="created_organizations")
     memberships = relationship("Membership", back_populates="organization")
     papers = relationship("Paper", back_populates="organization")
+    stats = relationship("OrganizationStats", back_populates="organization", uselist=False)
+
+class OrganizationStats(Base):
+    """Per-organization counters, updated in the same transaction as the rows they count.
+
+    repair_org_stats.py recomputes them from the source tables.
+    """
+    __tablename__ = "organization_stats"
+    
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id"), primary_key=True)
+    paper_count = Column(Integer, default=0, nullable=False)
+    approved_member_count = Column(Integer, default=0, nullable=False)
+    pending_count = Column(Integer, default=0, nullable=False)
+    chunk_count = Column(Integer, default=0, nullable=False)
+    total_bytes = Column(BigInteger, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    organization = relationship("Organization", back_populates="stats")
 
 class Membership(Base):
     __tablename__ = "memberships"
@@ -80,6 +179,15 @@ class Membership(Base):
     # Relationships
     user = relationship("User", back_populates="memberships")
     organization = relationship("Organization", back_populates="memberships")
+    
+    __table_args__ = (
+        # Membership checks: (user, org, approved)
+        Index("ix_memberships_user_org_status", "user_id", "organization_id", "status"),
+        # Member listings and counts per org
+        Index("ix_memberships_org_status", "organization_id", "status"),
+        # Keyset pagination of member listings
+        Index("ix_memberships_org_requested", "organization_id", "requested_at", "id"),
+    )
 
 class Paper(Base):
     __tablename__ = "papers"
@@ -87,6 +195,11 @@ class Paper(Base):
     id = Column(UUID(as_uuid=True), primary_key=True)
     title = Column(String)
     file_url = Column(String)
+    # Last segment of file_url ("<uuid>_<original name>"), the name clients request files by
+    filename = Column(String)
+    # Size of the stored PDF and number of vectors it was indexed as (null until known)
+    size_bytes = Column(BigInteger)
+    chunk_count = Column(Integer)
     uploaded_by = Column(UUID(as_uuid=True), ForeignKey("users.id"))
     organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id"))
     uploaded_at = Column(DateTime, default=datetime.utcnow)
@@ -94,13 +207,79 @@ class Paper(Base):
     # Relationships
     uploaded_by_user = relationship("User", back_populates="uploaded_papers")
     organization = relationship("Organization", back_populates="papers")
+    
+    __table_args__ = (
+        # Also serves plain per-org paper queries through its leading column
+        Index("ix_papers_org_filename", "organization_id", "filename"),
+        # Keyset pagination of paper listings
+        Index("ix_papers_org_uploaded", "organization_id", "uploaded_at", "id"),
+    )
+
+def storage_filename(file_url: str) -> str:
+    """Filename part of a storage path such as org_<id>/<uuid>_<name>.pdf"""
+    return str(file_url).rsplit("/", 1)[-1]
 
 # Create tables
 Base.metadata.create_all(bind=engine)
 
+# Organization name search: an FTS5 trigram index kept in sync by triggers on
+# SQLite, a pg_trgm GIN index (which serves ILIKE '%q%') on Postgres
+SQLITE_ORG_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS organizations_fts USING fts5("
+    "name, content='organizations', content_rowid='rowid', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS organizations_fts_insert AFTER INSERT ON organizations BEGIN "
+    "INSERT INTO organizations_fts(rowid, name) VALUES (new.rowid, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS organizations_fts_delete AFTER DELETE ON organizations BEGIN "
+    "INSERT INTO organizations_fts(organizations_fts, rowid, name) VALUES ('delete', old.rowid, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS organizations_fts_update AFTER UPDATE OF name ON organizations BEGIN "
+    "INSERT INTO organizations_fts(organizations_fts, rowid, name) VALUES ('delete', old.rowid, old.name); "
+    "INSERT INTO organizations_fts(rowid, name) VALUES (new.rowid, new.name); END",
+]
+POSTGRES_ORG_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_organizations_name_trgm ON organizations USING gin (name gin_trgm_ops)",
+]
+
+def ensure_org_search_index() -> bool:
+    """Create the organization name search index if possible.
+
+    Returns True when the SQLite FTS5 table is usable; searches fall back to
+    ILIKE otherwise (which the trigram index accelerates on Postgres).
+    """
+    try:
+        if engine.dialect.name == "sqlite":
+            with engine.begin() as conn:
+                created = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'organizations_fts'"
+                )).first() is None
+                for statement in SQLITE_ORG_SEARCH_DDL:
+                    conn.execute(text(statement))
+                if created:
+                    # Index organizations that existed before the FTS table
+                    conn.execute(text("INSERT INTO organizations_fts(organizations_fts) VALUES ('rebuild')"))
+            return True
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                for statement in POSTGRES_ORG_SEARCH_DDL:
+                    conn.execute(text(statement))
+    except Exception as e:
+        print(f"Organization search index unavailable, using ILIKE: {e}")
+    return False
+
+ORG_SEARCH_USES_FTS = ensure_org_search_index()
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_async_read_db():
+    """Session for read-only endpoints, served by the replica when one is configured"""
+    async with AsyncSessionLocal(info={"use_replica": True}) as db:
+        yield db 
\ No newline at end of file
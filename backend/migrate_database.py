@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+from typing import Dict, List, Tuple
+from sqlalchemy import inspect, text
+from database import engine, SessionLocal, Base, Paper, storage_filename
+from repair_org_stats import OrganizationStatsRepair
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKFILL_BATCH_SIZE = 1000
+
+# Columns added to existing tables after their first release: (table, column, DDL type)
+ADDED_COLUMNS: List[Tuple[str, str, str]] = [
+    ("papers", "filename", "VARCHAR"),
+    ("papers", "size_bytes", "BIGINT"),
+    ("papers", "chunk_count", "INTEGER"),
+]
+
+class DatabaseMigration:
+    """Bring an existing database up to the current models.
+
+    create_all only creates missing tables, so columns and indexes added to
+    existing tables are applied here. Every step is idempotent.
+    """
+
+    def __init__(self):
+        self.engine = engine
+        self.is_postgres = engine.dialect.name == "postgresql"
+
+    def add_missing_columns(self, dry_run: bool = True) -> List[str]:
+        inspector = inspect(self.engine)
+        added = []
+        for table, column, ddl_type in ADDED_COLUMNS:
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column in existing:
+                continue
+            print(f"  Adding column {table}.{column}")
+            added.append(f"{table}.{column}")
+            if not dry_run:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+        return added
+
+    def create_missing_indexes(self, dry_run: bool = True) -> List[str]:
+        inspector = inspect(self.engine)
+        created = []
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                columns = ", ".join(column.name for column in index.columns)
+                unique = "UNIQUE " if index.unique else ""
+                # Build indexes on Postgres without blocking writes to the table
+                concurrently = "CONCURRENTLY " if self.is_postgres else ""
+                statement = f"CREATE {unique}INDEX {concurrently}IF NOT EXISTS {index.name} ON {table.name} ({columns})"
+                print(f"  {statement}")
+                created.append(index.name)
+                if not dry_run:
+                    # CONCURRENTLY cannot run inside a transaction block
+                    with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        conn.execute(text(statement))
+        return created
+
+    def backfill_paper_filenames(self, dry_run: bool = True) -> int:
+        """Fill papers.filename from file_url in batches"""
+        db = SessionLocal()
+        updated = 0
+        try:
+            if dry_run:
+                return db.query(Paper).filter(
+                    Paper.filename.is_(None),
+                    Paper.file_url.isnot(None)
+                ).count()
+            while True:
+                papers = db.query(Paper).filter(
+                    Paper.filename.is_(None),
+                    Paper.file_url.isnot(None)
+                ).limit(BACKFILL_BATCH_SIZE).all()
+                if not papers:
+                    break
+                for paper in papers:
+                    paper.filename = storage_filename(paper.file_url)
+                updated += len(papers)
+                db.commit()
+                print(f"  Backfilled {updated} paper filenames")
+        finally:
+            db.close()
+        return updated
+
+    def migrate(self, dry_run: bool = True) -> Dict[str, object]:
+        print("Starting database migration...")
+        if dry_run:
+            print("(DRY RUN - No changes will be made)")
+
+        # Tables first so later steps can rely on them
+        if not dry_run:
+            Base.metadata.create_all(bind=self.engine)
+
+        columns = self.add_missing_columns(dry_run)
+        if dry_run and columns:
+            # The remaining steps need the new columns to exist
+            print("  Skipping index and backfill checks until columns are added")
+            return {"added_columns": columns, "created_indexes": [], "backfilled_papers": 0, "organization_stats": {}}
+
+        indexes = self.create_missing_indexes(dry_run)
+        backfilled = self.backfill_paper_filenames(dry_run)
+        print(f"  Papers needing a filename backfill: {backfilled}" if dry_run else f"  Backfilled {backfilled} papers")
+
+        # Fill organization_stats for organizations that predate it
+        stats = OrganizationStatsRepair().repair(dry_run)
+
+        return {
+            "added_columns": columns,
+            "created_indexes": indexes,
+            "backfilled_papers": backfilled,
+            "organization_stats": {"created": stats["created"], "corrected": len(stats["drifted"])}
+        }
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply schema changes and backfills to an existing database")
+    parser.add_argument("--dry-run", action="store_true", default=True,
+                       help="Show what would be done without making changes (default: True)")
+    parser.add_argument("--execute", action="store_true",
+                       help="Actually apply the migration")
+
+    args = parser.parse_args()
+
+    if args.execute:
+        args.dry_run = False
+
+    results = DatabaseMigration().migrate(dry_run=args.dry_run)
+    if args.dry_run:
+        print("To apply these changes, run with --execute flag")
+    else:
+        print(f"Migration completed: {results}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Membership, MembershipStatus, OrganizationStats, Paper
+
+COUNTERS = ("paper_count", "approved_member_count", "pending_count", "chunk_count", "total_bytes")
+
+
+def empty_counts() -> Dict[str, int]:
+    return {name: 0 for name in COUNTERS}
+
+
+def source_count_statements(organization_ids: Optional[Iterable] = None) -> Tuple:
+    """Grouped queries that count papers and memberships per organization from the source tables"""
+    papers = select(
+        Paper.organization_id,
+        func.count(Paper.id),
+        func.coalesce(func.sum(Paper.chunk_count), 0),
+        func.coalesce(func.sum(Paper.size_bytes), 0)
+    ).group_by(Paper.organization_id)
+    memberships = select(
+        Membership.organization_id,
+        Membership.status,
+        func.count(Membership.id)
+    ).group_by(Membership.organization_id, Membership.status)
+    if organization_ids is not None:
+        ids = [uuid.UUID(str(org_id)) for org_id in organization_ids]
+        papers = papers.where(Paper.organization_id.in_(ids))
+        memberships = memberships.where(Membership.organization_id.in_(ids))
+    return papers, memberships
+
+
+def combine_source_counts(paper_rows, membership_rows) -> Dict[uuid.UUID, Dict[str, int]]:
+    """Fold the rows of source_count_statements() into counters per organization"""
+    counts: Dict[uuid.UUID, Dict[str, int]] = {}
+    for org_id, paper_count, chunk_count, total_bytes in paper_rows:
+        org_counts = counts.setdefault(org_id, empty_counts())
+        org_counts["paper_count"] = paper_count
+        org_counts["chunk_count"] = int(chunk_count)
+        org_counts["total_bytes"] = int(total_bytes)
+    for org_id, membership_status, member_count in membership_rows:
+        org_counts = counts.setdefault(org_id, empty_counts())
+        if membership_status == MembershipStatus.APPROVED.value:
+            org_counts["approved_member_count"] = member_count
+        elif membership_status == MembershipStatus.PENDING.value:
+            org_counts["pending_count"] = member_count
+    return counts
+
+
+async def count_from_sources(db: AsyncSession, organization_id) -> Dict[str, int]:
+    """Recount one organization's counters from papers and memberships"""
+    papers, memberships = source_count_statements([organization_id])
+    counts = combine_source_counts(
+        (await db.execute(papers)).all(),
+        (await db.execute(memberships)).all()
+    )
+    return counts.get(uuid.UUID(str(organization_id)), empty_counts())
+
+
+def insert_ignoring_existing(dialect_name: str, **values):
+    """INSERT of an organization_stats row that does nothing if the row already exists"""
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    return insert(OrganizationStats).values(**values).on_conflict_do_nothing(
+        index_elements=[OrganizationStats.organization_id]
+    )
+
+
+async def adjust_org_stats(db: AsyncSession, organization_id, **deltas: int) -> None:
+    """Apply counter deltas inside db's transaction, to be committed with the change they count.
+
+    Call it after adding the counted change to the session. Organizations
+    without a counter row yet are recounted from the source tables instead;
+    if a concurrent transaction creates the row first, the deltas are applied
+    to its row.
+    """
+    values = {name: getattr(OrganizationStats, name) + delta for name, delta in deltas.items() if delta}
+    if not values:
+        return
+    org_id = uuid.UUID(str(organization_id))
+    apply_deltas = (
+        update(OrganizationStats)
+        .where(OrganizationStats.organization_id == org_id)
+        .values(**values, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    if (await db.execute(apply_deltas)).rowcount:
+        return
+    # The recount sees the caller's change once it is flushed
+    await db.flush()
+    counts = await count_from_sources(db, org_id)
+    inserted = await db.execute(insert_ignoring_existing(
+        db.get_bind().dialect.name, organization_id=org_id, updated_at=datetime.utcnow(), **counts
+    ))
+    if inserted.rowcount == 0:
+        # Another transaction inserted the row between our UPDATE and INSERT;
+        # its recount cannot have seen our uncommitted change
+        await db.execute(apply_deltas)
+
+
+async def get_org_stats(db: AsyncSession, organization_id) -> Dict[str, int]:
+    """Counters for one organization: a primary-key read, or a recount if the row is missing"""
+    org_id = uuid.UUID(str(organization_id))
+    stats = await db.get(OrganizationStats, org_id)
+    if stats is None:
+        return await count_from_sources(db, org_id)
+    return {name: getattr(stats, name) for name in COUNTERS}
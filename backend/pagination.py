@@ -0,0 +1,84 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Upper bound for ?limit= on paginated listings
+MAX_PAGE_SIZE = 200
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _decode_value(column, value: Any) -> Any:
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if value is None:
+        return None
+    if issubclass(python_type, datetime):
+        return datetime.fromisoformat(value)
+    if issubclass(python_type, uuid.UUID):
+        return uuid.UUID(value)
+    return python_type(value)
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """Opaque cursor for the sort key of the last row on a page"""
+    payload = json.dumps([_encode_value(value) for value in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: Sequence[Any]) -> Tuple[Any, ...]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("Cursor does not match this listing")
+        return tuple(_decode_value(column, value) for column, value in zip(columns, values))
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+async def paginate(
+    db: AsyncSession,
+    statement,
+    columns: Sequence[Any],
+    key: Callable[[Any], Sequence[Any]],
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None
+) -> Tuple[List[Any], Optional[str]]:
+    """Keyset-paginate a select ordered by columns (ascending, unique as a whole).
+
+    Returns the rows of the page and the cursor for the next one, or None
+    on the last page. Without a limit every remaining row is returned.
+    key maps a result row to its values for columns.
+    """
+    if cursor:
+        statement = statement.where(tuple_(*columns) > decode_cursor(cursor, columns))
+    statement = statement.order_by(*columns)
+
+    if limit is None:
+        return list((await db.execute(statement)).all()), None
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # One extra row tells us whether another page exists
+    rows = list((await db.execute(statement.limit(limit + 1))).all())
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
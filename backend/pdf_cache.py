@@ -0,0 +1,381 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator, NamedTuple, Optional, Tuple, Union
+
+from concurrency import SingleFlight
+
+CHUNK_SIZE = 64 * 1024
+# Temp files older than this at startup were left by a crash; younger ones may
+# belong to another worker sharing the directory
+STALE_TMP_SECONDS = 3600
+
+
+@contextmanager
+def temporary_pdf_path(data: Union[bytes, bytearray, memoryview, BinaryIO]) -> Iterator[str]:
+    """Expose in-memory PDF data as a file path for libraries that only accept paths.
+
+    The file is removed when the block exits, including on errors.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                tmp_file.write(data)
+            else:
+                data.seek(0)
+                while chunk := data.read(CHUNK_SIZE):
+                    tmp_file.write(chunk)
+        yield path
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class CachedPdf(NamedTuple):
+    path: str
+    digest: str  # sha256 of the file content
+    size: int
+
+
+class PdfSpool:
+    """A PDF being written into the cache, hashed and measured as chunks arrive.
+
+    Until commit() the data lives in a private temp file that can be read
+    back with iter_chunks() or via `file`. Leaving the context manager
+    without committing discards it.
+    """
+
+    def __init__(self, cache: "PdfDiskCache"):
+        self._cache = cache
+        fd, self.path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self.file: BinaryIO = os.fdopen(fd, "w+b")
+        self._hasher = hashlib.sha256()
+        self.size = 0
+        self._done = False
+
+    def write(self, chunk: bytes) -> None:
+        self._hasher.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    @property
+    def digest(self) -> str:
+        return self._hasher.hexdigest()
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Read the spooled data back from the start"""
+        self.file.flush()
+        self.file.seek(0)
+        while chunk := self.file.read(chunk_size):
+            yield chunk
+
+    def commit(self, storage_path: str) -> CachedPdf:
+        """Move the spooled file into the cache as the content of storage_path"""
+        self.file.close()
+        cached = self._cache._commit(storage_path, self.path, self.digest, self.size)
+        self._done = True
+        return cached
+
+    def discard(self) -> None:
+        if self._done:
+            return
+        self._done = True
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self) -> "PdfSpool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.discard()
+
+
+class PdfDiskCache:
+    """Content-addressed on-disk cache of PDFs keyed by their storage path.
+
+    Blobs live under blobs/<sha256>.pdf and small ref files map a storage path
+    to the blob holding its content; backrefs/<sha256>/ holds an empty marker
+    per ref to the blob, so checking whether a blob is still shared only lists
+    its own markers. Writes go to a temp file in the same
+    directory and are renamed into place, so readers never see partial files.
+    When the total blob size exceeds max_bytes the least recently used blobs
+    are removed; refs to a removed blob simply miss on their next lookup.
+    Readers should use open(), since an open file stays readable after its
+    blob is removed.
+
+    Byte accounting is per process: workers sharing the directory each keep
+    their own budget, so the directory can grow to workers x max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.ref_dir = os.path.join(directory, "refs")
+        self.tmp_dir = os.path.join(directory, "tmp")
+        self.backref_dir = os.path.join(directory, "backrefs")
+        for path in (self.blob_dir, self.ref_dir, self.tmp_dir, self.backref_dir):
+            os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._downloads = SingleFlight("pdf-download")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_existing()
+
+    def _load_existing(self) -> None:
+        """Rebuild the LRU order from blob mtimes left by a previous process"""
+        entries = []
+        for name in os.listdir(self.blob_dir):
+            if not name.endswith(".pdf"):
+                continue
+            stat = os.stat(os.path.join(self.blob_dir, name))
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, digest, size in sorted(entries):
+            self._blobs[digest] = size
+            self._total_bytes += size
+        # Caches written before backrefs existed only have refs; index them once
+        if not os.listdir(self.backref_dir):
+            for name in os.listdir(self.ref_dir):
+                digest = self._read_ref(os.path.join(self.ref_dir, name))
+                if digest:
+                    self._add_backref(digest, name)
+        # Temp files from interrupted writes are garbage once they are old enough
+        # not to be another worker's spool in progress
+        stale_before = time.time() - STALE_TMP_SECONDS
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.stat(path).st_mtime < stale_before:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, f"{digest}.pdf")
+
+    def _ref_name(self, storage_path: str) -> str:
+        return hashlib.sha256(storage_path.encode()).hexdigest()
+
+    def _ref_path(self, storage_path: str) -> str:
+        return os.path.join(self.ref_dir, self._ref_name(storage_path))
+
+    @staticmethod
+    def _read_ref(ref_path: str) -> Optional[str]:
+        try:
+            with open(ref_path) as ref_file:
+                return ref_file.read().strip() or None
+        except OSError:
+            return None
+
+    def _add_backref(self, digest: str, ref_name: str) -> None:
+        marker_dir = os.path.join(self.backref_dir, digest)
+        while True:
+            os.makedirs(marker_dir, exist_ok=True)
+            try:
+                open(os.path.join(marker_dir, ref_name), "a").close()
+                return
+            except FileNotFoundError:
+                # Removed as empty by a concurrent invalidate; recreate it
+                continue
+
+    def _remove_backref(self, digest: str, ref_name: str) -> bool:
+        """Drop one ref's marker and return whether other refs still share the blob"""
+        marker_dir = os.path.join(self.backref_dir, digest)
+        try:
+            os.unlink(os.path.join(marker_dir, ref_name))
+        except OSError:
+            pass
+        try:
+            os.rmdir(marker_dir)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # Not empty: another ref still points at the blob
+            return True
+        return False
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, storage_path: str) -> Optional[CachedPdf]:
+        """Return the cached file for a storage path and mark it recently used"""
+        try:
+            with open(self._ref_path(storage_path)) as ref_file:
+                digest = ref_file.read().strip()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            size = self._blobs.get(digest)
+            if size is None:
+                self.misses += 1
+                return None
+            self._blobs.move_to_end(digest)
+            self.hits += 1
+
+        blob_path = self._blob_path(digest)
+        try:
+            # mtime doubles as the recency marker across restarts
+            os.utime(blob_path)
+        except OSError:
+            with self._lock:
+                self._forget(digest)
+                self.misses += 1
+            return None
+        return CachedPdf(blob_path, digest, size)
+
+    def _forget(self, digest: str) -> None:
+        size = self._blobs.pop(digest, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _commit(self, storage_path: str, tmp_path: str, digest: str, size: int) -> CachedPdf:
+        """Move a fully written temp file into place as the blob for storage_path"""
+        blob_path = self._blob_path(digest)
+        ref_name = self._ref_name(storage_path)
+        ref_path = self._ref_path(storage_path)
+        previous = self._read_ref(ref_path)
+        # Mark the blob as referenced before it appears, so a concurrent invalidate keeps it
+        self._add_backref(digest, ref_name)
+        os.replace(tmp_path, blob_path)
+        self._write_atomic(ref_path, digest.encode())
+        if previous and previous != digest and not self._remove_backref(previous, ref_name):
+            # The path's old content is no longer referenced by anything
+            with self._lock:
+                self._forget(previous)
+            try:
+                os.unlink(self._blob_path(previous))
+            except OSError:
+                pass
+        with self._lock:
+            if digest not in self._blobs:
+                self._blobs[digest] = size
+                self._total_bytes += size
+            self._blobs.move_to_end(digest)
+            self._evict(keep=digest)
+        return CachedPdf(blob_path, digest, size)
+
+    def _evict(self, keep: str) -> None:
+        while self._total_bytes > self.max_bytes and len(self._blobs) > 1:
+            digest = next(iter(self._blobs))
+            if digest == keep:
+                self._blobs.move_to_end(digest)
+                continue
+            self._forget(digest)
+            self.evictions += 1
+            try:
+                os.unlink(self._blob_path(digest))
+            except OSError:
+                pass
+
+    def spool(self) -> PdfSpool:
+        """Start writing a new PDF into the cache; see PdfSpool"""
+        return PdfSpool(self)
+
+    def put_file(self, storage_path: str, file_obj: BinaryIO) -> CachedPdf:
+        """Copy a readable binary file into the cache under storage_path"""
+        with self.spool() as spool:
+            while chunk := file_obj.read(CHUNK_SIZE):
+                spool.write(chunk)
+            return spool.commit(storage_path)
+
+    async def _download(self, storage_path: str, stream: Callable[[str], AsyncIterator[bytes]]) -> CachedPdf:
+        # Hashing, disk writes and the commit's rename and eviction stay off the event loop
+        spool = await asyncio.to_thread(self.spool)
+        try:
+            async for chunk in stream(storage_path):
+                await asyncio.to_thread(spool.write, chunk)
+            if spool.size == 0:
+                raise ValueError(f"Downloaded PDF is empty: {storage_path}")
+            print(f"Cached PDF on disk: {storage_path} ({spool.size} bytes)")
+            return await asyncio.to_thread(spool.commit, storage_path)
+        finally:
+            await asyncio.to_thread(spool.discard)
+
+    async def fetch(self, storage_path: str, stream: Callable[[str], AsyncIterator[bytes]]) -> CachedPdf:
+        """Return the cached file, downloading it with stream(storage_path) on a miss.
+
+        Downloads are written to disk chunk by chunk, and concurrent misses for
+        the same path share one download.
+        """
+        cached = self.get(storage_path)
+        if cached is not None:
+            return cached
+        return await self._downloads.do(storage_path, lambda: self._download(storage_path, stream))
+
+    async def open(self, storage_path: str, stream: Callable[[str], AsyncIterator[bytes]]) -> Tuple[CachedPdf, BinaryIO]:
+        """Like fetch, but also return the blob opened for reading; the caller closes it.
+
+        The open file keeps its content readable even if the blob is evicted
+        or invalidated while a response is still streaming it.
+        """
+        cached = await self.fetch(storage_path, stream)
+        try:
+            return cached, open(cached.path, "rb")
+        except FileNotFoundError:
+            # Removed between lookup and open (by this or another worker); fetch it again
+            with self._lock:
+                self._forget(cached.digest)
+            cached = await self.fetch(storage_path, stream)
+            return cached, open(cached.path, "rb")
+
+    def invalidate(self, storage_path: str) -> None:
+        """Forget a storage path, e.g. after the object is deleted.
+
+        Blobs are shared by every path with the same content, so the blob is
+        only removed once no other ref points at it.
+        """
+        ref_path = self._ref_path(storage_path)
+        digest = self._read_ref(ref_path)
+        if digest is None:
+            return
+        try:
+            os.unlink(ref_path)
+        except OSError:
+            return
+        if self._remove_backref(digest, self._ref_name(storage_path)):
+            return
+        with self._lock:
+            self._forget(digest)
+        try:
+            os.unlink(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "directory": self.directory,
+                "max_bytes": self.max_bytes,
+                "total_bytes": self._total_bytes,
+                "blob_count": len(self._blobs),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
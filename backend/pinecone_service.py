@@ -1,12 +1,30 @@
 import os
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, BinaryIO, Iterable, Iterator, Optional, Set, Union
+from concurrent.futures import ThreadPoolExecutor
 import pinecone
 from openai import OpenAI
 import PyPDF2
 import io
 from tiktoken import encoding_for_model
 import re
+from rate_limit import embedding_governor
+
+# A PDF given by path, as raw bytes, or as a seekable binary file such as BytesIO
+PdfSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
+
+# Largest page index.list() returns and most ids index.delete() accepts
+LIST_PAGE_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+# Paper ids are UUIDs, so listing one prefix per leading hex digit covers them in parallel
+VECTOR_ID_SHARDS = "0123456789abcdef"
+
+def vector_id_prefix(paper_id: str) -> str:
+    """Vector ids are "<paper_id>_<chunk index>", so a paper's vectors share this prefix"""
+    return f"{paper_id}_"
+
+def paper_id_from_vector_id(vector_id: str) -> str:
+    return vector_id.rsplit("_", 1)[0]
 
 class PineconeService:
     def __init__(self):
@@ -20,7 +38,8 @@ class PineconeService:
         self.pc = pinecone.Pinecone(api_key=self.pinecone_api_key)
         
         # Initialize OpenAI client
-        self.openai_client = OpenAI(api_key=self.openai_api_key)
+        # The shared rate governor retries rate limits and transient errors
+        self.openai_client = OpenAI(api_key=self.openai_api_key, max_retries=0)
         
         # Get or create index
         self.index_name = "alexandria-documents"
@@ -50,19 +69,27 @@ class PineconeService:
             print(f"Error ensuring index exists: {e}")
             raise
     
-    def extract_text_from_pdf(self, file_path: str) -> str:
-        """Extract text content from PDF file"""
+    def extract_text_from_pdf(self, file_path: PdfSource) -> str:
+        """Extract text content from a PDF path, in-memory buffer or open binary file"""
         try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                return text
+            if isinstance(file_path, str):
+                with open(file_path, 'rb') as file:
+                    return self._extract_text(file)
+            if isinstance(file_path, (bytes, bytearray, memoryview)):
+                return self._extract_text(io.BytesIO(file_path))
+            file_path.seek(0)
+            return self._extract_text(file_path)
         except Exception as e:
             print(f"Error extracting text from PDF: {e}")
             return ""
     
+    def _extract_text(self, file: BinaryIO) -> str:
+        pdf_reader = PyPDF2.PdfReader(file)
+        text = ""
+        for page in pdf_reader.pages:
+            text += page.extract_text() + "\n"
+        return text
+    
     def chunk_text(self, text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
         """Split text into overlapping chunks optimized for context windows"""
         # Use tiktoken to count tokens accurately
@@ -96,38 +123,61 @@ class PineconeService:
         
         return chunks
     
-    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+    def generate_embeddings(self, texts: List[str], priority: str = "interactive") -> List[List[float]]:
         """Generate embeddings for text chunks using OpenAI"""
         try:
-            response = self.openai_client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=texts
+            enc = encoding_for_model("text-embedding-ada-002")
+            token_count = sum(len(enc.encode(text)) for text in texts)
+            
+            # Go through the shared governor so ingestion cannot starve interactive queries
+            raw_response = embedding_governor.call(
+                lambda: self.openai_client.embeddings.with_raw_response.create(
+                    model="text-embedding-ada-002",
+                    input=texts
+                ),
+                tokens=token_count,
+                priority=priority
             )
+            embedding_governor.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
             return [embedding.embedding for embedding in response.data]
         except Exception as e:
             print(f"Error generating embeddings: {e}")
             return []
     
-    def store_document_vectors(self, organization_id: str, paper_id: str, file_path: str, title: str) -> bool:
-        """Process PDF and store vectors in Pinecone"""
+    def store_document_vectors(
+        self,
+        organization_id: str,
+        paper_id: str,
+        file_path: PdfSource,
+        title: str,
+        filename: Optional[str] = None
+    ) -> int:
+        """Process PDF and store vectors in Pinecone, returning the number stored (0 on failure).
+
+        file_path may also be PDF bytes or an open binary file, in which case
+        filename names the original upload.
+        """
+        if filename is None:
+            filename = os.path.basename(file_path) if isinstance(file_path, str) else "document.pdf"
         try:
             # Extract text from PDF
             text = self.extract_text_from_pdf(file_path)
             if not text.strip():
-                print(f"No text extracted from PDF: {file_path}")
-                return False
+                print(f"No text extracted from PDF: {filename}")
+                return 0
             
             # Chunk the text
             chunks = self.chunk_text(text)
             if not chunks:
                 print(f"No chunks created from text")
-                return False
+                return 0
             
             # Generate embeddings
-            embeddings = self.generate_embeddings(chunks)
+            embeddings = self.generate_embeddings(chunks, priority="ingestion")
             if not embeddings:
                 print(f"No embeddings generated")
-                return False
+                return 0
             
             # Prepare vectors for Pinecone v3
             vectors = []
@@ -139,7 +189,7 @@ class PineconeService:
                     "title": title,
                     "chunk_index": i,
                     "text": chunk,
-                    "file_path": f"org_{organization_id}/{paper_id}_{os.path.basename(file_path)}"  # Store the actual file path format
+                    "file_path": f"org_{organization_id}/{paper_id}_{filename}"  # Store the actual file path format
                 }
                 vectors.append({
                     "id": vector_id,
@@ -150,11 +200,11 @@ class PineconeService:
             # Upsert to Pinecone v3
             self.index.upsert(vectors=vectors)
             print(f"Stored {len(vectors)} vectors for paper {paper_id}")
-            return True
+            return len(vectors)
             
         except Exception as e:
             print(f"Error storing document vectors: {e}")
-            return False
+            return 0
     
     def search_similar_chunks(self, query: str, organization_id: str, top_k: int = 5) -> List[Dict[str, Any]]:
         """Search for similar chunks using vector similarity"""
@@ -221,32 +271,65 @@ class PineconeService:
             print(f"Error searching similar chunks: {e}")
             return []
     
+    def iter_vector_ids(self, prefix: Optional[str] = None) -> Iterator[List[str]]:
+        """Page through vector ids starting with prefix (all ids when None).
+
+        Uses the serverless list endpoint, so unlike a similarity query it is
+        not capped and sees every vector.
+        """
+        for page in self.index.list(prefix=prefix, limit=LIST_PAGE_SIZE):
+            if page:
+                yield list(page)
+
+    def _paper_ids_in_shard(self, prefix: str) -> Set[str]:
+        paper_ids = set()
+        for page in self.iter_vector_ids(prefix):
+            for vector_id in page:
+                paper_ids.add(paper_id_from_vector_id(vector_id))
+        return paper_ids
+
+    def list_paper_ids(self, workers: int = 8) -> Set[str]:
+        """Ids of every paper with at least one vector, listing id prefixes in parallel.
+
+        Memory grows with the number of papers, not vectors. Listing errors
+        propagate: a partial listing would make valid papers look orphaned.
+        """
+        paper_ids: Set[str] = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for shard_ids in executor.map(self._paper_ids_in_shard, VECTOR_ID_SHARDS):
+                paper_ids.update(shard_ids)
+        return paper_ids
+
+    def has_vectors(self, paper_id: str) -> bool:
+        return next(self.iter_vector_ids(vector_id_prefix(paper_id)), None) is not None
+
+    def delete_vector_ids(self, vector_ids: Iterable[str]) -> int:
+        """Delete vectors by id in batches of DELETE_BATCH_SIZE, returning how many were sent"""
+        batch: List[str] = []
+        deleted = 0
+        for vector_id in vector_ids:
+            batch.append(vector_id)
+            if len(batch) == DELETE_BATCH_SIZE:
+                self.index.delete(ids=batch)
+                deleted += len(batch)
+                batch = []
+        if batch:
+            self.index.delete(ids=batch)
+            deleted += len(batch)
+        return deleted
+
+    def delete_paper_vectors(self, paper_id: str) -> int:
+        """Delete every vector of a paper by listing its id prefix; errors propagate"""
+        return self.delete_vector_ids(
+            vector_id for page in self.iter_vector_ids(vector_id_prefix(paper_id)) for vector_id in page
+        )
+
     def delete_document_vectors(self, paper_id: str) -> bool:
         """Delete all vectors for a specific paper"""
         try:
-            # Get all vectors for this paper
-            results = self.index.query(
-                vector=[0.0] * 1536,  # Dummy vector as float
-                filter={"paper_id": paper_id},
-                top_k=10000,  # Large number to get all
-                include_metadata=False
-            )
-            
-            # Delete the vectors
-            try:
-                matches = results.matches
-                if matches:
-                    vector_ids = [match.id for match in matches]
-                    self.index.delete(ids=vector_ids)
-                    print(f"Deleted {len(vector_ids)} vectors for paper {paper_id}")
-            except AttributeError:
-                # Fallback: try to access as dictionary
-                if isinstance(results, dict) and 'matches' in results:
-                    vector_ids = [match.get('id') for match in results['matches']]
-                    if vector_ids:
-                        self.index.delete(ids=vector_ids)
-                        print(f"Deleted {len(vector_ids)} vectors for paper {paper_id}")
-            
+            deleted = self.delete_paper_vectors(paper_id)
+            if deleted:
+                print(f"Deleted {deleted} vectors for paper {paper_id}")
             return True
             
         except Exception as e:
@@ -1,17 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Tuple
+import asyncio
 import os
 import uuid
 from datetime import datetime
 from PIL import Image
 import io
 
-from database import get_db
+from database import get_async_db
 from auth import get_current_user
 from schemas import User
 from supabase_storage import SupabaseStorageService
+from access import invalidate_user
 
 router = APIRouter()
 
@@ -19,8 +21,23 @@ router = APIRouter()
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif"}
 
-# Initialize Supabase Storage service
-storage_service = SupabaseStorageService()
+# Initialize Supabase Storage service; profile images are unavailable without it
+try:
+    storage_service = SupabaseStorageService()
+except Exception as e:
+    print(f"Failed to initialize Supabase Storage service for profiles: {e}")
+    storage_service = None
+
+@router.on_event("shutdown")
+async def close_storage_client():
+    """Release pooled storage connections"""
+    if storage_service:
+        await storage_service.aclose()
+
+def require_storage_service() -> SupabaseStorageService:
+    if not storage_service:
+        raise HTTPException(status_code=500, detail="Storage service not available")
+    return storage_service
 
 def validate_image_file(file: UploadFile) -> bool:
     """Validate uploaded image file"""
@@ -34,8 +51,8 @@ def validate_image_file(file: UploadFile) -> bool:
     
     return True
 
-def process_image(image_data: bytes, filename: str) -> str:
-    """Process and save image with compression"""
+def process_image(image_data: bytes, filename: str) -> Tuple[bytes, str]:
+    """Compress an image, returning the JPEG bytes and a unique filename"""
     try:
         # Open image with PIL
         image = Image.open(io.BytesIO(image_data))
@@ -55,15 +72,7 @@ def process_image(image_data: bytes, filename: str) -> str:
         # Save compressed image to bytes
         img_byte_arr = io.BytesIO()
         image.save(img_byte_arr, format='JPEG', quality=85, optimize=True)
-        img_byte_arr = img_byte_arr.getvalue()
-        
-        # Upload to Supabase Storage
-        storage_path = storage_service.upload_profile_image(
-            file_content=img_byte_arr,
-            filename=unique_filename
-        )
-        
-        return storage_path
+        return img_byte_arr.getvalue(), unique_filename
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
 
@@ -71,10 +80,12 @@ def process_image(image_data: bytes, filename: str) -> str:
 async def upload_profile_image(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Upload and process profile image"""
     
+    storage = require_storage_service()
+    
     # Validate file
     if not validate_image_file(file):
         raise HTTPException(
@@ -98,12 +109,15 @@ async def upload_profile_image(
         # Process and save image
         if not file.filename:
             raise HTTPException(status_code=400, detail="No filename provided")
-        filename = process_image(file_content, file.filename)
+        # Decoding and resizing is CPU-bound, so keep it off the event loop
+        image_bytes, unique_filename = await asyncio.to_thread(process_image, file_content, file.filename)
+        filename = await storage.aupload_profile_image(image_bytes, unique_filename)
         
         # Update user profile in database
         current_user.profile_image_url = filename  # This is now the Supabase URL
         current_user.updated_at = datetime.utcnow()
-        db.commit()
+        await db.commit()
+        invalidate_user(current_user.id)
         
         return JSONResponse({
             "message": "Profile image uploaded successfully",
@@ -118,7 +132,7 @@ async def get_profile_image(filename: str):
     """Get profile image URL from Supabase"""
     try:
         # Get the public URL from Supabase Storage
-        public_url = storage_service.get_profile_image_url(filename)
+        public_url = require_storage_service().get_profile_image_url(filename)
         return {"url": public_url}
     except Exception as e:
         raise HTTPException(status_code=404, detail="Image not found")
@@ -128,7 +142,7 @@ async def update_profile(
     name: Optional[str] = Form(None),
     bio: Optional[str] = Form(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update user profile information"""
     
@@ -139,7 +153,8 @@ async def update_profile(
             current_user.bio = bio
         
         current_user.updated_at = datetime.utcnow()
-        db.commit()
+        await db.commit()
+        invalidate_user(current_user.id)
         
         return JSONResponse({
             "message": "Profile updated successfully",
@@ -158,7 +173,7 @@ async def update_profile(
 @router.get("/profile")
 async def get_profile(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get current user's profile"""
     
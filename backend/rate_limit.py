@@ -0,0 +1,304 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from metrics import metrics
+
+# Lower number = more important. Lower priorities may not dip into the share
+# of each bucket reserved for the priorities above them.
+PRIORITIES = {
+    "interactive": 0,
+    "ingestion": 1,
+    "maintenance": 2
+}
+PRIORITY_RESERVES = {
+    "interactive": 0.0,
+    "ingestion": 0.2,
+    "maintenance": 0.4
+}
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+
+class TokenBucket:
+    """Continuously refilling bucket; not thread-safe on its own"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, reserve: float) -> float:
+        """Seconds until amount can be taken while leaving reserve untouched"""
+        needed = amount + reserve * self.capacity - self.level
+        if needed <= 0:
+            return 0.0
+        return needed / self.rate if self.rate > 0 else BACKOFF_MAX_SECONDS
+
+    def resize(self, per_minute: float) -> None:
+        if per_minute > 0 and per_minute != self.capacity:
+            self.capacity = float(per_minute)
+            self.rate = per_minute / 60.0
+            self.level = min(self.level, self.capacity)
+
+
+class RateLimiter:
+    """Thread-safe blocking limit on operations per minute, for maintenance jobs"""
+
+    def __init__(self, per_minute: float):
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(per_minute)
+
+    def acquire(self, amount: float = 1) -> float:
+        """Block until amount can be taken; returns the time spent waiting"""
+        started = time.monotonic()
+        amount = min(amount, self._bucket.capacity)
+        while True:
+            with self._lock:
+                self._bucket.refill(time.monotonic())
+                wait = self._bucket.wait_time(amount, 0.0)
+                if wait <= 0:
+                    self._bucket.level -= amount
+                    break
+            time.sleep(min(wait, 1.0))
+        return time.monotonic() - started
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as "1s", "6m0s" or "20ms" into seconds"""
+    if not value:
+        return None
+    total = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def _rate_limit_retry_after(error: Exception) -> Optional[float]:
+    """Return the suggested wait for a 429-style error, or None for other errors"""
+    status_code = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    if status_code != 429 and type(error).__name__ != "RateLimitError":
+        return None
+
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else 0.0
+    except ValueError:
+        return 0.0
+
+
+# Besides 429s, these are worth retrying: the SDK retries them by default
+TRANSIENT_STATUS_CODES = {408, 409}
+TRANSIENT_ERROR_TYPES = {"APIConnectionError", "APITimeoutError"}
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether an error is a timeout, connection failure or server error"""
+    if type(error).__name__ in TRANSIENT_ERROR_TYPES:
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status_code, int) and (status_code in TRANSIENT_STATUS_CODES or status_code >= 500)
+
+
+class RateGovernor:
+    """Process-wide request and token budget for one OpenAI model.
+
+    Callers acquire capacity before each API call with a priority. Interactive
+    work can use the full budget, while ingestion and maintenance leave part of
+    each bucket free and also wait while more important callers are queued.
+    Budgets follow the limits reported in response headers, and 429s pause
+    everyone until the suggested retry time. OpenAI limits are per model, so
+    each model gets its own governor and only feeds it its own headers.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, name: str = "governor"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._waiting = {priority: 0 for priority in PRIORITIES}
+        self._paused_until = 0.0
+
+    def _try_acquire(self, requests: float, tokens: float, priority: str) -> float:
+        """Take capacity and return 0, or return how long to wait before retrying"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            rank = PRIORITIES[priority]
+            if any(count for other, count in self._waiting.items() if PRIORITIES[other] < rank):
+                return 0.05
+
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            reserve = PRIORITY_RESERVES[priority]
+            # A single call larger than the whole bucket can never fit; let it drain the bucket instead
+            requests = min(requests, self._requests.capacity * (1 - reserve))
+            tokens = min(tokens, self._tokens.capacity * (1 - reserve))
+            wait = max(self._requests.wait_time(requests, reserve), self._tokens.wait_time(tokens, reserve))
+            if wait > 0:
+                return wait
+
+            self._requests.level -= requests
+            self._tokens.level -= tokens
+            return 0.0
+
+    def _set_waiting(self, priority: str, delta: int) -> None:
+        with self._lock:
+            self._waiting[priority] += delta
+
+    def acquire(self, tokens: float, priority: str = "interactive", requests: float = 1) -> float:
+        """Block until capacity is available; returns the time spent waiting"""
+        started = time.monotonic()
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                wait = self._try_acquire(requests, tokens, priority)
+                if wait <= 0:
+                    break
+                time.sleep(min(wait, 1.0))
+        finally:
+            self._set_waiting(priority, -1)
+        waited = time.monotonic() - started
+        metrics.observe(f"openai.{self.name}.wait.{priority}", waited)
+        return waited
+
+    async def acquire_async(self, tokens: float, priority: str = "interactive", requests: float = 1) -> float:
+        """Async variant of acquire that sleeps on the event loop instead of blocking it"""
+        started = time.monotonic()
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                wait = self._try_acquire(requests, tokens, priority)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            self._set_waiting(priority, -1)
+        waited = time.monotonic() - started
+        metrics.observe(f"openai.{self.name}.wait.{priority}", waited)
+        return waited
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Adapt budgets to the x-ratelimit-* headers of an OpenAI response"""
+        def number(name: str) -> Optional[float]:
+            try:
+                value = headers.get(name)
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                limit = number(f"x-ratelimit-limit-{kind}")
+                remaining = number(f"x-ratelimit-remaining-{kind}")
+                if limit:
+                    bucket.resize(limit)
+                if remaining is not None:
+                    bucket.refill(now)
+                    # Other processes share the quota; never believe we have more than the server says
+                    bucket.level = min(bucket.level, remaining)
+                    if remaining <= 0:
+                        reset = _parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                        if reset:
+                            self._paused_until = max(self._paused_until, now + reset)
+
+    def pause(self, seconds: float) -> None:
+        """Hold all callers back, e.g. after a 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _backoff(self, attempt: int, retry_after: float) -> float:
+        # Full jitter keeps retrying callers from synchronizing
+        backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        return max(retry_after, backoff)
+
+    def _retry_delay(self, error: Exception, attempt: int, priority: str) -> Optional[float]:
+        """Seconds to wait before retrying a failed call, or None if it should raise"""
+        if attempt == MAX_RETRIES:
+            return None
+        retry_after = _rate_limit_retry_after(error)
+        if retry_after is not None:
+            delay = self._backoff(attempt, retry_after)
+            metrics.increment(f"openai.{self.name}.rate_limited.{priority}")
+            print(f"OpenAI rate limited ({self.name}, {priority}), retrying in {delay:.1f}s")
+            self.pause(retry_after)
+            return delay
+        if _is_transient(error):
+            # Only this caller backs off; a server error says nothing about the quota
+            delay = self._backoff(attempt, 0.0)
+            metrics.increment(f"openai.{self.name}.transient_error.{priority}")
+            print(f"OpenAI call failed ({self.name}, {priority}): {error}; retrying in {delay:.1f}s")
+            return delay
+        return None
+
+    def call(self, fn: Callable[[], Any], tokens: float, priority: str = "interactive", requests: float = 1) -> Any:
+        """Run a blocking API call under the governor, retrying rate limits and transient errors with backoff"""
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(tokens, priority, requests)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, priority)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], tokens: float, priority: str = "interactive", requests: float = 1) -> Any:
+        """Async variant of call"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.acquire_async(tokens, priority, requests)
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, priority)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            return {
+                "requests_available": round(self._requests.level, 1),
+                "requests_per_minute": self._requests.capacity,
+                "tokens_available": round(self._tokens.level, 1),
+                "tokens_per_minute": self._tokens.capacity,
+                "waiting": dict(self._waiting),
+                "paused_for_seconds": round(max(0.0, self._paused_until - now), 2)
+            }
+
+
+# Chat completions made by PaperQA
+openai_governor = RateGovernor(
+    requests_per_minute=float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "3000")),
+    tokens_per_minute=float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "1000000"))
+)
+
+# Embedding calls: ada-002 for retrieval and ingestion, plus PaperQA's chunk embeddings
+embedding_governor = RateGovernor(
+    requests_per_minute=float(os.getenv("OPENAI_EMBEDDING_REQUESTS_PER_MINUTE", "3000")),
+    tokens_per_minute=float(os.getenv("OPENAI_EMBEDDING_TOKENS_PER_MINUTE", "1000000")),
+    name="embedding_governor"
+)
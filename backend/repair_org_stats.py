@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from typing import Dict, List
+from database import engine, Organization, OrganizationStats
+from org_stats import COUNTERS, combine_source_counts, empty_counts, source_count_statements
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class OrganizationStatsRepair:
+    """Recompute organization_stats from papers and memberships.
+
+    Counters are kept in step by the request handlers; this fixes drift from
+    failed requests, manual edits or rows that predate the table, and fills
+    in the counters when the table is first created.
+    """
+
+    def __init__(self):
+        self.engine = engine
+
+    def repair(self, dry_run: bool = True) -> Dict[str, object]:
+        print("Checking organization counters...")
+        if dry_run:
+            print("(DRY RUN - No changes will be made)")
+
+        with Session(self.engine) as db:
+            papers, memberships = source_count_statements()
+            expected = combine_source_counts(db.execute(papers).all(), db.execute(memberships).all())
+            stored = {stats.organization_id: stats for stats in db.scalars(select(OrganizationStats))}
+            organization_ids = db.scalars(select(Organization.id)).all()
+
+            drifted: List[Dict[str, object]] = []
+            created = 0
+            for org_id in organization_ids:
+                counts = expected.get(org_id, empty_counts())
+                stats = stored.get(org_id)
+                if stats is None:
+                    created += 1
+                    if not dry_run:
+                        db.add(OrganizationStats(organization_id=org_id, **counts))
+                    continue
+                differences = {
+                    name: {"stored": getattr(stats, name), "actual": counts[name]}
+                    for name in COUNTERS
+                    if getattr(stats, name) != counts[name]
+                }
+                if differences:
+                    print(f"  Organization {org_id}: {differences}")
+                    drifted.append({"organization_id": str(org_id), "differences": differences})
+                    if not dry_run:
+                        for name in COUNTERS:
+                            setattr(stats, name, counts[name])
+
+            if not dry_run:
+                db.commit()
+
+        print(f"  Missing counter rows: {created}")
+        print(f"  Organizations with drifted counters: {len(drifted)}")
+        return {
+            "organizations": len(organization_ids),
+            "created": created,
+            "drifted": drifted
+        }
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recompute per-organization counters from the source tables")
+    parser.add_argument("--dry-run", action="store_true", default=True,
+                       help="Show what would be done without making changes (default: True)")
+    parser.add_argument("--execute", action="store_true",
+                       help="Actually write the corrected counters")
+
+    args = parser.parse_args()
+
+    if args.execute:
+        args.dry_run = False
+
+    results = OrganizationStatsRepair().repair(dry_run=args.dry_run)
+    if args.dry_run:
+        print("To apply these changes, run with --execute flag")
+    else:
+        print(f"Repair completed: {results['created']} created, {len(results['drifted'])} corrected")
+
+if __name__ == "__main__":
+    main()
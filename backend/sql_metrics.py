@@ -0,0 +1,206 @@
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from metrics import metrics
+
+# Log statements slower than this many milliseconds; 0 disables the slow-query log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+# Distinct normalized statements tracked; the cheapest are dropped beyond this
+MAX_TRACKED_STATEMENTS = 500
+TOP_STATEMENTS = 20
+MAX_STATEMENT_LENGTH = 2000
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|\$\d+|\?|\b\d+(?:\.\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(statement: str) -> str:
+    """Collapse literals, bind placeholders and IN lists so equivalent statements group together"""
+    normalized = _LITERAL.sub("?", statement)
+    normalized = _VALUE_LIST.sub("(...)", normalized)
+    normalized = _WHITESPACE.sub(" ", normalized).strip()
+    return normalized[:MAX_STATEMENT_LENGTH]
+
+
+class _StatementStats:
+    __slots__ = ("count", "total", "max", "errors")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def summary(self, sql: str) -> Dict[str, Any]:
+        return {
+            "sql": sql,
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total * 1000, 2),
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 2)
+        }
+
+
+class _PoolState:
+    __slots__ = ("engine", "checked_out", "peak_checked_out", "timeouts")
+
+    def __init__(self, engine: Engine):
+        # engine.pool is replaced by dispose(), so always read it through the engine
+        self.engine = engine
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.timeouts = 0
+
+    def capacity(self) -> Optional[int]:
+        # Only queue pools have a fixed capacity (size + max_overflow)
+        size = getattr(self.engine.pool, "size", None)
+        max_overflow = getattr(self.engine.pool, "_max_overflow", None)
+        if not callable(size) or max_overflow is None or max_overflow < 0:
+            return None
+        return size() + max_overflow
+
+
+class SqlInstrumentation:
+    """Statement latency, slowest normalized statements and pool usage per engine.
+
+    Timings go to the shared metrics registry as db.<engine>.statement and
+    db.<engine>.pool.checkout_wait; stats() adds the per-statement breakdown
+    and the current pool saturation for the admin metrics endpoint.
+    """
+
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._statements: Dict[str, _StatementStats] = {}
+        self._pools: Dict[str, _PoolState] = {}
+
+    def instrument(self, engine: Engine, name: str) -> None:
+        """Attach statement and pool event hooks; pass async engines' sync_engine"""
+        state = _PoolState(engine)
+        self._pools[name] = state
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info["query_started"].pop()
+            self._record(name, statement, time.perf_counter() - started)
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(context):
+            started = context.connection.info.get("query_started") if context.connection else None
+            if started:
+                started.pop()
+            metrics.increment(f"db.{name}.errors")
+            if context.statement:
+                with self._lock:
+                    stats = self._statements.get(normalize_sql(context.statement))
+                    if stats is not None:
+                        stats.errors += 1
+
+        @event.listens_for(engine.pool, "checkout")
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                state.checked_out += 1
+                state.peak_checked_out = max(state.peak_checked_out, state.checked_out)
+
+        @event.listens_for(engine.pool, "checkin")
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                state.checked_out = max(0, state.checked_out - 1)
+
+        @event.listens_for(engine.pool, "connect")
+        def connect(dbapi_connection, connection_record):
+            metrics.increment(f"db.{name}.pool.connects")
+
+    def timed_pool_class(self, pool_class, name: str):
+        """Subclass of pool_class that records how long checkouts wait for a connection"""
+        instrumentation = self
+
+        class TimedPool(pool_class):
+            def _do_get(self):
+                started = time.perf_counter()
+                try:
+                    return super()._do_get()
+                except PoolTimeoutError:
+                    instrumentation._pool_timeout(name)
+                    raise
+                finally:
+                    metrics.observe(f"db.{name}.pool.checkout_wait", time.perf_counter() - started)
+
+        TimedPool.__name__ = f"Timed{pool_class.__name__}"
+        return TimedPool
+
+    def _pool_timeout(self, name: str) -> None:
+        metrics.increment(f"db.{name}.pool.timeouts")
+        with self._lock:
+            state = self._pools.get(name)
+            if state is not None:
+                state.timeouts += 1
+
+    def _record(self, name: str, statement: str, seconds: float) -> None:
+        metrics.observe(f"db.{name}.statement", seconds)
+        sql = normalize_sql(statement)
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                if len(self._statements) >= MAX_TRACKED_STATEMENTS:
+                    cheapest = min(self._statements, key=lambda key: self._statements[key].total)
+                    del self._statements[cheapest]
+                stats = self._statements[sql] = _StatementStats()
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+
+        if self.slow_query_ms and seconds * 1000 >= self.slow_query_ms:
+            metrics.increment(f"db.{name}.slow_queries")
+            print(f"Slow query on {name} ({seconds * 1000:.1f} ms): {sql}")
+
+    def pool_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for name, state in self._pools.items():
+                capacity = state.capacity()
+                result[name] = {
+                    "pool": type(state.engine.pool).__name__,
+                    "status": state.engine.pool.status(),
+                    "checked_out": state.checked_out,
+                    "peak_checked_out": state.peak_checked_out,
+                    "capacity": capacity,
+                    "saturation": round(state.checked_out / capacity, 3) if capacity else None,
+                    "timeouts": state.timeouts
+                }
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            statements = list(self._statements.items())
+        by_total: List[Dict[str, Any]] = [
+            stats.summary(sql)
+            for sql, stats in sorted(statements, key=lambda item: item[1].total, reverse=True)[:TOP_STATEMENTS]
+        ]
+        by_max: List[Dict[str, Any]] = [
+            stats.summary(sql)
+            for sql, stats in sorted(statements, key=lambda item: item[1].max, reverse=True)[:TOP_STATEMENTS]
+        ]
+        return {
+            "slow_query_ms": self.slow_query_ms,
+            "tracked_statements": len(statements),
+            "top_by_total_time": by_total,
+            "slowest": by_max,
+            "pools": self.pool_stats()
+        }
+
+
+sql_metrics = SqlInstrumentation()
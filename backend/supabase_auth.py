@@ -1,8 +1,16 @@
 from supabase import create_client, Client
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
-from database import get_db, User, Organization, Membership, UserRole, MembershipRole, MembershipStatus
+from sqlalchemy import select
+from jose import jwt, JWTError
+from database import AsyncSessionLocal, User, Organization, OrganizationStats, Membership, UserRole, MembershipRole, MembershipStatus, SUPABASE_JWT_SECRET
+from cache import TTLCache
+from access import load_user
+from pagination import paginate
+from metrics import metrics
+import asyncio
+import hashlib
 import os
+import time
 from typing import Optional
 from datetime import datetime
 import uuid
@@ -15,6 +23,78 @@ if not supabase_url or not supabase_key:
 
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# Supabase access tokens are HS256 JWTs signed with the project secret and audience "authenticated"
+JWT_AUDIENCE = "authenticated"
+LOCAL_JWT_ALGORITHMS = ["HS256"]
+
+# Verified token -> user id, so repeat requests skip verification entirely
+AUTH_TOKEN_CACHE_SECONDS = float(os.getenv("AUTH_TOKEN_CACHE_SECONDS", "300"))
+verified_token_cache = TTLCache(max_entries=50000, ttl=AUTH_TOKEN_CACHE_SECONDS)
+
+def _invalid_token() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid token"
+    )
+
+def _token_key(access_token: str) -> str:
+    # Keep raw bearer tokens out of process memory dumps of the cache
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+async def verify_access_token(access_token: str) -> str:
+    """Return the user id of a valid Supabase access token or raise 401.
+
+    Tokens are verified locally against SUPABASE_JWT_SECRET (signature, exp
+    and aud). Supabase is only asked when no secret is configured or the
+    token uses a signing algorithm we cannot check locally.
+    """
+    cache_key = _token_key(access_token)
+    user_id = verified_token_cache.get(cache_key)
+    if user_id is not None:
+        metrics.increment("auth.token.cached")
+        return user_id
+
+    try:
+        header = jwt.get_unverified_header(access_token)
+        unverified_claims = jwt.get_unverified_claims(access_token)
+    except JWTError:
+        raise _invalid_token()
+
+    if SUPABASE_JWT_SECRET and header.get("alg") in LOCAL_JWT_ALGORITHMS:
+        try:
+            claims = jwt.decode(
+                access_token,
+                SUPABASE_JWT_SECRET,
+                algorithms=LOCAL_JWT_ALGORITHMS,
+                audience=JWT_AUDIENCE
+            )
+        except JWTError as e:
+            metrics.increment("auth.token.rejected")
+            print(f"Rejected access token: {e}")
+            raise _invalid_token()
+        user_id = claims.get("sub")
+        metrics.increment("auth.token.local")
+    else:
+        # get_user(jwt=...) checks the token without touching the shared client's session
+        try:
+            response = await asyncio.to_thread(supabase.auth.get_user, access_token)
+        except Exception as e:
+            print(f"Remote token check failed: {e}")
+            raise _invalid_token()
+        user_id = response.user.id if response and response.user else None
+        metrics.increment("auth.token.remote")
+
+    if not user_id:
+        raise _invalid_token()
+
+    # Never cache a token past its own expiry
+    expires_at = unverified_claims.get("exp")
+    ttl = None
+    if isinstance(expires_at, (int, float)):
+        ttl = min(AUTH_TOKEN_CACHE_SECONDS, expires_at - time.time())
+    verified_token_cache.set(cache_key, str(user_id), ttl=ttl)
+    return str(user_id)
+
 class SupabaseAuth:
     @staticmethod
     async def sign_up(email: str, password: str, name: Optional[str] = None):
@@ -33,7 +113,7 @@ class SupabaseAuth:
             
             if response.user:
                 print(f"Creating user in database with ID: {response.user.id}")
-                db = next(get_db())
+                db = AsyncSessionLocal()
                 try:
                     user = User(
                         id=uuid.UUID(response.user.id),
@@ -44,9 +124,9 @@ class SupabaseAuth:
                     print(f"User object created: {user}")
                     db.add(user)
                     print("User added to session")
-                    db.commit()
+                    await db.commit()
                     print("Database committed successfully")
-                    db.refresh(user)
+                    await db.refresh(user)
                     print(f"User refreshed: {user}")
                     
                     return {
@@ -57,7 +137,7 @@ class SupabaseAuth:
                 except Exception as e:
                     print(f"Database error creating user: {str(e)}")
                     print(f"Error type: {type(e)}")
-                    db.rollback()
+                    await db.rollback()
                     try:
                         supabase.auth.admin.delete_user(response.user.id)
                         print("Supabase auth user deleted")
@@ -68,7 +148,7 @@ class SupabaseAuth:
                         detail=f"Failed to create user: {str(e)}"
                     )
                 finally:
-                    db.close()
+                    await db.close()
             else:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -98,9 +178,9 @@ class SupabaseAuth:
             })
             
             if response.user and response.session:
-                db = next(get_db())
+                db = AsyncSessionLocal()
                 try:
-                    user = db.query(User).filter(User.id == response.user.id).first()
+                    user = await db.get(User, uuid.UUID(response.user.id))
                     if not user:
                         raise HTTPException(
                             status_code=status.HTTP_404_NOT_FOUND,
@@ -113,7 +193,7 @@ class SupabaseAuth:
                         "access_token": response.session.access_token
                     }
                 finally:
-                    db.close()
+                    await db.close()
             else:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
@@ -134,41 +214,33 @@ class SupabaseAuth:
     @staticmethod
     async def get_user_by_token(access_token: str):
         """Get user from access token"""
+        user_id = await verify_access_token(access_token)
+        
+        db = AsyncSessionLocal()
         try:
-            supabase.auth.set_session(access_token, access_token)
-            response = supabase.auth.get_user()
-
-            if not response or not response.user:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid token"
-                )
-
-            db = next(get_db())
-            try:
-                db_user = db.query(User).filter(User.id == response.user.id).first()
-                if not db_user:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail="User not found"
-                    )
-                return db_user
-            finally:
-                db.close()
-                
+            db_user = await load_user(db, user_id)
         except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token"
-            )
+            print(f"Error loading user {user_id}: {e}")
+            raise _invalid_token()
+        finally:
+            await db.close()
+        
+        if not db_user:
+            print(f"No database user for token subject {user_id}")
+            raise _invalid_token()
+        return db_user
 
 
     @staticmethod
     async def sign_out(access_token: str):
-        """Sign out user"""
+        """Sign out user.
+
+        The logout call is authorized by the user's own token, so the shared
+        client's session is never set and concurrent requests cannot pick it up.
+        """
         try:
-            supabase.auth.set_session(access_token, access_token)
-            supabase.auth.sign_out()
+            await asyncio.to_thread(supabase.auth.admin.sign_out, access_token)
+            verified_token_cache.invalidate(_token_key(access_token))
             return {"message": "Signed out successfully"}
         except Exception as e:
             raise HTTPException(
@@ -191,7 +263,7 @@ class SupabaseAuth:
     @staticmethod
     async def create_organization(user_id: str, organization_name: str):
         """Create a new organization and add user as admin"""
-        db = next(get_db())
+        db = AsyncSessionLocal()
         try:
             organization = Organization(
                 id=uuid.uuid4(),
@@ -199,8 +271,8 @@ class SupabaseAuth:
                 created_by=uuid.UUID(user_id)
             )
             db.add(organization)
-            db.commit()
-            db.refresh(organization)
+            await db.commit()
+            await db.refresh(organization)
             
             membership = Membership(
                 id=uuid.uuid4(),
@@ -211,40 +283,49 @@ class SupabaseAuth:
                 approved_at=datetime.utcnow()
             )
             db.add(membership)
-            db.commit()
+            db.add(OrganizationStats(organization_id=organization.id, approved_member_count=1))
+            await db.commit()
             
             return organization
             
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Failed to create organization: {str(e)}"
             )
         finally:
-            db.close()
+            await db.close()
 
     @staticmethod
-    async def get_user_organizations(user_id: str):
-        """Get all organizations a user belongs to"""
-        db = next(get_db())
+    async def get_user_organizations(user_id: str, cursor: Optional[str] = None, limit: Optional[int] = None):
+        """Get organizations a user belongs to, with the cursor for the next page"""
+        db = AsyncSessionLocal()
         try:
-            memberships = db.query(Membership).filter(
-                Membership.user_id == uuid.UUID(user_id),
-                Membership.status == MembershipStatus.APPROVED
-            ).all()
+            rows, next_cursor = await paginate(
+                db,
+                select(Membership, Organization).join(
+                    Organization, Organization.id == Membership.organization_id
+                ).where(
+                    Membership.user_id == uuid.UUID(user_id),
+                    Membership.status == MembershipStatus.APPROVED
+                ),
+                columns=(Membership.requested_at, Membership.id),
+                key=lambda row: (row[0].requested_at, row[0].id),
+                cursor=cursor,
+                limit=limit
+            )
             
-            organizations = []
-            for membership in memberships:
-                org = db.query(Organization).filter(Organization.id == membership.organization_id).first()
-                if org:
-                    organizations.append({
-                        "organization": org,
-                        "role": membership.role_in_org,
-                        "joined_at": membership.approved_at
-                    })
+            organizations = [
+                {
+                    "organization": org,
+                    "role": membership.role_in_org,
+                    "joined_at": membership.approved_at
+                }
+                for membership, org in rows
+            ]
             
-            return organizations
+            return organizations, next_cursor
             
         finally:
-            db.close() 
\ No newline at end of file
+            await db.close() 
\ No newline at end of file
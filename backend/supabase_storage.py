@@ -1,43 +1,110 @@
 import os
 import uuid
-from typing import Optional
-import tempfile
+import asyncio
+import random
+import re
+from datetime import datetime, timezone
+from typing import Optional, AsyncIterator, AsyncIterable, Iterable, Iterator, List, Union
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pool, timeout and retry settings shared by the sync and async clients
+STORAGE_CONNECT_TIMEOUT = float(os.getenv("STORAGE_CONNECT_TIMEOUT", "5"))
+STORAGE_TIMEOUT = float(os.getenv("STORAGE_TIMEOUT", "60"))
+STORAGE_MAX_RETRIES = int(os.getenv("STORAGE_MAX_RETRIES", "3"))
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "20"))
+STORAGE_CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Objects per list request and paths per bulk delete request
+STORAGE_LIST_PAGE_SIZE = 1000
+STORAGE_DELETE_BATCH_SIZE = 100
+
+def parse_storage_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Storage API timestamps ("2024-05-01T12:00:00.123Z") as naive UTC, like the database columns"""
+    if not value:
+        return None
+    # fromisoformat before Python 3.11 wants "+00:00" and exactly 3 or 6 fraction digits
+    normalized = re.sub(r"Z$", "+00:00", value)
+    normalized = re.sub(r"\.(\d+)", lambda match: "." + match.group(1)[:6].ljust(6, "0"), normalized)
+    parsed = datetime.fromisoformat(normalized)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
 class SupabaseStorageService:
     def __init__(self):
         self.supabase_url = os.getenv("SUPABASE_URL")
-        # Use service role key for backend operations (bypasses RLS)
-        self.supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
+        # Use service role key for backend operations (bypasses RLS); the anon key cannot write or delete
+        self.supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
         
         if not self.supabase_url or not self.supabase_key:
             raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set in environment variables")
         
         self.bucket_name = "uploadedpdfs"
         self.storage_url = f"{self.supabase_url}/storage/v1"
+        self.timeout = (STORAGE_CONNECT_TIMEOUT, STORAGE_TIMEOUT)
+        
+        # Keep-alive session for the sync facade (scripts like sync_databases.py); urllib3 does its retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=STORAGE_POOL_SIZE,
+            pool_maxsize=STORAGE_POOL_SIZE,
+            max_retries=Retry(
+                total=STORAGE_MAX_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "HEAD", "DELETE"])
+            )
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self._auth_headers())
+        
+        # Pooled async client for request handlers so transfers never block the event loop;
+        # _arequest is its only retry layer
+        self.async_client = httpx.AsyncClient(
+            headers=self._auth_headers(),
+            timeout=httpx.Timeout(STORAGE_TIMEOUT, connect=STORAGE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=STORAGE_POOL_SIZE,
+                max_keepalive_connections=STORAGE_POOL_SIZE
+            )
+        )
         self._ensure_bucket_exists()
     
+    def _auth_headers(self) -> dict:
+        return {
+            "apikey": self.supabase_key,
+            "Authorization": f"Bearer {self.supabase_key}"
+        }
+    
+    def _object_url(self, file_path: str, bucket: Optional[str] = None) -> str:
+        return f"{self.storage_url}/object/{bucket or self.bucket_name}/{file_path}"
+    
+    def _absolute_signed_url(self, result: dict) -> str:
+        """Signed URLs come back relative to the storage API; make them usable by browsers"""
+        signed_url = result.get("signedURL") or result.get("signedUrl") or ""
+        if signed_url and not signed_url.startswith("http"):
+            signed_url = f"{self.storage_url}{signed_url}"
+        return signed_url
+    
     def _ensure_bucket_exists(self):
         """Ensure the storage bucket exists"""
         try:
             # Check if bucket exists
-            response = requests.get(
+            response = self.session.get(
                 f"{self.storage_url}/bucket/{self.bucket_name}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                }
+                timeout=self.timeout
             )
             
             if response.status_code == 404:
                 # Create bucket
-                create_response = requests.post(
+                create_response = self.session.post(
                     f"{self.storage_url}/bucket",
-                    headers={
-                        "apikey": self.supabase_key,
-                        "Authorization": f"Bearer {self.supabase_key}",
-                        "Content-Type": "application/json"
-                    },
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout,
                     json={
                         "id": self.bucket_name,
                         "public": False
@@ -68,13 +135,10 @@ class SupabaseStorageService:
             print(f"🔍 Debug: Organization ID: {organization_id}")
             
             # Upload to Supabase Storage
-            response = requests.post(
+            response = self.session.post(
                 f"{self.storage_url}/object/{self.bucket_name}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}",
-                    "Content-Type": "application/pdf"
-                },
+                headers={"Content-Type": "application/pdf"},
+                timeout=self.timeout,
                 data=file_content
             )
             
@@ -95,12 +159,9 @@ class SupabaseStorageService:
         """Download a PDF file from Supabase Storage"""
         try:
             # Download from Supabase Storage
-            response = requests.get(
+            response = self.session.get(
                 f"{self.storage_url}/object/{self.bucket_name}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                }
+                timeout=self.timeout
             )
             
             if response.status_code == 200:
@@ -117,13 +178,10 @@ class SupabaseStorageService:
         """Get a signed URL for PDF access"""
         try:
             # Generate signed URL for secure access
-            response = requests.post(
+            response = self.session.post(
                 f"{self.storage_url}/object/sign/{self.bucket_name}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}",
-                    "Content-Type": "application/json"
-                },
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout,
                 json={
                     "expiresIn": expires_in
                 }
@@ -131,7 +189,7 @@ class SupabaseStorageService:
             
             if response.status_code == 200:
                 result = response.json()
-                return result.get("signedURL", "")
+                return self._absolute_signed_url(result)
             else:
                 raise Exception(f"Failed to generate signed URL: {response.text}")
                 
@@ -143,12 +201,9 @@ class SupabaseStorageService:
         """Delete a PDF file from Supabase Storage"""
         try:
             # Delete from Supabase Storage
-            response = requests.delete(
+            response = self.session.delete(
                 f"{self.storage_url}/object/{self.bucket_name}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                }
+                timeout=self.timeout
             )
             
             if response.status_code == 200:
@@ -162,43 +217,99 @@ class SupabaseStorageService:
             print(f"❌ Error deleting PDF: {e}")
             return False
     
-    def list_organization_pdfs(self, organization_id: str) -> list:
-        """List all PDFs for an organization"""
-        try:
-            # List files in organization folder
-            response = requests.get(
+    def iter_objects(self, prefix: str = "", sort_by: str = "name", order: str = "asc") -> Iterator[dict]:
+        """Page through the objects and folders directly under prefix.
+
+        Folders come back with a null "id". Errors raise instead of ending the
+        listing early, so callers never mistake a failed page for the end.
+        """
+        offset = 0
+        while True:
+            response = self.session.post(
                 f"{self.storage_url}/object/list/{self.bucket_name}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                },
-                params={
-                    "prefix": f"org_{organization_id}/",
-                    "limit": 100
+                timeout=self.timeout,
+                json={
+                    "prefix": prefix,
+                    "limit": STORAGE_LIST_PAGE_SIZE,
+                    "offset": offset,
+                    "sortBy": {"column": sort_by, "order": order}
                 }
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return [item["name"] for item in result.get("data", [])]
-            else:
-                print(f"⚠️  List failed: {response.text}")
-                return []
-                
+            if response.status_code != 200:
+                raise Exception(f"List failed: {response.text}")
+            items = response.json()
+            yield from items
+            if len(items) < STORAGE_LIST_PAGE_SIZE:
+                return
+            offset += len(items)
+    
+    def list_organization_folders(self) -> List[str]:
+        """Organization ids that have a folder in the bucket"""
+        return [
+            item["name"][len("org_"):]
+            for item in self.iter_objects()
+            if item.get("id") is None and item["name"].startswith("org_")
+        ]
+    
+    def iter_organization_pdfs(self, organization_id: str, created_after: Optional[datetime] = None) -> Iterator[dict]:
+        """Stored PDFs of an organization as {"path", "size", "created_at"}, newest first.
+
+        With created_after, listing stops at the first older object instead
+        of paging through the whole folder.
+        """
+        folder = f"org_{organization_id}/"
+        for item in self.iter_objects(folder, sort_by="created_at", order="desc"):
+            if item.get("id") is None:
+                continue
+            created_at = parse_storage_timestamp(item.get("created_at"))
+            if created_after is not None and created_at is not None and created_at < created_after:
+                return
+            yield {
+                "path": folder + item["name"],
+                "size": (item.get("metadata") or {}).get("size"),
+                "created_at": created_at
+            }
+    
+    def list_organization_pdfs(self, organization_id: str) -> list:
+        """List all PDFs for an organization"""
+        try:
+            return [item["path"].rsplit("/", 1)[-1] for item in self.iter_organization_pdfs(organization_id)]
         except Exception as e:
             print(f"❌ Error listing PDFs: {e}")
             return []
     
+    def delete_pdfs(self, file_paths: Iterable[str]) -> int:
+        """Delete PDFs in bulk requests of STORAGE_DELETE_BATCH_SIZE, returning how many were removed"""
+        paths = list(file_paths)
+        deleted = 0
+        for start in range(0, len(paths), STORAGE_DELETE_BATCH_SIZE):
+            response = self.session.delete(
+                f"{self.storage_url}/object/{self.bucket_name}",
+                timeout=self.timeout,
+                json={"prefixes": paths[start:start + STORAGE_DELETE_BATCH_SIZE]}
+            )
+            if response.status_code != 200:
+                raise Exception(f"Bulk delete failed: {response.text}")
+            deleted += len(response.json())
+        return deleted
+    
+    def pdf_exists(self, file_path: str) -> bool:
+        """Whether a PDF is stored; unlike get_pdf_info, errors other than not-found raise"""
+        response = self.session.head(self._object_url(file_path), timeout=self.timeout)
+        if 200 <= response.status_code < 300:
+            return True
+        # Only an explicit not-found means missing; anything else could delete a stored paper
+        if response.status_code == 404:
+            return False
+        raise Exception(f"Existence check failed for {file_path}: HTTP {response.status_code}")
+    
     def get_pdf_info(self, file_path: str) -> Optional[dict]:
         """Get information about a PDF file"""
         try:
             # Get file info
-            response = requests.head(
+            response = self.session.head(
                 f"{self.storage_url}/object/{self.bucket_name}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                }
+                timeout=self.timeout
             )
             
             if response.status_code == 200:
@@ -214,6 +325,147 @@ class SupabaseStorageService:
             print(f"❌ Error getting PDF info: {e}")
             return None
 
+    async def _arequest(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request on the pooled async client, retrying idempotent calls on transient failures"""
+        retryable = method in ("GET", "HEAD", "DELETE")
+        for attempt in range(STORAGE_MAX_RETRIES + 1):
+            try:
+                response = await self.async_client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if not retryable or attempt == STORAGE_MAX_RETRIES:
+                    raise
+            else:
+                if not retryable or response.status_code not in RETRY_STATUSES or attempt == STORAGE_MAX_RETRIES:
+                    return response
+            await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+    
+    async def aupload_pdf(
+        self,
+        file_content: Union[bytes, AsyncIterable[bytes]],
+        filename: str,
+        organization_id: str,
+        content_length: Optional[int] = None
+    ) -> str:
+        """Upload a PDF to Supabase Storage without blocking the event loop.
+
+        file_content may be bytes or an async iterable of chunks, which is
+        streamed to storage without being assembled in memory.
+        """
+        try:
+            # Generate unique filename
+            unique_filename = f"{uuid.uuid4()}_{filename}"
+            
+            # Create organization-specific path with org_ prefix to match RLS policy
+            file_path = f"org_{organization_id}/{unique_filename}"
+            
+            headers = {"Content-Type": "application/pdf"}
+            if content_length is not None:
+                headers["Content-Length"] = str(content_length)
+            
+            response = await self._arequest(
+                "POST",
+                self._object_url(file_path),
+                headers=headers,
+                content=file_content
+            )
+            
+            if response.status_code == 200:
+                print(f"✅ PDF uploaded successfully: {file_path}")
+                return file_path
+            else:
+                raise Exception(f"Upload failed: {response.text}")
+                
+        except Exception as e:
+            print(f"❌ Error uploading PDF: {e}")
+            raise
+    
+    async def adownload_pdf(self, file_path: str) -> bytes:
+        """Download a PDF file from Supabase Storage without blocking the event loop"""
+        try:
+            response = await self._arequest("GET", self._object_url(file_path))
+            
+            if response.status_code == 200:
+                print(f"✅ PDF downloaded successfully: {file_path}")
+                return response.content
+            else:
+                raise Exception(f"Download failed: {response.text}")
+                
+        except Exception as e:
+            print(f"❌ Error downloading PDF: {e}")
+            raise
+    
+    async def astream_pdf(self, file_path: str, chunk_size: int = STORAGE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """Stream a PDF from Supabase Storage chunk by chunk"""
+        async with self.async_client.stream("GET", self._object_url(file_path)) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise Exception(f"Download failed: {body.decode(errors='replace')}")
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+    
+    async def aget_pdf_url(self, file_path: str, expires_in: int = 3600) -> str:
+        """Get a signed URL for PDF access without blocking the event loop"""
+        try:
+            response = await self._arequest(
+                "POST",
+                f"{self.storage_url}/object/sign/{self.bucket_name}/{file_path}",
+                json={
+                    "expiresIn": expires_in
+                }
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                return self._absolute_signed_url(result)
+            else:
+                raise Exception(f"Failed to generate signed URL: {response.text}")
+                
+        except Exception as e:
+            print(f"❌ Error generating signed URL: {e}")
+            raise
+    
+    async def adelete_pdf(self, file_path: str) -> bool:
+        """Delete a PDF file from Supabase Storage without blocking the event loop"""
+        try:
+            response = await self._arequest("DELETE", self._object_url(file_path))
+            
+            if response.status_code == 200:
+                print(f"✅ PDF deleted successfully: {file_path}")
+                return True
+            else:
+                print(f"⚠️  Delete failed: {response.text}")
+                return False
+                
+        except Exception as e:
+            print(f"❌ Error deleting PDF: {e}")
+            return False
+    
+    async def aupload_profile_image(self, file_content: bytes, filename: str) -> str:
+        """Upload a profile image to Supabase Storage without blocking the event loop"""
+        try:
+            file_path = f"profiles/{filename}"
+            response = await self._arequest(
+                "POST",
+                f"{self.storage_url}/object/profilepictures/{file_path}",
+                headers={"Content-Type": "image/jpeg"},
+                content=file_content
+            )
+            
+            if response.status_code == 200:
+                print(f"✅ Profile image uploaded successfully: {file_path}")
+                return file_path
+            else:
+                raise Exception(f"Profile image upload failed: {response.text}")
+                
+        except Exception as e:
+            print(f"❌ Error uploading profile image: {e}")
+            raise
+    
+    async def aclose(self):
+        """Close pooled connections"""
+        await self.async_client.aclose()
+        self.session.close()
+
     def upload_profile_image(self, file_content: bytes, filename: str) -> str:
         """Upload a profile image to Supabase Storage"""
         try:
@@ -226,13 +478,10 @@ class SupabaseStorageService:
             print(f"🔍 Debug: Uploading profile image to path: {file_path}")
             
             # Upload to Supabase Storage
-            response = requests.post(
+            response = self.session.post(
                 f"{self.storage_url}/object/{profile_bucket}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}",
-                    "Content-Type": "image/jpeg"
-                },
+                headers={"Content-Type": "image/jpeg"},
+                timeout=self.timeout,
                 data=file_content
             )
             
@@ -272,12 +521,9 @@ class SupabaseStorageService:
             profile_bucket = "profilepictures"
             
             # Delete from Supabase Storage
-            response = requests.delete(
+            response = self.session.delete(
                 f"{self.storage_url}/object/{profile_bucket}/{file_path}",
-                headers={
-                    "apikey": self.supabase_key,
-                    "Authorization": f"Bearer {self.supabase_key}"
-                }
+                timeout=self.timeout
             )
             
             if response.status_code == 200:
@@ -1,152 +1,184 @@
 #!/usr/bin/env python3
 
-import os
-import sys
-from typing import List, Dict, Set
-from sqlalchemy.orm import Session
+import bisect
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterator, List, Dict, NamedTuple, Set
+from sqlalchemy import delete, func, select
 from database import SessionLocal, Paper
 from pinecone_service import PineconeService
+from repair_org_stats import OrganizationStatsRepair
 from supabase_storage import SupabaseStorageService
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Rows fetched per round trip while streaming papers
+DB_FETCH_SIZE = 5000
+# Papers deleted per transaction
+DB_DELETE_BATCH_SIZE = 500
+
+class PaperRow(NamedTuple):
+    id: str
+    title: str
+    file_url: str
+    uploaded_at: datetime
+
+class SyncAborted(Exception):
+    """Raised when a sync would act on incomplete or implausible data"""
+
 class DatabaseSync:
-    def __init__(self):
+    def __init__(self, workers: int = 8):
         self.pinecone_service = PineconeService()
         self.storage_service = SupabaseStorageService()
         self.db = SessionLocal()
-    
-    def get_supabase_papers(self) -> Dict[str, Paper]:
-        papers = self.db.query(Paper).all()
-        return {str(paper.id): paper for paper in papers}
-    
+        self.workers = workers
+
+    def iter_supabase_papers(self) -> Iterator[PaperRow]:
+        """Stream papers in DB_FETCH_SIZE batches instead of loading the whole table"""
+        rows = self.db.execute(
+            select(Paper.id, Paper.title, Paper.file_url, Paper.uploaded_at)
+            .execution_options(yield_per=DB_FETCH_SIZE)
+        )
+        for paper_id, title, file_url, uploaded_at in rows:
+            yield PaperRow(str(paper_id), title, file_url, uploaded_at)
+
     def get_pinecone_papers(self) -> Set[str]:
-        try:
-            results = self.pinecone_service.index.query(
-                vector=[0.0] * 1536,
-                top_k=10000,
-                include_metadata=True
-            )
-            paper_ids = set()
+        return self.pinecone_service.list_paper_ids(self.workers)
+
+    def _delete_stored_pdf(self, paper: PaperRow) -> None:
+        file_url = str(paper.file_url) if paper.file_url else None
+        if file_url and file_url.strip():
             try:
-                matches = results.matches
-                for match in matches:
-                    paper_id = match.metadata.get("paper_id")
-                    if paper_id:
-                        paper_ids.add(paper_id)
-            except AttributeError:
-                if isinstance(results, dict) and 'matches' in results:
-                    for match in results['matches']:
-                        paper_id = match.get('metadata', {}).get('paper_id')
-                        if paper_id:
-                            paper_ids.add(paper_id)
-            return paper_ids
-        except Exception as e:
-            print(f"Error getting Pinecone papers: {e}")
-            return set()
-    
-    def sync_databases(self, dry_run: bool = True) -> Dict[str, List[str]]:
-        print("Starting database sync...")
+                self.storage_service.delete_pdf(file_url)
+            except Exception as e:
+                print(f"    Error deleting {file_url} from storage: {e}")
+
+    def _delete_papers(self, papers: List[PaperRow]) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(papers), DB_DELETE_BATCH_SIZE):
+                batch = papers[start:start + DB_DELETE_BATCH_SIZE]
+                list(executor.map(self._delete_stored_pdf, batch))
+                self.db.execute(delete(Paper).where(Paper.id.in_([uuid.UUID(paper.id) for paper in batch])))
+                self.db.commit()
+                print(f"  Deleted {start + len(batch)}/{len(papers)} papers from Supabase")
+
+    def _delete_vectors(self, paper_ids: List[str]) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            deleted = sum(executor.map(self.pinecone_service.delete_paper_vectors, paper_ids))
+        print(f"  Deleted {deleted} vectors for {len(paper_ids)} papers from Pinecone")
 
-        supabase_papers = self.get_supabase_papers()
-        pinecone_papers = self.get_pinecone_papers()
+    def sync_databases(
+        self,
+        dry_run: bool = True,
+        min_age: timedelta = timedelta(hours=1),
+        max_delete_fraction: float = 0.5
+    ) -> Dict[str, List[str]]:
+        """Delete papers missing from Pinecone and vectors whose paper is gone.
 
-        print(f"Found {len(supabase_papers)} papers in Supabase")
-        print(f"Found {len(pinecone_papers)} papers in Pinecone")
+        Pinecone is listed before the database is read: an upload commits its
+        row before storing vectors, so every listed vector's paper is already
+        visible. Papers younger than min_age may still be ingesting and are
+        left alone. The sync refuses to delete more than max_delete_fraction
+        of either side.
+        """
+        print("Starting database sync...")
 
-        supabase_ids = set(supabase_papers.keys())
-        pinecone_ids = pinecone_papers
+        pinecone_ids = sorted(self.get_pinecone_papers())
+        print(f"Found {len(pinecone_ids)} papers in Pinecone")
 
-        only_in_supabase = supabase_ids - pinecone_ids
-        only_in_pinecone = pinecone_ids - supabase_ids
+        # Diff by streaming papers against the sorted Pinecone ids
+        seen = bytearray(len(pinecone_ids))
+        only_in_supabase: List[PaperRow] = []
+        supabase_count = 0
+        cutoff = datetime.utcnow() - min_age
+        for paper in self.iter_supabase_papers():
+            supabase_count += 1
+            position = bisect.bisect_left(pinecone_ids, paper.id)
+            if position < len(pinecone_ids) and pinecone_ids[position] == paper.id:
+                seen[position] = 1
+            elif paper.uploaded_at is None or paper.uploaded_at < cutoff:
+                only_in_supabase.append(paper)
+        only_in_pinecone = [paper_id for paper_id, found in zip(pinecone_ids, seen) if not found]
+        print(f"Found {supabase_count} papers in Supabase")
 
         print("Analysis Results:")
         print(f"  Orphaned in Supabase (deleting): {len(only_in_supabase)}")
         print(f"  Orphaned in Pinecone (deleting): {len(only_in_pinecone)}")
 
-        if only_in_supabase:
-            for paper_id in only_in_supabase:
-                paper = supabase_papers[paper_id]
-                print(f"  Deleting from Supabase: {paper.title} (ID: {paper_id})")
-                if not dry_run:
-                    file_url = str(paper.file_url) if paper.file_url else None
-                    if file_url and file_url.strip():
-                        try:
-                            self.storage_service.delete_pdf(file_url)
-                        except Exception as e:
-                            print(f"    Error deleting from storage: {e}")
-                    self.db.delete(paper)
-
-        if only_in_pinecone:
-            for paper_id in only_in_pinecone:
-                print(f"  Deleting from Pinecone: {paper_id}")
-                if not dry_run:
-                    self.pinecone_service.delete_document_vectors(paper_id)
+        for side, orphaned, total in (
+            ("Supabase", len(only_in_supabase), supabase_count),
+            ("Pinecone", len(only_in_pinecone), len(pinecone_ids))
+        ):
+            if total and orphaned > total * max_delete_fraction:
+                raise SyncAborted(
+                    f"Refusing to delete {orphaned} of {total} papers from {side}; "
+                    f"check the listings or raise --max-delete-fraction"
+                )
+
+        for paper in only_in_supabase:
+            print(f"  Deleting from Supabase: {paper.title} (ID: {paper.id})")
+        for paper_id in only_in_pinecone:
+            print(f"  Deleting from Pinecone: {paper_id}")
 
         if not dry_run:
-            self.db.commit()
+            if only_in_supabase:
+                self._delete_papers(only_in_supabase)
+                OrganizationStatsRepair().repair(dry_run=False)
+            if only_in_pinecone:
+                self._delete_vectors(only_in_pinecone)
             print("Sync cleanup committed")
 
         return {
-            "deleted_from_supabase": list(only_in_supabase),
-            "deleted_from_pinecone": list(only_in_pinecone)
+            "deleted_from_supabase": [paper.id for paper in only_in_supabase],
+            "deleted_from_pinecone": only_in_pinecone
         }
-    
+
     def clear_all_data(self, dry_run: bool = True) -> bool:
         print("Clearing all data...")
-        
+
         if dry_run:
             print("(DRY RUN - No data will be deleted)")
-        
+
         try:
             print("Clearing Pinecone index...")
             if not dry_run:
-                results = self.pinecone_service.index.query(
-                    vector=[0.0] * 1536,
-                    top_k=10000,
-                    include_metadata=False
-                )
-                try:
-                    matches = results.matches
-                    if matches:
-                        vector_ids = [match.id for match in matches]
-                        self.pinecone_service.index.delete(ids=vector_ids)
-                        print(f"  Deleted {len(vector_ids)} vectors from Pinecone")
-                except AttributeError:
-                    if isinstance(results, dict) and 'matches' in results:
-                        vector_ids = [match.get('id') for match in results['matches']]
-                        if vector_ids:
-                            self.pinecone_service.index.delete(ids=vector_ids)
-                            print(f"  Deleted {len(vector_ids)} vectors from Pinecone")
-            
+                self.pinecone_service.index.delete(delete_all=True)
+                print("  Deleted all vectors from Pinecone")
+
             print("Clearing Supabase database...")
             if not dry_run:
-                papers = self.db.query(Paper).all()
-                for paper in papers:
-                    file_url = str(paper.file_url) if paper.file_url else None
-                    if file_url and file_url.strip():
-                        try:
-                            self.storage_service.delete_pdf(file_url)
-                        except Exception as e:
-                            print(f"  Error deleting from storage: {e}")
-                    self.db.delete(paper)
-                self.db.commit()
-                print(f"  Deleted {len(papers)} papers from database")
-            
+                total = self.db.scalar(select(func.count(Paper.id)))
+                deleted = 0
+                while True:
+                    batch = [
+                        PaperRow(str(paper_id), title, file_url, uploaded_at)
+                        for paper_id, title, file_url, uploaded_at in self.db.execute(
+                            select(Paper.id, Paper.title, Paper.file_url, Paper.uploaded_at)
+                            .limit(DB_DELETE_BATCH_SIZE)
+                        )
+                    ]
+                    if not batch:
+                        break
+                    self._delete_papers(batch)
+                    deleted += len(batch)
+                print(f"  Deleted {deleted} of {total} papers from database")
+                OrganizationStatsRepair().repair(dry_run=False)
+
             print("All data cleared successfully")
             return True
-            
+
         except Exception as e:
             print(f"Error clearing data: {e}")
             return False
-    
+
     def close(self):
         self.db.close()
 
 def main():
     import argparse
-    
+
     parser = argparse.ArgumentParser(description="Sync Pinecone and Supabase databases")
     parser.add_argument("--dry-run", action="store_true", default=True,
                        help="Show what would be done without making changes (default: True)")
@@ -154,14 +186,20 @@ def main():
                        help="Actually perform the sync operations")
     parser.add_argument("--clear-all", action="store_true",
                        help="Clear all data from both databases")
-    
+    parser.add_argument("--workers", type=int, default=8,
+                       help="Parallel listing and delete requests (default: 8)")
+    parser.add_argument("--min-age-minutes", type=float, default=60,
+                       help="Leave papers uploaded more recently than this alone (default: 60)")
+    parser.add_argument("--max-delete-fraction", type=float, default=0.5,
+                       help="Abort if more than this fraction of either side would be deleted (default: 0.5)")
+
     args = parser.parse_args()
-    
+
     if args.execute:
         args.dry_run = False
-    
-    sync = DatabaseSync()
-    
+
+    sync = DatabaseSync(workers=args.workers)
+
     try:
         if args.clear_all:
             print("WARNING: This will delete ALL data from both Pinecone and Supabase")
@@ -176,7 +214,15 @@ def main():
             else:
                 print("Failed to clear all data")
         else:
-            results = sync.sync_databases(dry_run=args.dry_run)
+            try:
+                sync.sync_databases(
+                    dry_run=args.dry_run,
+                    min_age=timedelta(minutes=args.min_age_minutes),
+                    max_delete_fraction=args.max_delete_fraction
+                )
+            except SyncAborted as e:
+                print(f"Sync aborted: {e}")
+                return
             if args.dry_run:
                 print("To execute these changes, run with --execute flag")
             else:
@@ -185,4 +231,4 @@ def main():
         sync.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+# database.py and the services read their configuration at import time, so the
+# environment has to be in place before app is imported by any test module
+_TEST_DIR = tempfile.mkdtemp(prefix="alexandria-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_TEST_DIR}/app.db"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.pop("READ_DATABASE_URL", None)
+os.environ["PDF_CACHE_DIR"] = os.path.join(_TEST_DIR, "pdf_cache")
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test.anon.key")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test.service.key")
+os.environ.setdefault("SUPABASE_JWT_SECRET", "test-jwt-secret")
+os.environ.setdefault("OPENAI_API_KEY", "test-openai-key")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,168 @@
+"""Listings must cost a fixed number of SQL statements however many rows they return.
+
+Each test seeds the same listing with one row and with several, requests it,
+and compares the statements the async engine executed. A difference means a
+per-row query (a lazy load or a loop of lookups) crept back in.
+"""
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from access import membership_cache, user_cache
+from app import app, get_current_user
+from database import (
+    SessionLocal, async_engine, async_read_engine, User, Organization, Membership, Paper,
+    MembershipRole, MembershipStatus, UserRole
+)
+
+MANY = 5
+
+
+@contextmanager
+def count_statements():
+    """Collect the statements executed on the primary and replica engines"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = {async_engine.sync_engine, async_read_engine.sync_engine}
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", record)
+
+
+def add_user(db, email_prefix="user"):
+    user = User(
+        id=uuid.uuid4(),
+        email=f"{email_prefix}-{uuid.uuid4().hex}@example.com",
+        name=email_prefix,
+        role=UserRole.MEMBER.value
+    )
+    db.add(user)
+    return user
+
+
+def add_organization(db, creator):
+    organization = Organization(id=uuid.uuid4(), name=f"org-{uuid.uuid4().hex}", created_by=creator.id)
+    db.add(organization)
+    return organization
+
+
+def add_membership(db, user, organization, role=MembershipRole.MEMBER.value, offset=0):
+    requested_at = datetime.utcnow() + timedelta(seconds=offset)
+    db.add(Membership(
+        id=uuid.uuid4(),
+        user_id=user.id,
+        organization_id=organization.id,
+        status=MembershipStatus.APPROVED.value,
+        role_in_org=role,
+        requested_at=requested_at,
+        approved_at=requested_at
+    ))
+
+
+@pytest.fixture
+def client():
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    membership_cache.invalidate_where(lambda key: True)
+    user_cache.invalidate_where(lambda key: True)
+
+
+def get_as(client, user, path):
+    """GET path as user, returning the response and the statements it executed"""
+    app.dependency_overrides[get_current_user] = lambda: user
+    with count_statements() as statements:
+        response = client.get(path)
+    assert response.status_code == 200, response.text
+    return response, statements
+
+
+def seed_organizations(count):
+    with SessionLocal() as db:
+        user = add_user(db)
+        for i in range(count):
+            organization = add_organization(db, user)
+            add_membership(db, user, organization, offset=i)
+        db.commit()
+        db.refresh(user)
+        db.expunge(user)
+    return user
+
+
+def seed_members(count):
+    with SessionLocal() as db:
+        admin = add_user(db, "admin")
+        organization = add_organization(db, admin)
+        add_membership(db, admin, organization, role=MembershipRole.ORG_ADMIN.value)
+        for i in range(count):
+            add_membership(db, add_user(db), organization, offset=i + 1)
+        db.commit()
+        db.refresh(admin)
+        db.expunge(admin)
+        return admin, str(organization.id)
+
+
+def seed_papers(count):
+    with SessionLocal() as db:
+        user = add_user(db)
+        organization = add_organization(db, user)
+        add_membership(db, user, organization)
+        for i in range(count):
+            # Each paper has its own uploader so their emails cannot come from one cached load
+            uploader = add_user(db, "uploader")
+            filename = f"{uuid.uuid4()}_paper{i}.pdf"
+            db.add(Paper(
+                id=uuid.uuid4(),
+                title=f"Paper {i}",
+                file_url=f"org_{organization.id}/{filename}",
+                filename=filename,
+                uploaded_by=uploader.id,
+                organization_id=organization.id,
+                uploaded_at=datetime.utcnow() + timedelta(seconds=i)
+            ))
+        db.commit()
+        db.refresh(user)
+        db.expunge(user)
+        return user, str(organization.id)
+
+
+def test_organization_listing_query_count_is_constant(client):
+    one, one_statements = get_as(client, seed_organizations(1), "/organizations")
+    many, many_statements = get_as(client, seed_organizations(MANY), "/organizations")
+
+    assert len(one.json()) == 1
+    assert len(many.json()) == MANY
+    assert len(many_statements) == len(one_statements)
+
+
+def test_member_listing_query_count_is_constant(client):
+    admin, organization_id = seed_members(1)
+    one, one_statements = get_as(client, admin, f"/organizations/{organization_id}/members")
+    admin, organization_id = seed_members(MANY)
+    many, many_statements = get_as(client, admin, f"/organizations/{organization_id}/members")
+
+    assert len(one.json()) == 2
+    assert len(many.json()) == MANY + 1
+    assert len(many_statements) == len(one_statements)
+
+
+def test_paper_listing_query_count_is_constant(client):
+    user, organization_id = seed_papers(1)
+    one, one_statements = get_as(client, user, f"/papers/{organization_id}")
+    user, organization_id = seed_papers(MANY)
+    many, many_statements = get_as(client, user, f"/papers/{organization_id}")
+
+    assert len(one.json()) == 1
+    assert len(many.json()) == MANY
+    assert all(paper["uploaded_by"] != "Unknown" for paper in many.json())
+    assert len(many_statements) == len(one_statements)
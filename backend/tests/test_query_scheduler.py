@@ -0,0 +1,145 @@
+"""Admission control for LLM-backed queries: ordering, overflow and slot release."""
+import asyncio
+import json
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+import app as app_module
+from concurrency import QueryScheduler, QueueFullError
+from schemas import QueryRequest
+
+
+def test_waiting_orgs_are_served_round_robin():
+    async def scenario():
+        scheduler = QueryScheduler(max_concurrent=1, max_queued=10, max_queued_per_org=10)
+        running = scheduler.admit("a")
+        waiting = [scheduler.admit(org_id) for org_id in ("a", "a", "b", "c")]
+
+        order = []
+        for _ in waiting:
+            running.release()
+            running = next(ticket for ticket in waiting if not ticket.waiting and not ticket.released)
+            order.append(running.org_id)
+        return order
+
+    assert asyncio.run(scenario()) == ["a", "b", "c", "a"]
+
+
+def test_full_queue_raises_queue_full():
+    async def scenario():
+        scheduler = QueryScheduler(max_concurrent=1, max_queued=2, max_queued_per_org=1)
+        scheduler.admit("a")
+        scheduler.admit("a")
+        with pytest.raises(QueueFullError):
+            scheduler.admit("a")
+        scheduler.admit("b")
+        with pytest.raises(QueueFullError) as excinfo:
+            scheduler.admit("c")
+        assert excinfo.value.retry_after >= 1
+        assert scheduler.stats()["rejected"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_admit_query_answers_429_when_saturated(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(app_module, "query_scheduler", QueryScheduler(1, 0, 0))
+        query = QueryRequest(question="Why?", organization_id=uuid.uuid4())
+        deadline = asyncio.get_running_loop().time() + 30
+        app_module.admit_query(query, deadline)
+        with pytest.raises(HTTPException) as excinfo:
+            app_module.admit_query(query, deadline)
+        assert excinfo.value.status_code == 429
+        assert "Retry-After" in excinfo.value.headers
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = QueryScheduler(max_concurrent=1, max_queued=10, max_queued_per_org=10)
+        running = scheduler.admit("a")
+        waiter = scheduler.admit("b")
+        acquiring = asyncio.ensure_future(waiter.acquire())
+        await asyncio.sleep(0)
+        acquiring.cancel()
+        waiter.release()
+        assert scheduler.stats()["queued"] == 0
+
+        running.release()
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_is_held_until_the_answer_task_ends():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        scheduler = QueryScheduler(max_concurrent=1, max_queued=10, max_queued_per_org=10)
+        ticket = scheduler.admit("a")
+        ticket.release_at(loop.time() + 0.01)
+        answer_task = asyncio.ensure_future(asyncio.sleep(60))
+        ticket.release_when_done(answer_task)
+
+        # The deadline safety net no longer applies once a task holds the slot
+        await asyncio.sleep(0.05)
+        assert not ticket.released
+
+        answer_task.cancel()
+        await asyncio.gather(answer_task, return_exceptions=True)
+        assert ticket.released
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+class SlowDocs:
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def aget_evidence(self, query, callbacks=None):
+        self.started.set()
+        session = type("Session", (), {})()
+        session.contexts = []
+        return session
+
+    async def aquery(self, session, callbacks=None):
+        session.formatted_answer = "An answer."
+        return session
+
+
+class ConnectedRequest:
+    async def is_disconnected(self):
+        return False
+
+
+def test_run_started_without_a_ticket_waits_for_a_slot(monkeypatch):
+    async def scenario():
+        scheduler = QueryScheduler(max_concurrent=1, max_queued=10, max_queued_per_org=10)
+        monkeypatch.setattr(app_module, "query_scheduler", scheduler)
+        # Admitted while its question was in flight, so it arrives without a ticket
+        query = QueryRequest(question="Why?", organization_id=uuid.uuid4())
+        deadline = asyncio.get_running_loop().time() + 30
+        blocker = scheduler.admit("other")
+        docs = SlowDocs()
+
+        async def collect():
+            return [
+                json.loads(event[len("data: "):])
+                async for event in app_module.stream_answer_events(query, docs, [], ConnectedRequest(), deadline)
+            ]
+
+        streaming = asyncio.ensure_future(collect())
+        await asyncio.sleep(0.05)
+        assert not docs.started.is_set()
+        assert scheduler.stats()["queued"] == 1
+
+        blocker.release()
+        events = await streaming
+        assert docs.started.is_set()
+        assert not any("error" in event for event in events)
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,62 @@
+"""The answer stream carries PaperQA's answer tokens and nothing it generates along the way."""
+import asyncio
+import json
+import uuid
+
+from app import stream_answer_events
+from schemas import QueryRequest
+
+SUMMARY = "Chunk summary that must stay private."
+ANSWER_TOKENS = ["Transformers use attention. ", "They scale well. ", "Training is parallel."]
+
+
+class StubSession:
+    def __init__(self, question, contexts):
+        self.question = question
+        self.contexts = contexts
+        self.formatted_answer = ""
+
+
+class StubDocs:
+    """Calls callbacks the way paper-qa 5 does: once per evidence summary, then per answer token"""
+
+    async def aget_evidence(self, query, callbacks=None):
+        session = StubSession(query, []) if isinstance(query, str) else query
+        for callback in callbacks or []:
+            callback(SUMMARY)
+        session.contexts = ["context"]
+        return session
+
+    async def aquery(self, query, callbacks=None):
+        session = StubSession(query, []) if isinstance(query, str) else query
+        if not session.contexts:
+            session = await self.aget_evidence(session, callbacks=callbacks)
+        for token in ANSWER_TOKENS:
+            for callback in callbacks or []:
+                callback(token)
+        session.formatted_answer = "".join(ANSWER_TOKENS)
+        return session
+
+
+class ConnectedRequest:
+    async def is_disconnected(self):
+        return False
+
+
+async def collect_events(docs, question):
+    query = QueryRequest(question=question, organization_id=uuid.uuid4())
+    deadline = asyncio.get_running_loop().time() + 30
+    return [
+        json.loads(event[len("data: "):])
+        async for event in stream_answer_events(query, docs, [], ConnectedRequest(), deadline)
+    ]
+
+
+def test_evidence_summaries_are_not_streamed():
+    events = asyncio.run(collect_events(StubDocs(), "How do transformers work?"))
+
+    streamed = "".join(event.get("answer", "") for event in events if event.get("thinking") is False)
+    assert not any("error" in event for event in events)
+    assert SUMMARY not in streamed
+    assert streamed.startswith("Transformers use attention.")
+    assert streamed.endswith("Training is parallel.")
@@ -0,0 +1,121 @@
+"""Read-only sessions go to the replica until they write; two SQLite files stand in for both servers."""
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+import database
+from access import get_membership_role, membership_cache
+from database import (
+    Base, User, Organization, Membership, MembershipRole, MembershipStatus,
+    get_async_read_db, reads_from_replica
+)
+
+
+@pytest.fixture
+def databases(tmp_path, monkeypatch):
+    """Route sessions to separate primary and replica files, each with a differently named organization"""
+    user_id, org_id = uuid.uuid4(), uuid.uuid4()
+    sync_engines = {}
+    for name in ("primary", "replica"):
+        path = tmp_path / f"{name}.db"
+        sync_engines[name] = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(sync_engines[name])
+        with Session(sync_engines[name]) as db:
+            db.add(User(id=user_id, email="reader@example.com"))
+            db.add(Organization(id=org_id, name=name, created_by=user_id))
+            db.commit()
+        monkeypatch.setattr(
+            database, f"async_{'engine' if name == 'primary' else 'read_engine'}",
+            create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
+        )
+    yield sync_engines, user_id, org_id
+    membership_cache.invalidate_where(lambda key: True)
+    for engine in sync_engines.values():
+        engine.dispose()
+
+
+async def read_session():
+    """Open a session the way get_async_read_db hands it to an endpoint"""
+    sessions = get_async_read_db()
+    return sessions, await sessions.__anext__()
+
+
+def organization_name(org_id):
+    return select(Organization.name).where(Organization.id == org_id)
+
+
+def test_read_sessions_use_the_replica(databases):
+    _, _, org_id = databases
+
+    async def scenario():
+        sessions, db = await read_session()
+        try:
+            assert reads_from_replica(db)
+            assert await db.scalar(organization_name(org_id)) == "replica"
+        finally:
+            await sessions.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_flush_switches_the_session_to_the_primary(databases):
+    _, user_id, org_id = databases
+
+    async def scenario():
+        sessions, db = await read_session()
+        try:
+            assert await db.scalar(organization_name(org_id)) == "replica"
+            db.add(Organization(id=uuid.uuid4(), name="new", created_by=user_id))
+            await db.flush()
+            assert not reads_from_replica(db)
+            assert await db.scalar(organization_name(org_id)) == "primary"
+        finally:
+            await sessions.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_dml_switches_the_session_to_the_primary(databases):
+    _, _, org_id = databases
+
+    async def scenario():
+        sessions, db = await read_session()
+        try:
+            await db.execute(update(Organization).where(Organization.id == org_id).values(name="renamed"))
+            assert await db.scalar(organization_name(org_id)) == "renamed"
+            await db.commit()
+        finally:
+            await sessions.aclose()
+
+    asyncio.run(scenario())
+    sync_engines, _, _ = databases
+    with Session(sync_engines["replica"]) as db:
+        assert db.scalar(organization_name(org_id)) == "replica"
+
+
+def test_membership_missing_on_the_replica_is_read_from_the_primary(databases):
+    sync_engines, user_id, org_id = databases
+    # Approved on the primary but not yet replicated
+    with Session(sync_engines["primary"]) as db:
+        db.add(Membership(
+            id=uuid.uuid4(),
+            user_id=user_id,
+            organization_id=org_id,
+            status=MembershipStatus.APPROVED.value,
+            role_in_org=MembershipRole.MEMBER.value
+        ))
+        db.commit()
+
+    async def scenario():
+        sessions, db = await read_session()
+        try:
+            return await get_membership_role(db, user_id, org_id)
+        finally:
+            await sessions.aclose()
+
+    assert asyncio.run(scenario()) == MembershipRole.MEMBER.value
@@ -419,13 +419,19 @@ const ChatInterface = ({ organizationId, authToken, userOrganizations, selectedO
               return newHistory;
             });
           } else {
+            if (data.insufficient_info) {
+              // Sources arrive before the answer; drop them if the answer turns out unsupported
+              finalSources = [];
+              finalEnhancedSources = [];
+            }
             // Regular answer text - always append, never replace
             fullAnswer += data.answer;
             setCurrentMessage(prev => ({
               ...prev,
               text: fullAnswer,
               isThinking: false,
-              insufficient_info: data.insufficient_info || false
+              insufficient_info: data.insufficient_info || false,
+              ...(data.insufficient_info ? { sources: [], enhancedSources: [] } : {})
             }));
             setChatHistory(prev => {
               const newHistory = [...prev];
@@ -433,7 +439,8 @@ const ChatInterface = ({ organizationId, authToken, userOrganizations, selectedO
                 ...newHistory[newHistory.length - 1],
                 text: fullAnswer,
                 isThinking: false,
-                insufficient_info: data.insufficient_info || false
+                insufficient_info: data.insufficient_info || false,
+                ...(data.insufficient_info ? { sources: [], enhancedSources: [] } : {})
               };
               return newHistory;
             });